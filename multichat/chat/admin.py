@@ -3,8 +3,8 @@ from .models import Message, UserProfile
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('sender', 'receiver', 'timestamp', 'is_read')
-    list_filter = ('is_read', 'timestamp')
+    list_display = ('sender', 'receiver', 'timestamp')
+    list_filter = ('timestamp',)
     search_fields = ('content', 'sender__username', 'receiver__username')
     date_hierarchy = 'timestamp'
 
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+
+
+def backfill_conversations(apps, schema_editor):
+    """
+    Build one Conversation row per pair of users that already exchanged messages.
+    """
+    Message = apps.get_model('chat', 'Message')
+    Conversation = apps.get_model('chat', 'Conversation')
+
+    pairs = {}
+    per_direction = Message.objects.values('sender_id', 'receiver_id').annotate(
+        last_id=Max('id'),
+        unread=Count('id', filter=Q(is_read=False)),
+    )
+    for row in per_direction:
+        sender_id, receiver_id = row['sender_id'], row['receiver_id']
+        low, high = sorted((sender_id, receiver_id))
+        pair = pairs.setdefault((low, high), {'last_id': 0, 'unread_low': 0, 'unread_high': 0})
+        pair['last_id'] = max(pair['last_id'], row['last_id'])
+        # Unread messages count against their receiver
+        pair['unread_low' if receiver_id == low else 'unread_high'] += row['unread']
+
+    last_messages = Message.objects.in_bulk([pair['last_id'] for pair in pairs.values()])
+    Conversation.objects.bulk_create([
+        Conversation(
+            user_low_id=low,
+            user_high_id=high,
+            last_message_id=pair['last_id'],
+            last_message_preview=last_messages[pair['last_id']].content[:100],
+            last_message_at=last_messages[pair['last_id']].timestamp,
+            unread_low=pair['unread_low'],
+            unread_high=pair['unread_high'],
+        )
+        for (low, high), pair in pairs.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_room_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_preview', models.CharField(blank=True, max_length=100)),
+                ('last_message_at', models.DateTimeField(null=True)),
+                ('unread_low', models.PositiveIntegerField(default=0)),
+                ('unread_high', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_message_at'], name='chat_conversation_low_inbox'), models.Index(fields=['user_high', '-last_message_at'], name='chat_conversation_high_inbox')],
+                'constraints': [models.UniqueConstraint(fields=('user_low', 'user_high'), name='chat_unique_conversation_pair')],
+            },
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,13 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, Least
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+# conversation_key is low * CONVERSATION_KEY_BASE + high for the ordered pair
+# of user ids, which fits a bigint as long as user ids fit 32 bits
+CONVERSATION_KEY_BASE = 2 ** 32
+
 
 class UserProfile(models.Model):
     """
@@ -17,12 +23,12 @@ class UserProfile(models.Model):
     @property
     def has_unread_messages(self):
         """Check if user has any unread messages."""
-        return Message.objects.filter(receiver=self.user, is_read=False).exists()
+        return Conversation.objects.with_unread_for(self.user_id).exists()
     
     @property
     def unread_message_count(self):
         """Get count of unread messages."""
-        return Message.objects.filter(receiver=self.user, is_read=False).count()
+        return Conversation.unread_total(self.user_id)
 
 
 class Message(models.Model):
@@ -33,18 +39,31 @@ class Message(models.Model):
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # The same for both directions of a conversation, computed by the database
+    conversation_key = models.GeneratedField(
+        expression=Least('sender', 'receiver') * CONVERSATION_KEY_BASE + Greatest('sender', 'receiver'),
+        output_field=models.BigIntegerField(),
+        db_persist=True,
+    )
     
     class Meta:
         ordering = ['timestamp']
-    indexes = [
-        models.Index(fields=['sender', 'receiver', 'is_read']),
-        models.Index(fields=['timestamp'])
-    ]
+        indexes = [
+            # History pages are one range scan over a conversation in (timestamp, id) order
+            models.Index(fields=['conversation_key', 'timestamp', 'id'], name='chat_message_history'),
+            # Admin list ordering and date drill-down
+            models.Index(fields=['timestamp'], name='chat_message_timestamp'),
+        ]
     
     def __str__(self):
         return f"From {self.sender.username} to {self.receiver.username}: {self.content[:20]}"
     
+    @staticmethod
+    def key_for(user_id, other_id):
+        """The conversation_key of the messages between two users."""
+        low, high = Conversation.pair(user_id, other_id)
+        return low * CONVERSATION_KEY_BASE + high
+    
     @property
     def formatted_timestamp(self):
         """Return nicely formatted timestamp for templates."""
@@ -57,3 +76,157 @@ class Message(models.Model):
         else:
             # Other days
             return self.timestamp.strftime("%d %b %Y, %H:%M")
+
+
+class ConversationQuerySet(models.QuerySet):
+
+    def with_unread_for(self, user_id):
+        """Conversations in which user_id has unread messages."""
+        return self.filter(
+            Q(user_low_id=user_id, unread_low__gt=0) | Q(user_high_id=user_id, unread_high__gt=0)
+        )
+
+
+class Conversation(models.Model):
+    """
+    Denormalized inbox row for a pair of users, kept up to date as messages
+    are saved and read so the chat index never has to scan Message.
+
+    What each side has read is a high-watermark: the id of the last message
+    they have seen. Everything the other side sent after it is unread, and
+    the unread counters hold how many messages that is.
+
+    The pair is stored ordered (user_low.id < user_high.id), so each
+    conversation has exactly one row no matter who wrote first.
+    """
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, related_name='+')
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_message_at = models.DateTimeField(null=True)
+    unread_low = models.PositiveIntegerField(default=0)
+    unread_high = models.PositiveIntegerField(default=0)
+    last_read_low = models.BigIntegerField(default=0)
+    last_read_high = models.BigIntegerField(default=0)
+
+    objects = ConversationQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='chat_unique_conversation_pair'),
+        ]
+        indexes = [
+            models.Index(fields=['user_low', '-last_message_at'], name='chat_conversation_low_inbox'),
+            models.Index(fields=['user_high', '-last_message_at'], name='chat_conversation_high_inbox'),
+        ]
+
+    def __str__(self):
+        return f"Conversation between {self.user_low_id} and {self.user_high_id}"
+
+    @staticmethod
+    def pair(user_id, other_id):
+        """Return the two user ids in storage order."""
+        return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+    @staticmethod
+    def unread_field(user_id, other_id):
+        """Name of the unread counter belonging to user_id."""
+        return 'unread_low' if user_id < other_id else 'unread_high'
+
+    @staticmethod
+    def last_read_field(user_id, other_id):
+        """Name of the read cursor belonging to user_id."""
+        return 'last_read_low' if user_id < other_id else 'last_read_high'
+
+    @classmethod
+    def between(cls, user_id, other_id):
+        """The row of a pair of users, as a queryset."""
+        low, high = cls.pair(user_id, other_id)
+        return cls.objects.filter(user_low_id=low, user_high_id=high)
+
+    @classmethod
+    def for_user(cls, user):
+        """All conversations of a user, most recently active first."""
+        return cls.objects.filter(
+            Q(user_low=user) | Q(user_high=user),
+            last_message_at__isnull=False,
+        ).order_by('-last_message_at')
+
+    @classmethod
+    def unread_total(cls, user_id):
+        """Number of unread messages of a user across all conversations."""
+        totals = cls.objects.with_unread_for(user_id).aggregate(
+            total=Sum(Case(When(user_low_id=user_id, then=F('unread_low')), default=F('unread_high')))
+        )
+        return totals['total'] or 0
+
+    @classmethod
+    def record_message(cls, message):
+        """
+        Fold a newly saved message into its conversation row and return the
+        receiver's new unread count for the conversation.
+
+        This is a single UPDATE with F() expressions, so concurrent writers
+        never lose an unread increment, and an older message that commits
+        late cannot replace a newer one as the last message.
+        """
+        low, high = cls.pair(message.sender_id, message.receiver_id)
+        unread = cls.unread_field(message.receiver_id, message.sender_id)
+        preview = message.content[:100]
+        newer = Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.timestamp)
+
+        def latest(field, value, output_field):
+            return Case(When(newer, then=Value(value)), default=F(field), output_field=output_field)
+
+        updates = {
+            'last_message_id': latest('last_message_id', message.id, models.BigIntegerField()),
+            'last_message_preview': latest('last_message_preview', preview, models.CharField()),
+            'last_message_at': latest('last_message_at', message.timestamp, models.DateTimeField()),
+            unread: F(unread) + 1,
+        }
+        conversation = cls.objects.filter(user_low_id=low, user_high_id=high)
+        if conversation.update(**updates):
+            return conversation.values_list(unread, flat=True).get()
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    user_low_id=low,
+                    user_high_id=high,
+                    last_message=message,
+                    last_message_preview=preview,
+                    last_message_at=message.timestamp,
+                    **{unread: 1}
+                )
+            return 1
+        except IntegrityError:
+            # Someone else created the row first; apply our message to it
+            conversation.update(**updates)
+            return conversation.values_list(unread, flat=True).get()
+
+    @classmethod
+    def mark_read(cls, reader_id, other_id):
+        """
+        Move the reader's cursor up to the last message of the conversation
+        and reset their unread counter; a single-row UPDATE however many
+        messages were unread. Returns the new cursor, or None if there was
+        nothing unread.
+        """
+        unread = cls.unread_field(reader_id, other_id)
+        last_read = cls.last_read_field(reader_id, other_id)
+        conversation = cls.between(reader_id, other_id)
+        reset = conversation.filter(**{f"{unread}__gt": 0}).update(**{
+            last_read: Greatest(F(last_read), Coalesce(F('last_message_id'), 0)),
+            unread: 0,
+        })
+        if not reset:
+            return None
+        return conversation.values_list(last_read, flat=True).get()
+
+    def other_user(self, user):
+        return self.user_high if user.id == self.user_low_id else self.user_low
+
+    def unread_count_for(self, user):
+        return self.unread_low if user.id == self.user_low_id else self.unread_high
+
+    def last_read_for(self, user):
+        return self.last_read_low if user.id == self.user_low_id else self.last_read_high
@@ -1,17 +1,39 @@
 from django.contrib import admin
+from django.db.models import Q
 
-from django.contrib import admin
-from .models import Message, UserProfile
+from .models import Message, Room, UserProfile
+from .search import match
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('sender', 'receiver', 'timestamp', 'is_read')
-    list_filter = ('is_read', 'timestamp')
+    list_display = ('sender', 'receiver', 'timestamp')
+    list_filter = ('timestamp',)
     search_fields = ('content', 'sender__username', 'receiver__username')
     date_hierarchy = 'timestamp'
+    # Counting every message again for each search would be the slow part
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Match content through the full-text index rather than scanning the
+        table with icontains, and usernames exactly.
+        """
+        if not search_term:
+            return queryset, False
+        condition = Q(sender__username=search_term) | Q(receiver__username=search_term)
+        content = match(search_term)
+        if content is not None:
+            condition |= content
+        return queryset.filter(condition), False
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'is_online', 'last_activity')
     list_filter = ('is_online',)
     search_fields = ('user__username',)
+
+@admin.register(Room)
+class RoomAdmin(admin.ModelAdmin):
+    list_display = ('title', 'staff_only')
+    list_filter = ('staff_only',)
+    search_fields = ('title',)
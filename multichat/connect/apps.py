@@ -6,5 +6,6 @@ class ConnectChatConfig(AppConfig):
     label = 'connect'  # Explicitly set the label
 
     def ready(self):
-        pass
+        # Import the signals module to ensure the signal handlers are registered
+        import connect.signals
 
@@ -0,0 +1,220 @@
+"""
+Cold storage for old messages.
+
+archive_messages moves every month older than MESSAGE_ARCHIVE_AFTER_MONTHS
+out of Message into MessageArchive segments: runs of up to
+MESSAGE_ARCHIVE_SEGMENT_SIZE messages of one conversation, stored as
+zlib-compressed NDJSON. On PostgreSQL the month's partition is then dropped
+(see connect.partitions); elsewhere the rows are deleted.
+
+Months are archived oldest first, so every message up to the newest archived
+one is in the archive and every later one is in Message. paginate() reads
+history across both, so the same keyset cursors keep working when a page
+crosses into archived months. Search only covers Message.
+"""
+
+import json
+import zlib
+from datetime import timedelta
+from itertools import groupby, islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Min
+
+from . import partitions
+from .models import Conversation, Message, MessageArchive
+from .pagination import EPOCH, decode_cursor, encode_cursor, page_size, paginate_messages
+
+UNTIL_KEY = 'archive_until'
+
+
+def segment_size():
+    return getattr(settings, 'MESSAGE_ARCHIVE_SEGMENT_SIZE', 500)
+
+
+def encode(messages):
+    lines = (
+        json.dumps([
+            message.id,
+            message.sender_id,
+            message.receiver_id,
+            message.content,
+            (message.timestamp - EPOCH) // timedelta(microseconds=1),
+        ])
+        for message in messages
+    )
+    return zlib.compress('\n'.join(lines).encode())
+
+
+def decode(data):
+    messages = []
+    for line in zlib.decompress(data).decode().split('\n'):
+        message_id, sender_id, receiver_id, content, micros = json.loads(line)
+        messages.append(Message(
+            id=message_id,
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            content=content,
+            timestamp=EPOCH + timedelta(microseconds=micros),
+        ))
+    return messages
+
+
+def archived_until():
+    """
+    Timestamp of the newest archived message, or None if nothing has been
+    archived yet.
+    """
+    found = cache.get(UNTIL_KEY)
+    if found is None:
+        found = (MessageArchive.objects.order_by('-last_at').values_list('last_at', flat=True).first(),)
+        cache.set(UNTIL_KEY, found, timeout=None)
+    return found[0]
+
+
+def archived(conversation_key, before=None, after=None):
+    """
+    Yields the archived messages of a conversation newest first, or oldest
+    first if after is given. before and after are (timestamp, id) bounds
+    that are not included.
+    """
+    segments = MessageArchive.objects.filter(conversation_key=conversation_key)
+    if after:
+        segments = segments.filter(last_at__gte=after[0]).order_by('first_at', 'id')
+    else:
+        if before:
+            segments = segments.filter(first_at__lte=before[0])
+        segments = segments.order_by('-first_at', '-id')
+    # Segments are decompressed one at a time, as far as the caller reads
+    for segment_id in list(segments.values_list('id', flat=True)):
+        messages = decode(MessageArchive.objects.values_list('data', flat=True).get(id=segment_id))
+        if not after:
+            messages.reverse()
+        for message in messages:
+            position = (message.timestamp, message.id)
+            if (after and position <= after) or (before and position >= before):
+                continue
+            yield message
+
+
+def paginate(queryset, conversation_key, before=None, after=None, limit=None):
+    """
+    paginate_messages() over a conversation, reading Message (queryset)
+    first and the archive once a page reaches back past it.
+    """
+    limit = page_size(limit)
+    until = archived_until()
+    if until is None:
+        return paginate_messages(queryset, before=before, after=after, limit=limit)
+
+    if after:
+        position = decode_cursor(after)
+        if position[0] > until:
+            return paginate_messages(queryset, after=after, limit=limit)
+        messages = list(islice(archived(conversation_key, after=position), limit + 1))
+        if len(messages) <= limit:
+            # The archive ran out; everything later is in Message
+            messages += queryset.order_by('timestamp', 'id')[:limit + 1 - len(messages)]
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        return {
+            'messages': messages,
+            'before': encode_cursor(messages[0]) if messages else None,
+            'after': encode_cursor(messages[-1]) if messages else after,
+            'has_more': has_more,
+        }
+
+    page = paginate_messages(queryset, before=before, limit=limit)
+    if page['has_more']:
+        return page
+    hot = page['messages']
+    if hot:
+        position = (hot[0].timestamp, hot[0].id)
+    else:
+        position = decode_cursor(before) if before else None
+    wanted = limit - len(hot)
+    older = list(islice(archived(conversation_key, before=position), wanted + 1))
+    if not older:
+        return page
+    has_more = len(older) > wanted
+    messages = older[:wanted][::-1] + hot
+    return {
+        'messages': messages,
+        'before': encode_cursor(messages[0]) if has_more else None,
+        'after': encode_cursor(messages[-1]),
+        'has_more': has_more,
+    }
+
+
+def segments(messages, size):
+    """
+    Cuts the messages of one conversation, in order, into archive segments.
+    """
+    messages = iter(messages)
+    while chunk := list(islice(messages, size)):
+        yield MessageArchive(
+            conversation_key=chunk[0].conversation_key,
+            first_at=chunk[0].timestamp,
+            last_at=chunk[-1].timestamp,
+            count=len(chunk),
+            data=encode(chunk),
+        )
+
+
+def archive_month(month):
+    """
+    Moves the messages of the month starting at month into the archive and
+    returns how many there were.
+    """
+    start, end = month, partitions.add_months(month, 1)
+    rows = Message.objects.filter(timestamp__gte=start, timestamp__lt=end).order_by(
+        'conversation_key', 'timestamp', 'id'
+    )
+    size = segment_size()
+    moved = 0
+    with transaction.atomic():
+        pending = []
+        for _, messages in groupby(rows.iterator(chunk_size=2000), key=attrgetter('conversation_key')):
+            for segment in segments(messages, size):
+                pending.append(segment)
+                moved += segment.count
+            if len(pending) >= 100:
+                MessageArchive.objects.bulk_create(pending)
+                pending = []
+        MessageArchive.objects.bulk_create(pending)
+
+        if partitions.is_partitioned(connection) and month in partitions.partitions(connection):
+            partitions.drop_partition(connection, month)
+        # Rows of the month in the default partition, or all of them on
+        # databases without partitions
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {Message._meta.db_table} WHERE timestamp >= %s AND timestamp < %s",
+                [start, end],
+            )
+        # The inbox keeps the preview and time of an archived last message
+        Conversation.objects.filter(last_message_at__lt=end).exclude(last_message=None).update(last_message=None)
+    cache.delete(UNTIL_KEY)
+    return moved
+
+
+def archive_before(cutoff):
+    """
+    Archives every month that ends before cutoff, oldest first. Returns
+    {month: number of messages archived}.
+    """
+    cutoff = partitions.month_start(cutoff)
+    months = set()
+    oldest = Message.objects.filter(timestamp__lt=cutoff).aggregate(oldest=Min('timestamp'))['oldest']
+    if oldest is not None:
+        month = partitions.month_start(oldest)
+        while month < cutoff:
+            months.add(month)
+            month = partitions.add_months(month, 1)
+    if partitions.is_partitioned(connection):
+        # Empty partitions are dropped too
+        months.update(month for month in partitions.partitions(connection) if month < cutoff)
+    return {month: archive_month(month) for month in sorted(months)}
@@ -4,16 +4,22 @@ ASGI config for connect project.
 
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
 # Make sure this matches your actual settings file location:
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'connect.settings')  # <-- Common default
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'connect_settings')
+
+# Set up Django before importing anything that touches models
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.auth import AuthMiddlewareStack
 
 import connect.routing  # Make sure connect/routing.py exists
+from connect1.metrics import with_metrics_endpoint
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    # Prometheus scrapes /metrics from the same app
+    "http": with_metrics_endpoint(django_asgi_app),
     "websocket": AuthMiddlewareStack(
         URLRouter(
             connect.routing.websocket_urlpatterns
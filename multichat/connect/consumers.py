@@ -1,9 +1,10 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
+from connect1.db import database_sync_to_async
+from connect1.identity import identities
+from django.db import transaction
 from django.utils import timezone
-from .models import Message, UserProfile
+from .models import Conversation, Message, UserProfile
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -42,8 +43,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         if message_type == 'chat_message':
             message = data['message']
-            receiver_id = data['receiver_id']
-            
+            receiver_id = int(data['receiver_id'])
+
+            if await identities.get(receiver_id) is None:
+                await self.close(code=4001)  # Custom close code for invalid user
+                return
+
             # Save message to database
             message_obj = await self.save_message(receiver_id, message)
             
@@ -75,7 +80,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             
         elif message_type == 'read_messages':
             sender_id = data['sender_id']
-            await self.mark_messages_as_read(sender_id)
+            last_read = await self.mark_messages_as_read(sender_id)
             
             # Notify sender that messages were read
             sender_group_name = f"user_{sender_id}"
@@ -83,7 +88,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 sender_group_name,
                 {
                     'type': 'messages_read',
-                    'reader_id': self.user.id
+                    'reader_id': self.user.id,
+                    'last_read_message_id': last_read
                 }
             )
             
@@ -133,7 +139,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         await self.send(text_data=json.dumps({
             'type': 'messages_read',
-            'reader_id': event['reader_id']
+            'reader_id': event['reader_id'],
+            'last_read_message_id': event['last_read_message_id']
         }))
 
     async def typing_status(self, event):
@@ -172,12 +179,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         Save message to database.
         """
-        receiver = User.objects.get(id=receiver_id)
-        message = Message.objects.create(
-            sender=self.user,
-            receiver=receiver,
-            content=content
-        )
+        with transaction.atomic():
+            message = Message.objects.create(
+                sender=self.user,
+                receiver_id=receiver_id,
+                content=content
+            )
+            Conversation.record_message(message)
         return message
 
     @database_sync_to_async
@@ -185,9 +193,4 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         Mark messages from sender as read.
         """
-        sender = User.objects.get(id=sender_id)
-        Message.objects.filter(
-            sender=sender,
-            receiver=self.user,
-            is_read=False
-        ).update(is_read=True)
+        return Conversation.mark_read(self.user.id, int(sender_id))
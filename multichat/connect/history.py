@@ -0,0 +1,130 @@
+"""
+Write-through cache of the most recent messages of each conversation.
+
+Every conversation has an entry with its newest HISTORY_CACHE_SIZE messages
+and a generation counter, both in the cache. Saving a message bumps the
+counter and appends the message to the entry; an entry is only used while
+it carries the current generation. Writers that race each other, or a page
+loaded from the database while a message was being saved, therefore leave
+at worst an outdated entry that the next read ignores and refills.
+
+Entries hold the messages only. Whether a message has been read comes from
+the conversation's read cursors, so marking messages read needs no
+invalidation here.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import archive
+from .models import Conversation, Message
+from .pagination import encode_cursor, page_size
+from .versions import fresh_version
+
+
+def cache_size():
+    return getattr(settings, 'HISTORY_CACHE_SIZE', getattr(settings, 'MESSAGE_PAGE_SIZE', 50))
+
+
+def cache_timeout():
+    return getattr(settings, 'HISTORY_CACHE_TTL', 3600)
+
+
+def cache_keys(user_id, other_id):
+    """
+    Keys of the entry and of the generation counter of a conversation.
+    """
+    low, high = Conversation.pair(user_id, other_id)
+    return f"history_{low}_{high}", f"history_generation_{low}_{high}"
+
+
+def pack(message):
+    return (message.id, message.sender_id, message.receiver_id, message.content, message.timestamp)
+
+
+def unpack(row):
+    message_id, sender_id, receiver_id, content, timestamp = row
+    return Message(id=message_id, sender_id=sender_id, receiver_id=receiver_id, content=content, timestamp=timestamp)
+
+
+def newest_page(queryset, user_id, other_id, limit=None):
+    """
+    The newest page of the conversation between two users, in the form
+    paginate_messages() returns it, archived messages included. queryset
+    holds the conversation's messages and is only queried if the cache
+    cannot answer.
+    """
+    limit = page_size(limit)
+    size = cache_size()
+    conversation_key = Message.key_for(user_id, other_id)
+    if limit > size:
+        return archive.paginate(queryset, conversation_key, limit=limit)
+
+    entry_key, generation_key = cache_keys(user_id, other_id)
+    found = cache.get_many([entry_key, generation_key])
+    generation = found.get(generation_key)
+    if generation is None:
+        # add() so concurrent readers agree on the starting value
+        cache.add(generation_key, fresh_version(), timeout=cache_timeout())
+        generation = cache.get(generation_key)
+    entry = found.get(entry_key)
+
+    if entry is None or entry['generation'] != generation:
+        # The generation was read first, so a message saved while we load
+        # makes this entry outdated rather than wrong
+        page = archive.paginate(queryset, conversation_key, limit=size)
+        entry = {
+            'generation': generation,
+            'messages': [pack(message) for message in page['messages']],
+            'has_more': page['has_more'],
+        }
+        cache.set(entry_key, entry, timeout=cache_timeout())
+        cache.touch(generation_key, cache_timeout())
+
+    rows = entry['messages']
+    has_more = entry['has_more'] or len(rows) > limit
+    messages = [unpack(row) for row in rows[-limit:]]
+    return {
+        'messages': messages,
+        'before': encode_cursor(messages[0]) if messages and has_more else None,
+        'after': encode_cursor(messages[-1]) if messages else None,
+        'has_more': has_more,
+    }
+
+
+def append(message):
+    """
+    Adds a committed message to its conversation's entry, or drops the
+    entry if it is not the one the previous message was added to.
+    """
+    entry_key, generation_key = cache_keys(message.sender_id, message.receiver_id)
+    try:
+        generation = cache.incr(generation_key)
+    except ValueError:
+        # No counter, so no entry can be current; the next read refills
+        return
+    entry = cache.get(entry_key)
+    if entry is None:
+        return
+    if entry['generation'] != generation - 1:
+        cache.delete(entry_key)
+        return
+    rows = sorted(entry['messages'] + [pack(message)], key=lambda row: (row[4], row[0]))
+    size = cache_size()
+    cache.set(entry_key, {
+        'generation': generation,
+        'messages': rows[-size:],
+        'has_more': entry['has_more'] or len(rows) > size,
+    }, timeout=cache_timeout())
+
+
+def invalidate(user_id, other_id):
+    """
+    Makes the conversation's entry outdated, e.g. after a message was deleted.
+    """
+    entry_key, generation_key = cache_keys(user_id, other_id)
+    try:
+        cache.incr(generation_key)
+    except ValueError:
+        pass
+    cache.delete(entry_key)
@@ -0,0 +1,36 @@
+"""
+Moves old messages into the compressed archive.
+
+Every month that ended more than --months months ago is archived, oldest
+first, and on PostgreSQL its partition is dropped:
+
+    python manage.py archive_messages --months 12
+
+History pages keep reading archived messages (see connect.archive).
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from connect import archive, partitions
+
+
+class Command(BaseCommand):
+    help = 'Moves messages older than the given number of months into the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=getattr(settings, 'MESSAGE_ARCHIVE_AFTER_MONTHS', 12),
+            help='Months of messages to keep in the message table, besides the current one'
+        )
+
+    def handle(self, *args, **options):
+        if options['months'] < 1:
+            raise CommandError('--months must be at least 1')
+        cutoff = partitions.add_months(partitions.month_start(timezone.now()), -options['months'])
+        archived = archive.archive_before(cutoff)
+        for month, count in archived.items():
+            self.stdout.write(f"Archived {count} messages of {month:%Y-%m}")
+        if not archived:
+            self.stdout.write(f"No messages before {cutoff:%Y-%m} to archive")
@@ -0,0 +1,343 @@
+"""
+Load test for the chat socket.
+
+Simulates --users authenticated users that each send a mix of chat_message,
+typing_status and read_messages frames to random other users, and reports
+throughput and the end-to-end delivery latency of chat messages.
+
+By default the sockets are opened in-process against ChatConsumer through
+channels.testing.WebsocketCommunicator, using the channel layer picked with
+--layer. With --url they are opened over the network with websocket-client
+against a running server, which then uses its own channel layer.
+
+    python manage.py bench_chat --users 50 --duration 10 --layer memory
+    python manage.py bench_chat --users 50 --layer redis --redis-url redis://localhost:6379
+    python manage.py bench_chat --url ws://localhost:8000/ws/chat/ --wire msgpack
+
+With --url every socket comes from this host, and the server admits only
+as many connect attempts per address as its connect.ip rate limit allows
+(30 a minute by default). For more users than that, raise it on the
+server first, e.g. RATE_LIMITS = {'connect.ip': (1000, 60)}.
+"""
+
+import asyncio
+import math
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from connect1.ratelimit import get_limit
+from connect1.wire import JSONCodec, MessagePackCodec
+
+USERNAME_PREFIX = 'bench_'
+FRAME_TYPES = ('chat_message', 'typing_status', 'read_messages')
+CODECS = {'json': JSONCodec(), 'msgpack': MessagePackCodec()}
+
+
+def parse_mix(value):
+    """
+    Parses "chat_message=80,typing_status=15,read_messages=5" into weights.
+    """
+    weights = dict.fromkeys(FRAME_TYPES, 0)
+    for part in value.split(','):
+        frame_type, _, weight = part.partition('=')
+        if frame_type.strip() not in weights:
+            raise CommandError(f"Unknown frame type in --mix: {frame_type}")
+        try:
+            weights[frame_type.strip()] = float(weight)
+        except ValueError:
+            raise CommandError(f"Invalid weight in --mix: {part}")
+    if not any(weights.values()):
+        raise CommandError("--mix needs at least one positive weight")
+    return [weights[frame_type] for frame_type in FRAME_TYPES]
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not values:
+        return 0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+class Stats:
+    """
+    Counters shared by all simulated clients; safe to update from threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = Counter()
+        self.received = Counter()
+        # chat message text -> time it was sent
+        self.in_flight = {}
+        self.latencies = []
+
+    def frame_sent(self, frame):
+        with self.lock:
+            self.sent[frame['type']] += 1
+            if frame['type'] == 'chat_message':
+                self.in_flight[frame['message']] = time.perf_counter()
+
+    def frame_received(self, frame):
+        received_at = time.perf_counter()
+        with self.lock:
+            self.received[frame.get('type', 'error')] += 1
+            if frame.get('type') == 'chat_message':
+                sent_at = self.in_flight.pop(frame['message'], None)
+                if sent_at is not None:
+                    self.latencies.append(received_at - sent_at)
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks ChatConsumer with simulated users and reports throughput and latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='Number of simulated users')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to send frames for')
+        parser.add_argument('--rate', type=float, default=2, help='Frames per second sent by each user')
+        parser.add_argument(
+            '--mix', default='chat_message=70,typing_status=25,read_messages=5',
+            help='Relative weights of the frame types sent'
+        )
+        parser.add_argument('--wire', choices=sorted(CODECS), default='json', help='Wire format to negotiate')
+        parser.add_argument(
+            '--layer', choices=['configured', 'memory', 'redis'], default='configured',
+            help='Channel layer for in-process runs'
+        )
+        parser.add_argument('--redis-url', default='redis://localhost:6379', help='Redis for --layer redis')
+        parser.add_argument('--url', help='Benchmark a running server at this WebSocket URL instead')
+        parser.add_argument('--drain', type=float, default=2, help='Seconds to wait for in-flight messages')
+        parser.add_argument('--keep-data', action='store_true', help='Keep the benchmark users and messages')
+        parser.add_argument('--seed', type=int, help='Random seed, for repeatable frame sequences')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2')
+        self.weights = parse_mix(options['mix'])
+        self.codec = CODECS[options['wire']]
+        self.random = random.Random(options['seed'])
+        self.stats = Stats()
+        users = self.create_users(options['users'])
+
+        try:
+            if options['url']:
+                layer = 'server'
+                started = time.perf_counter()
+                self.run_sockets(users, options)
+            else:
+                with override_settings(CHANNEL_LAYERS=self.channel_layers(options)):
+                    from channels.layers import get_channel_layer
+                    layer = type(get_channel_layer()).__name__
+                    started = time.perf_counter()
+                    asyncio.run(self.run_in_process(users, options))
+            elapsed = time.perf_counter() - started
+        finally:
+            if not options['keep_data']:
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        self.report(options, layer, elapsed)
+
+    def create_users(self, count):
+        users = []
+        for i in range(count):
+            user, created = User.objects.get_or_create(username=f"{USERNAME_PREFIX}{i}")
+            if created:
+                user.set_unusable_password()
+                user.save(update_fields=['password'])
+            users.append(user)
+        return users
+
+    def channel_layers(self, options):
+        if options['layer'] == 'memory':
+            return {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        if options['layer'] == 'redis':
+            return {
+                'default': {
+                    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                    'CONFIG': {'hosts': [options['redis_url']]},
+                }
+            }
+        return settings.CHANNEL_LAYERS
+
+    def next_frame(self, user, users):
+        frame_type = self.random.choices(FRAME_TYPES, self.weights)[0]
+        peer = self.random.choice([other for other in users if other.id != user.id])
+        if frame_type == 'chat_message':
+            # The text doubles as the key for measuring delivery latency
+            return {'type': 'chat_message', 'message': uuid.uuid4().hex, 'receiver_id': peer.id}
+        if frame_type == 'typing_status':
+            return {'type': 'typing_status', 'receiver_id': peer.id, 'is_typing': self.random.random() < 0.8}
+        return {'type': 'read_messages', 'sender_id': peer.id}
+
+    async def run_in_process(self, users, options):
+        from channels.testing import WebsocketCommunicator
+        from connect1.consumers import ChatConsumer
+
+        application = ChatConsumer.as_asgi()
+        communicators = []
+        for user in users:
+            communicator = WebsocketCommunicator(application, '/ws/chat/', subprotocols=[self.codec.subprotocol])
+            communicator.scope['user'] = user
+            connected, code = await communicator.connect()
+            if not connected:
+                raise CommandError(f"Connection of {user.username} was rejected ({code})")
+            communicators.append(communicator)
+
+        stopping = asyncio.Event()
+
+        async def receive(communicator):
+            # Read the queue directly; receive_output() kills the consumer on timeout
+            while not stopping.is_set():
+                try:
+                    output = await asyncio.wait_for(communicator.output_queue.get(), 0.1)
+                except asyncio.TimeoutError:
+                    continue
+                if output['type'] != 'websocket.send':
+                    return
+                self.stats.frame_received(self.codec.decode(output.get('text'), output.get('bytes')))
+
+        async def send(communicator, user, deadline):
+            while True:
+                await asyncio.sleep(self.random.expovariate(options['rate']))
+                if time.perf_counter() >= deadline:
+                    return
+                frame = self.next_frame(user, users)
+                self.stats.frame_sent(frame)
+                await communicator.send_input({'type': 'websocket.receive', **self.wire_input(frame)})
+
+        deadline = time.perf_counter() + options['duration']
+        receivers = asyncio.gather(*(receive(communicator) for communicator in communicators))
+        await asyncio.gather(*(
+            send(communicator, user, deadline) for communicator, user in zip(communicators, users)
+        ))
+        await asyncio.sleep(options['drain'])
+
+        stopping.set()
+        await receivers
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    def wire_input(self, frame):
+        """
+        The frame as the "text"/"bytes" keys of an ASGI websocket message.
+        """
+        encoded = self.codec.encode(frame)
+        if 'bytes_data' in encoded:
+            return {'bytes': encoded['bytes_data']}
+        return {'text': encoded['text_data']}
+
+    def run_sockets(self, users, options):
+        try:
+            import websocket
+        except ImportError:
+            raise CommandError('--url needs the websocket-client package')
+
+        limit = get_limit('connect.ip')
+        if limit is not None and len(users) > limit[0]:
+            self.stdout.write(self.style.WARNING(
+                f"A server with these settings admits {limit[0]} sockets per {limit[1]}s from one "
+                f"address; raise RATE_LIMITS['connect.ip'] on the server for {len(users)} users."
+            ))
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        sockets = []
+        for user in users:
+            # Log each user in by creating a session for them directly
+            session = session_store()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            try:
+                sockets.append(websocket.create_connection(
+                    options['url'],
+                    cookie=f"{settings.SESSION_COOKIE_NAME}={session.session_key}",
+                    subprotocols=[self.codec.subprotocol],
+                ))
+            except websocket.WebSocketBadStatusException as e:
+                # Most likely the connect.ip or connect.user rate limit
+                for ws in sockets:
+                    ws.close()
+                raise CommandError(f"Connection of {user.username} was rejected ({e.status_code})")
+
+        def receive(ws):
+            while True:
+                try:
+                    opcode, payload = ws.recv_data()
+                except Exception:
+                    return
+                if opcode == websocket.ABNF.OPCODE_TEXT:
+                    self.stats.frame_received(self.codec.decode(text_data=payload.decode()))
+                elif opcode == websocket.ABNF.OPCODE_BINARY:
+                    self.stats.frame_received(self.codec.decode(bytes_data=payload))
+                elif opcode == websocket.ABNF.OPCODE_CLOSE:
+                    return
+
+        def send(ws, user, deadline):
+            while True:
+                time.sleep(self.random.expovariate(options['rate']))
+                if time.perf_counter() >= deadline:
+                    return
+                frame = self.next_frame(user, users)
+                self.stats.frame_sent(frame)
+                encoded = self.codec.encode(frame)
+                if 'bytes_data' in encoded:
+                    ws.send_binary(encoded['bytes_data'])
+                else:
+                    ws.send(encoded['text_data'])
+
+        deadline = time.perf_counter() + options['duration']
+        receivers = [threading.Thread(target=receive, args=(ws,), daemon=True) for ws in sockets]
+        senders = [
+            threading.Thread(target=send, args=(ws, user, deadline), daemon=True)
+            for ws, user in zip(sockets, users)
+        ]
+        for thread in receivers + senders:
+            thread.start()
+        for thread in senders:
+            thread.join()
+        time.sleep(options['drain'])
+
+        for ws in sockets:
+            ws.close()
+        for thread in receivers:
+            thread.join(timeout=1)
+
+    def report(self, options, layer, elapsed):
+        stats = self.stats
+        sent = sum(stats.sent.values())
+        received = sum(stats.received.values())
+        latencies = sorted(latency * 1000 for latency in stats.latencies)
+        transport = options['url'] or 'in-process'
+
+        self.stdout.write(f"Transport: {transport}, channel layer: {layer}, wire: {options['wire']}")
+        self.stdout.write(f"Users: {options['users']}, sending for {options['duration']}s ({elapsed:.1f}s with connect and drain)")
+        self.stdout.write(
+            f"Frames sent: {sent} ({sent / options['duration']:.1f}/s) "
+            + ', '.join(f"{frame_type} {stats.sent[frame_type]}" for frame_type in FRAME_TYPES)
+        )
+        self.stdout.write(
+            f"Frames received: {received} ({received / options['duration']:.1f}/s) "
+            + ', '.join(f"{frame_type} {count}" for frame_type, count in sorted(stats.received.items()))
+        )
+        self.stdout.write(
+            f"Chat messages delivered: {len(latencies)}/{stats.sent['chat_message']} "
+            f"({len(latencies) / options['duration']:.1f}/s)"
+        )
+        self.stdout.write(
+            f"Delivery latency (ms): p50 {percentile(latencies, 50):.2f}  "
+            f"p95 {percentile(latencies, 95):.2f}  p99 {percentile(latencies, 99):.2f}  "
+            f"max {latencies[-1] if latencies else 0:.2f}"
+        )
+        if stats.received['error']:
+            self.stdout.write(self.style.WARNING(f"Error frames received: {stats.received['error']}"))
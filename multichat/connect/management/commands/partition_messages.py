@@ -0,0 +1,41 @@
+"""
+Creates the monthly partitions of the message table ahead of time.
+
+Run daily or at least monthly, e.g. from cron, on PostgreSQL:
+
+    python manage.py partition_messages --ahead 3
+
+Messages of a month without a partition land in the default partition;
+creating the month's partition later moves them into it.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from connect import partitions
+
+
+class Command(BaseCommand):
+    help = 'Creates the monthly partitions of the message table for the coming months'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ahead', type=int, default=getattr(settings, 'MESSAGE_PARTITIONS_AHEAD', 3),
+            help='Months to create past the current one'
+        )
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned(connection):
+            self.stdout.write('The message table is only partitioned on PostgreSQL; nothing to do')
+            return
+        existing = set(partitions.partitions(connection))
+        current = partitions.month_start(timezone.now())
+        for count in range(options['ahead'] + 1):
+            month = partitions.add_months(current, count)
+            if month in existing:
+                continue
+            with transaction.atomic():
+                partitions.create_partition(connection, month)
+            self.stdout.write(f"Created {partitions.partition_name(month)}")
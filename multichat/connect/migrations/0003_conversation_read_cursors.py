@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:49
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def backfill_read_cursors(apps, schema_editor):
+    """
+    Turn the per-message is_read flags into one read cursor per side: just
+    before the side's oldest unread message, or the last message if none.
+    """
+    Message = apps.get_model('connect', 'Message')
+    Conversation = apps.get_model('connect', 'Conversation')
+
+    first_unread = {
+        (row['receiver_id'], row['sender_id']): row['first_id']
+        for row in Message.objects.filter(is_read=False).values('sender_id', 'receiver_id').annotate(
+            first_id=Min('id')
+        )
+    }
+    conversations = []
+    for conversation in Conversation.objects.iterator():
+        low, high = conversation.user_low_id, conversation.user_high_id
+        last_id = conversation.last_message_id or 0
+        conversation.last_read_low = first_unread.get((low, high), last_id + 1) - 1
+        conversation.last_read_high = first_unread.get((high, low), last_id + 1) - 1
+        conversations.append(conversation)
+    Conversation.objects.bulk_update(conversations, ['last_read_low', 'last_read_high'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connect', '0002_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_read_high',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_read_low',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_cursors, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
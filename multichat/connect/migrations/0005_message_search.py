@@ -0,0 +1,73 @@
+from django.db import migrations
+
+POSTGRESQL = [
+    # Generated, so it is filled in by every INSERT and UPDATE without
+    # Django knowing about the column
+    """
+    ALTER TABLE connect_message ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED
+    """,
+    'CREATE INDEX connect_message_search ON connect_message USING gin (search_vector)',
+]
+
+POSTGRESQL_REVERSE = [
+    'DROP INDEX connect_message_search',
+    'ALTER TABLE connect_message DROP COLUMN search_vector',
+]
+
+SQLITE = [
+    """
+    CREATE VIRTUAL TABLE connect_message_fts USING fts5(
+        content, content='connect_message', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER connect_message_fts_insert AFTER INSERT ON connect_message BEGIN
+        INSERT INTO connect_message_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER connect_message_fts_delete AFTER DELETE ON connect_message BEGIN
+        INSERT INTO connect_message_fts (connect_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER connect_message_fts_update AFTER UPDATE OF content ON connect_message BEGIN
+        INSERT INTO connect_message_fts (connect_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO connect_message_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # Index the messages that already exist
+    "INSERT INTO connect_message_fts (connect_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    'DROP TRIGGER connect_message_fts_update',
+    'DROP TRIGGER connect_message_fts_delete',
+    'DROP TRIGGER connect_message_fts_insert',
+    'DROP TABLE connect_message_fts',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connect', '0004_room'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRESQL, 'sqlite': SQLITE}),
+            run({'postgresql': POSTGRESQL_REVERSE, 'sqlite': SQLITE_REVERSE}),
+        ),
+    ]
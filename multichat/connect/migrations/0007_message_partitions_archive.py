@@ -0,0 +1,150 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:12
+
+from datetime import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+# Months created past the current one; partition_messages keeps this up
+PARTITIONS_AHEAD = 3
+
+COLUMNS = """
+    content text NOT NULL,
+    timestamp timestamp with time zone NOT NULL,
+    receiver_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED,
+    sender_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED,
+    search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED,
+    conversation_key bigint GENERATED ALWAYS AS (
+        LEAST(sender_id, receiver_id) * 4294967296 + GREATEST(sender_id, receiver_id)
+    ) STORED
+"""
+
+STORED = 'id, content, timestamp, receiver_id, sender_id'
+
+INDEXES = [
+    'CREATE INDEX message_history ON connect_message (conversation_key, timestamp, id)',
+    'CREATE INDEX message_timestamp ON connect_message (timestamp)',
+    'CREATE INDEX connect_message_search ON connect_message USING gin (search_vector)',
+    'CREATE INDEX connect_message_sender_id ON connect_message (sender_id)',
+    'CREATE INDEX connect_message_receiver_id ON connect_message (receiver_id)',
+]
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition(apps, schema_editor):
+    """
+    Rebuild connect_message on PostgreSQL as a table partitioned by month,
+    with a partition for every month that has messages and the months
+    ahead, and a default partition for anything else.
+
+    This copies every message and rebuilds the indexes in one transaction,
+    holding an ACCESS EXCLUSIVE lock on connect_message throughout: chat
+    cannot read or write messages until the migration commits. On
+    PostgreSQL 16 a table of one million messages took about 30 seconds;
+    the time grows with the table. Plan for that much downtime, or run the
+    migration while the chat is stopped. The reverse migration copies the
+    table back the same way.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        # Held until the migration commits: writes wait from here on, so none
+        # are written to the old table after it was copied
+        cursor.execute('LOCK TABLE connect_message IN EXCLUSIVE MODE')
+        cursor.execute("SELECT DISTINCT date_trunc('month', timestamp AT TIME ZONE 'UTC') FROM connect_message")
+        months = {row[0] for row in cursor.fetchall()}
+        cursor.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM connect_message')
+        next_id = cursor.fetchone()[0]
+    current = timezone.now().replace(tzinfo=None, day=1, hour=0, minute=0, second=0, microsecond=0)
+    months.update(add_months(current, count) for count in range(PARTITIONS_AHEAD + 1))
+
+    execute = schema_editor.execute
+    execute(f'CREATE SEQUENCE connect_message_partitioned_id_seq START WITH {next_id}')
+    # The primary key of a partitioned table has to include the partition key
+    execute(f"""
+        CREATE TABLE connect_message_partitioned (
+            id bigint NOT NULL DEFAULT nextval('connect_message_partitioned_id_seq'),
+            {COLUMNS},
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    execute('ALTER SEQUENCE connect_message_partitioned_id_seq OWNED BY connect_message_partitioned.id')
+    execute('CREATE TABLE connect_message_default PARTITION OF connect_message_partitioned DEFAULT')
+    for month in sorted(months):
+        execute(
+            f"CREATE TABLE connect_message_p{month:%Y_%m} PARTITION OF connect_message_partitioned "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d} 00:00:00+00') TO ('{add_months(month, 1):%Y-%m-%d} 00:00:00+00')"
+        )
+    execute(f'INSERT INTO connect_message_partitioned ({STORED}) SELECT {STORED} FROM connect_message')
+    # Run the deferred foreign key checks of the copied rows now, as tables
+    # with pending checks cannot be altered or indexed
+    execute('SET CONSTRAINTS ALL IMMEDIATE')
+    execute('DROP TABLE connect_message')
+    execute('ALTER TABLE connect_message_partitioned RENAME TO connect_message')
+    execute('ALTER SEQUENCE connect_message_partitioned_id_seq RENAME TO connect_message_id_seq')
+    execute('ALTER TABLE connect_message RENAME CONSTRAINT connect_message_partitioned_pkey TO connect_message_pkey')
+    for statement in INDEXES:
+        execute(statement)
+
+
+def unpartition(apps, schema_editor):
+    """
+    Rebuild connect_message on PostgreSQL as one plain table.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    execute = schema_editor.execute
+    execute('LOCK TABLE connect_message IN EXCLUSIVE MODE')
+    execute(f"""
+        CREATE TABLE connect_message_plain (
+            id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            {COLUMNS}
+        )
+    """)
+    execute(f'INSERT INTO connect_message_plain ({STORED}) SELECT {STORED} FROM connect_message')
+    execute('SET CONSTRAINTS ALL IMMEDIATE')
+    execute(
+        "SELECT setval(pg_get_serial_sequence('connect_message_plain', 'id'), "
+        "(SELECT COALESCE(MAX(id), 0) + 1 FROM connect_message_plain), false)"
+    )
+    execute('DROP TABLE connect_message')
+    execute('ALTER TABLE connect_message_plain RENAME TO connect_message')
+    execute('ALTER SEQUENCE connect_message_plain_id_seq RENAME TO connect_message_id_seq')
+    execute('ALTER TABLE connect_message RENAME CONSTRAINT connect_message_plain_pkey TO connect_message_pkey')
+    for statement in INDEXES:
+        execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connect', '0006_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='connect.message'),
+        ),
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation_key', models.BigIntegerField()),
+                ('first_at', models.DateTimeField()),
+                ('last_at', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation_key', 'first_at'], name='archive_history'), models.Index(fields=['last_at'], name='archive_last_at')],
+            },
+        ),
+        migrations.RunPython(partition, unpartition),
+    ]
@@ -0,0 +1,86 @@
+"""
+Keyset (cursor) pagination for message history.
+
+Pages are cut on (timestamp, id) instead of OFFSET, so fetching any page
+costs one index range scan no matter how long the conversation is.
+"""
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(message):
+    """
+    Turn a message into an opaque cursor: "<microseconds since epoch>-<id>".
+    """
+    micros = (message.timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{message.id}"
+
+
+def decode_cursor(cursor):
+    """
+    Parse a cursor back into (timestamp, id). Raises ValueError if malformed.
+    """
+    micros, _, message_id = cursor.partition('-')
+    return EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+
+
+def page_size(limit):
+    """
+    Requested page size, falling back to the default and capped at the maximum.
+    """
+    default = getattr(settings, 'MESSAGE_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'MESSAGE_PAGE_SIZE_MAX', 200)
+    try:
+        limit = int(limit) if limit else default
+    except ValueError:
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+def paginate_messages(queryset, before=None, after=None, limit=None):
+    """
+    Return one page of messages from queryset in chronological order.
+
+    Without a cursor this is the newest page. With before/after it is the
+    page immediately older/newer than that cursor. The result also carries
+    the cursors to continue in either direction; "before" is None once the
+    start of the conversation has been reached.
+    """
+    limit = page_size(limit)
+
+    if after:
+        timestamp, message_id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+        ).order_by('timestamp', 'id')
+        messages = list(queryset[:limit + 1])
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        if before:
+            timestamp, message_id = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+            )
+        queryset = queryset.order_by('-timestamp', '-id')
+        messages = list(queryset[:limit + 1])
+        has_more = len(messages) > limit
+        messages = messages[:limit][::-1]
+
+    if messages:
+        older = encode_cursor(messages[0]) if has_more or after else None
+        newer = encode_cursor(messages[-1])
+    else:
+        older = None
+        newer = after
+    return {
+        'messages': messages,
+        'before': older,
+        'after': newer,
+        'has_more': has_more,
+    }
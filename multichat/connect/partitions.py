@@ -0,0 +1,115 @@
+"""
+Monthly range partitions of the message table on PostgreSQL.
+
+Migration 0007 turns connect_message into a table partitioned by the month
+of its timestamp, plus a default partition for rows outside every month
+created so far. The partition_messages command creates the coming months
+before messages arrive for them, and archive_messages drops months once
+they are archived, so the hot table and its indexes only hold recent
+months. Other databases keep one plain table.
+
+Creating, detaching and dropping a partition lock the whole message table
+(ACCESS EXCLUSIVE) until the transaction commits. With the months created
+ahead of time this takes milliseconds. If messages of a month are already
+in the default partition, create_partition moves them while holding the
+lock, so run partition_messages often enough that the default partition
+stays empty.
+"""
+
+from datetime import datetime, timezone as dt_timezone
+
+TABLE = 'connect_message'
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_PREFIX = f"{TABLE}_p"
+# Columns that are stored rather than generated
+COLUMNS = 'id, content, timestamp, receiver_id, sender_id'
+
+
+def month_start(moment):
+    """
+    Start of the (UTC) month of a datetime.
+    """
+    moment = moment.astimezone(dt_timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month:%Y_%m}"
+
+
+def bounds(month):
+    """
+    FOR VALUES clause of the partition of a month.
+    """
+    return f"FOR VALUES FROM ('{month:%Y-%m-%d} 00:00:00+00') TO ('{add_months(month, 1):%Y-%m-%d} 00:00:00+00')"
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [TABLE])
+        return cursor.fetchone() is not None
+
+
+def partitions(connection):
+    """
+    Months that have a partition, oldest first.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = inhrelid '
+            'WHERE inhparent = %s::regclass',
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall() if row[0] != DEFAULT_PARTITION]
+    return sorted(
+        datetime.strptime(name[len(PARTITION_PREFIX):], '%Y_%m').replace(tzinfo=dt_timezone.utc)
+        for name in names
+    )
+
+
+def create_partition(connection, month):
+    """
+    Creates the partition of a month, moving into it any rows of the month
+    that went to the default partition. Run inside a transaction.
+    """
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE timestamp >= %s AND timestamp < %s)",
+            [start, end],
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} {bounds(month)}")
+            return
+        # The default partition may not hold rows that belong to another
+        # partition, so it is taken out while they are moved
+        cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} {bounds(month)}")
+        cursor.execute(
+            f"INSERT INTO {TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {DEFAULT_PARTITION} "
+            f"WHERE timestamp >= %s AND timestamp < %s",
+            [start, end],
+        )
+        cursor.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= %s AND timestamp < %s", [start, end])
+        cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+
+
+def drop_partition(connection, month):
+    """
+    Drops the partition of a month with all its rows.
+    """
+    name = partition_name(month)
+    with connection.cursor() as cursor:
+        # A table with deferred foreign key checks still to run cannot be
+        # dropped, e.g. when rows were written earlier in this transaction
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+        cursor.execute(f"DROP TABLE {name}")
@@ -1,7 +1,7 @@
 from django.urls import re_path
-from . import consumers
+from connect1 import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/somepath/$', consumers.YourConsumer.as_asgi()),
+    re_path(r'ws/chat/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/rooms/$', consumers.RoomConsumer.as_asgi()),
 ]
-
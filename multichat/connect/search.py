@@ -0,0 +1,124 @@
+"""
+Full-text search over message content.
+
+The index is kept by the database itself, so messages are searchable as
+soon as they are inserted, bulk inserts included (see migration
+0005_message_search):
+
+- On PostgreSQL, connect_message has a generated tsvector column,
+  search_vector, with a GIN index.
+- On SQLite, connect_message_fts is an FTS5 table over the content,
+  kept in step by triggers. SQLite migrations rebuild connect_message for
+  most column changes, which drops the triggers, so ensure_triggers()
+  puts them back after every migrate.
+
+Other databases fall back to a substring match per term, which scans.
+
+A query matches messages that contain every word of it, in any order.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+
+from .pagination import paginate_messages
+
+# Must match the configuration the search_vector column was generated with
+SEARCH_CONFIG = 'simple'
+# Longer queries are cut to this many words
+MAX_TERMS = 8
+
+SQLITE_TRIGGERS = {
+    'connect_message_fts_insert': """
+        CREATE TRIGGER connect_message_fts_insert AFTER INSERT ON connect_message BEGIN
+            INSERT INTO connect_message_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+    'connect_message_fts_delete': """
+        CREATE TRIGGER connect_message_fts_delete AFTER DELETE ON connect_message BEGIN
+            INSERT INTO connect_message_fts (connect_message_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+        END
+    """,
+    'connect_message_fts_update': """
+        CREATE TRIGGER connect_message_fts_update AFTER UPDATE OF content ON connect_message BEGIN
+            INSERT INTO connect_message_fts (connect_message_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+            INSERT INTO connect_message_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+}
+
+
+def ensure_triggers(connection):
+    """
+    Recreates the SQLite triggers that keep connect_message_fts in step, if
+    they were dropped, and reindexes the messages.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        existing = {(kind, name) for kind, name in cursor.fetchall()}
+        if ('table', 'connect_message_fts') not in existing:
+            # Migrated back to before the index existed
+            return
+        missing = [name for name in SQLITE_TRIGGERS if ('trigger', name) not in existing]
+        for name in missing:
+            cursor.execute(SQLITE_TRIGGERS[name])
+        if missing:
+            # Messages changed while the triggers were gone are not indexed
+            cursor.execute("INSERT INTO connect_message_fts (connect_message_fts) VALUES ('rebuild')")
+
+
+def terms(query):
+    """
+    The words of a search query, lowercased and without duplicates.
+    """
+    words = re.findall(r'\w+', query.lower())
+    return list(dict.fromkeys(words))[:MAX_TERMS]
+
+
+def match(query):
+    """
+    Returns a Q object matching the messages that contain every word of the
+    query, or None if the query has no words.
+    """
+    words = terms(query)
+    if not words:
+        return None
+    if connection.vendor == 'postgresql':
+        # A condition on the row itself rather than an id IN (...) over the
+        # whole table, so the planner can combine the GIN index with the
+        # other filters, e.g. the conversation_key index
+        return Q(RawSQL(
+            'search_vector @@ plainto_tsquery(%s::regconfig, %s)',
+            [SEARCH_CONFIG, ' '.join(words)],
+            output_field=BooleanField(),
+        ))
+    if connection.vendor == 'sqlite':
+        # Quoted, so words are never read as FTS5 operators
+        return Q(id__in=RawSQL(
+            'SELECT rowid FROM connect_message_fts WHERE connect_message_fts MATCH %s',
+            [' '.join(f'"{word}"' for word in words)],
+        ))
+    condition = Q()
+    for word in words:
+        condition &= Q(content__icontains=word)
+    return condition
+
+
+def search_messages(queryset, query, before=None, limit=None):
+    """
+    One page of the messages in queryset that match the query, newest first,
+    in the form paginate_messages() returns. Pass the "before" cursor from
+    a page to get the next, older one.
+    """
+    condition = match(query)
+    if condition is None:
+        return {'messages': [], 'before': None, 'after': None, 'has_more': False}
+    page = paginate_messages(queryset.filter(condition), before=before, limit=limit)
+    page['messages'].reverse()
+    return page
@@ -0,0 +1,64 @@
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+from connect1.identity import identities
+from connect1.rooms import rooms
+from . import history, search
+from .models import Message, Room
+from .versions import bump_roster
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Invalidate everyone's user list and the user's cached identity when a
+    user joins or is renamed.
+    """
+    # Logins only touch last_login, which the list does not show
+    if created or update_fields is None or 'username' in update_fields:
+        bump_roster()
+        # After commit, so nobody caches the old row again in the meantime
+        user_id = instance.id
+        transaction.on_commit(lambda: identities.invalidate(user_id))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    """
+    Invalidate everyone's user list and the user's cached identity when a
+    user is removed.
+    """
+    bump_roster()
+    # The instance loses its id once deleted
+    user_id = instance.id
+    transaction.on_commit(lambda: identities.invalidate(user_id))
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def room_changed(sender, instance, **kwargs):
+    """
+    Drop the cached settings of a room that was edited or removed.
+    """
+    room_id = instance.id
+    transaction.on_commit(lambda: rooms.invalidate(room_id))
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    """
+    Drop the cached recent history of the message's conversation.
+    """
+    sender_id, receiver_id = instance.sender_id, instance.receiver_id
+    transaction.on_commit(lambda: history.invalidate(sender_id, receiver_id))
+
+
+@receiver(post_migrate)
+def connect_migrated(sender, using, **kwargs):
+    """
+    Put back the SQLite search triggers if a migration rebuilt the message
+    table.
+    """
+    if sender.label == 'connect':
+        search.ensure_triggers(connections[using])
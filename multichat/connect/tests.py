@@ -1,8 +1,330 @@
-from django.test import TestCase
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from channels.testing import WebsocketCommunicator
 
+from . import archive
+from .management.commands.bench_chat import parse_mix, percentile
+from .models import Conversation, Message, MessageArchive, UserProfile
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 async def test_consumer():
     communicator = WebsocketCommunicator(consumer, "/ws/chat/")
     connected, _ = await communicator.connect()
     assert connected
-    await communicator.disconnect()
\ No newline at end of file
+    await communicator.disconnect()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ConversationTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+
+    def send(self, sender, receiver, content):
+        message = Message.objects.create(sender=sender, receiver=receiver, content=content)
+        Conversation.record_message(message)
+        return message
+
+    def test_one_row_per_pair_with_unread_per_side(self):
+        self.send(self.alice, self.bob, 'hi')
+        self.send(self.alice, self.bob, 'are you there?')
+        last = self.send(self.bob, self.alice, 'yes')
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_message, last)
+        self.assertEqual(conversation.last_message_preview, 'yes')
+        self.assertEqual(conversation.unread_count_for(self.bob), 2)
+        self.assertEqual(conversation.unread_count_for(self.alice), 1)
+
+        self.assertEqual(Conversation.mark_read(self.bob.id, self.alice.id), last.id)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.unread_count_for(self.bob), 0)
+        self.assertEqual(conversation.unread_count_for(self.alice), 1)
+
+    def test_late_older_message_does_not_replace_last(self):
+        newest = self.send(self.alice, self.bob, 'second')
+        older = Message.objects.create(sender=self.bob, receiver=self.alice, content='first')
+        older.timestamp = newest.timestamp - timedelta(seconds=1)
+        Conversation.record_message(older)
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_message, newest)
+        self.assertEqual(conversation.unread_count_for(self.alice), 1)
+
+    def test_counters_are_returned_and_summed(self):
+        carol = User.objects.create_user('carol', password='secret')
+        message = Message.objects.create(sender=self.alice, receiver=self.bob, content='1')
+        self.assertEqual(Conversation.record_message(message), 1)
+        message = Message.objects.create(sender=self.alice, receiver=self.bob, content='2')
+        self.assertEqual(Conversation.record_message(message), 2)
+        self.send(carol, self.bob, 'hi')
+
+        self.assertEqual(Conversation.unread_total(self.bob.id), 3)
+        profile = UserProfile.objects.create(user=self.bob)
+        self.assertEqual(profile.unread_message_count, 3)
+        self.assertEqual(Conversation.mark_read(self.bob.id, self.alice.id), message.id)
+        self.assertIsNone(Conversation.mark_read(self.bob.id, self.alice.id))
+        self.assertEqual(Conversation.unread_total(self.bob.id), 1)
+
+    def test_batch_is_one_update_per_conversation(self):
+        carol = User.objects.create_user('carol', password='secret')
+        self.send(self.alice, self.bob, 'hi')
+        self.send(carol, self.bob, 'hi')
+        batch = Message.objects.bulk_create([
+            Message(sender=self.alice, receiver=self.bob, content='1'),
+            Message(sender=self.bob, receiver=self.alice, content='2'),
+            Message(sender=carol, receiver=self.bob, content='3'),
+            Message(sender=self.alice, receiver=self.bob, content='4'),
+        ])
+
+        with self.assertNumQueries(3):
+            self.assertEqual(Conversation.record_messages(batch), [2, 1, 2, 3])
+        conversation = Conversation.between(self.alice.id, self.bob.id).get()
+        self.assertEqual(conversation.last_message, batch[3])
+        self.assertEqual(conversation.unread_count_for(self.bob), 3)
+
+    def test_read_receipt_is_one_row_whatever_the_backlog(self):
+        for i in range(20):
+            last = self.send(self.alice, self.bob, str(i))
+
+        with self.assertNumQueries(2):
+            self.assertEqual(Conversation.mark_read(self.bob.id, self.alice.id), last.id)
+
+        self.client.force_login(self.alice)
+        page = self.client.get(f'/get_messages/{self.bob.id}/', secure=True).json()
+        self.assertEqual(page['last_read_message_id'], last.id)
+        self.assertTrue(all(message['is_read'] for message in page['messages']))
+
+    def test_index_lists_conversations_in_one_query(self):
+        carol = User.objects.create_user('carol', password='secret')
+        self.send(self.alice, self.bob, 'hi bob')
+        self.send(carol, self.alice, 'hi alice')
+
+        with self.assertNumQueries(1):
+            inbox = list(Conversation.for_user(self.alice).select_related('user_low__profile', 'user_high__profile'))
+        self.assertEqual([c.last_message_preview for c in inbox], ['hi alice', 'hi bob'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MessageHistoryPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.messages = [
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=str(i))
+            for i in range(5)
+        ]
+        self.client.force_login(self.alice)
+
+    def get_page(self, **params):
+        response = self.client.get(f'/get_messages/{self.bob.id}/', params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_walks_history_backwards_with_before_cursor(self):
+        page = self.get_page(limit=2)
+        self.assertEqual([m['content'] for m in page['messages']], ['3', '4'])
+
+        page = self.get_page(limit=2, before=page['before'])
+        self.assertEqual([m['content'] for m in page['messages']], ['1', '2'])
+
+        page = self.get_page(limit=2, before=page['before'])
+        self.assertEqual([m['content'] for m in page['messages']], ['0'])
+        self.assertIsNone(page['before'])
+
+    def test_after_cursor_returns_only_newer_messages(self):
+        page = self.get_page(limit=2)
+        newer = Message.objects.create(sender=self.bob, receiver=self.alice, content='new')
+
+        page = self.get_page(after=page['after'])
+        self.assertEqual([m['id'] for m in page['messages']], [newer.id])
+
+    def test_newest_page_is_served_from_the_history_cache(self):
+        self.get_page(limit=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            newer = Message.objects.create(sender=self.bob, receiver=self.alice, content='new')
+            Conversation.record_message(newer)
+
+        with CaptureQueriesContext(connection) as queries:
+            page = self.get_page(limit=2)
+        self.assertFalse([query for query in queries if 'connect_message' in query['sql']])
+        self.assertEqual([m['content'] for m in page['messages']], ['4', 'new'])
+        self.assertTrue(page['has_more'])
+
+        page = self.get_page(limit=2, before=page['before'])
+        self.assertEqual([m['content'] for m in page['messages']], ['2', '3'])
+
+    def test_history_is_one_range_scan_of_the_conversation_index(self):
+        reply = Message.objects.create(sender=self.bob, receiver=self.alice, content='reply')
+        reply.refresh_from_db()
+        self.assertEqual(reply.conversation_key, Message.key_for(self.alice.id, self.bob.id))
+
+        messages = Message.objects.filter(conversation_key=reply.conversation_key)
+        plan = messages.order_by('-timestamp', '-id')[:3].explain()
+        # Partitions of the PostgreSQL table get their own copy of the index
+        self.assertRegex(plan, 'message_history|conversation_key_timestamp_id_idx')
+
+    def test_rejects_malformed_cursor(self):
+        response = self.client.get(f'/get_messages/{self.bob.id}/', {'before': 'nope'}, secure=True)
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, MESSAGE_ARCHIVE_SEGMENT_SIZE=2)
+class MessageArchiveTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        long_ago = timezone.now() - timedelta(days=400)
+        for i in range(6):
+            message = Message.objects.create(sender=self.alice, receiver=self.bob, content=str(i))
+            if i < 4:
+                Message.objects.filter(id=message.id).update(timestamp=long_ago + timedelta(minutes=i))
+        self.client.force_login(self.alice)
+
+    def get_page(self, **params):
+        response = self.client.get(f'/get_messages/{self.bob.id}/', params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_history_pages_cross_into_the_archive(self):
+        archived = archive.archive_before(timezone.now() - timedelta(days=60))
+        self.assertEqual(sum(archived.values()), 4)
+        self.assertEqual(MessageArchive.objects.count(), 2)
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['4', '5'])
+
+        page = self.get_page(limit=3)
+        self.assertEqual([m['content'] for m in page['messages']], ['3', '4', '5'])
+        self.assertTrue(page['has_more'])
+
+        page = self.get_page(limit=3, before=page['before'])
+        self.assertEqual([m['content'] for m in page['messages']], ['0', '1', '2'])
+        self.assertIsNone(page['before'])
+
+        page = self.get_page(limit=2, after=page['after'])
+        self.assertEqual([m['content'] for m in page['messages']], ['3', '4'])
+        page = self.get_page(after=page['after'])
+        self.assertEqual([m['content'] for m in page['messages']], ['5'])
+
+    def test_inbox_keeps_the_preview_of_an_archived_last_message(self):
+        Conversation.record_message(Message.objects.latest('id'))
+        archive.archive_before(timezone.now() + timedelta(days=40))
+        conversation = Conversation.between(self.alice.id, self.bob.id).get()
+        self.assertIsNone(conversation.last_message)
+        self.assertEqual(conversation.last_message_preview, '5')
+        self.assertTrue(conversation.formatted_last_message_at)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MessageSearchTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.carol = User.objects.create_user('carol', password='secret')
+        Message.objects.bulk_create([
+            Message(sender=self.alice, receiver=self.bob, content=f'Lunch at noon? ({i})')
+            for i in range(3)
+        ] + [
+            Message(sender=self.bob, receiver=self.alice, content='No lunch today'),
+            Message(sender=self.bob, receiver=self.carol, content='lunch with carol'),
+        ])
+        self.client.force_login(self.alice)
+
+    def search(self, **params):
+        response = self.client.get('/search_messages/', params, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_finds_own_messages_newest_first_by_page(self):
+        page = self.search(q='LUNCH', limit=2)
+        self.assertEqual([m['content'] for m in page['messages']], ['No lunch today', 'Lunch at noon? (2)'])
+        self.assertEqual(page['messages'][0]['user']['username'], 'bob')
+
+        page = self.search(q='LUNCH', limit=2, before=page['before'])
+        self.assertEqual([m['content'] for m in page['messages']], ['Lunch at noon? (1)', 'Lunch at noon? (0)'])
+        self.assertFalse(page['has_more'])
+
+    def test_every_word_must_match(self):
+        page = self.search(q='lunch today')
+        self.assertEqual([m['content'] for m in page['messages']], ['No lunch today'])
+        self.assertEqual(self.search(q='"?*')['messages'], [])
+
+    def test_index_follows_edits_and_deletes(self):
+        message = Message.objects.get(content='No lunch today')
+        message.content = 'Dinner instead'
+        message.save()
+        self.assertEqual([m['id'] for m in self.search(q='dinner')['messages']], [message.id])
+        message.delete()
+        self.assertEqual(self.search(q='dinner')['messages'], [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UserListTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.carol = User.objects.create_user('carol', password='secret')
+        self.client.force_login(self.alice)
+
+    def get_users(self, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get('/get_users/', secure=True, headers=headers)
+
+    def test_single_query_for_any_number_of_users(self):
+        # Session, user and the list itself
+        with self.assertNumQueries(3):
+            response = self.get_users()
+        users = {user['username']: user for user in response.json()['users']}
+        self.assertEqual(set(users), {'bob', 'carol'})
+        self.assertFalse(users['bob']['is_online'])
+
+    def test_not_modified_until_own_list_changes(self):
+        etag = self.get_users()['ETag']
+        self.assertEqual(self.get_users(etag).status_code, 304)
+
+        # Alice does not see counts of messages she sent
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(sender=self.alice, receiver=self.bob, content='hi')
+            Conversation.record_message(message)
+        self.assertEqual(self.get_users(etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(sender=self.bob, receiver=self.alice, content='hi')
+            Conversation.record_message(message)
+        response = self.get_users(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class BenchChatTests(SimpleTestCase):
+
+    def test_mix_and_percentiles(self):
+        self.assertEqual(parse_mix('typing_status=1,chat_message=3'), [3, 1, 0])
+        with self.assertRaises(CommandError):
+            parse_mix('ping=1')
+        latencies = list(range(1, 101))
+        self.assertEqual(percentile(latencies, 50), 50)
+        self.assertEqual(percentile(latencies, 100), 100)
+        self.assertEqual(percentile(latencies, 99), 99)
+        self.assertEqual(percentile([], 95), 0)
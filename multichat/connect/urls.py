@@ -3,6 +3,9 @@ from . import views
 
 urlpatterns = [
     path('', views.home, name='home'),  # Simple test homepage
+    path('get_messages/<int:user_id>/', views.get_messages, name='get_messages'),
+    path('get_users/', views.get_users, name='get_users'),
+    path('search_messages/', views.search_messages, name='search_messages'),
 ]
 
 
@@ -0,0 +1,57 @@
+"""
+Version counters for the per-user user list, used as its ETag.
+
+Each user has a counter that is bumped whenever something only they see
+changes (their unread counts), and there is one shared roster counter for
+changes everyone sees (users joining, presence flushes). Counters live in
+the cache; if one is evicted it restarts from the current time in
+milliseconds, which is always ahead of any value it could have had, so a
+stale ETag can never match again.
+"""
+
+import time
+
+from django.core.cache import cache
+
+ROSTER_KEY = 'user_list_version_roster'
+
+
+def user_list_key(user_id):
+    return f"user_list_version_{user_id}"
+
+
+def fresh_version():
+    return int(time.time() * 1000)
+
+
+def bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, fresh_version(), timeout=None)
+
+
+def bump_roster():
+    """Invalidate every user's list, e.g. after presence changes."""
+    bump(ROSTER_KEY)
+
+
+def bump_user_list(*user_ids):
+    """Invalidate the lists of the given users only."""
+    for user_id in user_ids:
+        bump(user_list_key(user_id))
+
+
+def user_list_etag(request, *args, **kwargs):
+    """
+    ETag for the requesting user's list; usable as an etag_func with
+    django.views.decorators.http.condition.
+    """
+    keys = [ROSTER_KEY, user_list_key(request.user.id)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # add() so concurrent first requests agree on the starting value
+            cache.add(key, fresh_version(), timeout=None)
+            versions[key] = cache.get(key) or fresh_version()
+    return f"{versions[ROSTER_KEY]}-{versions[keys[1]]}"
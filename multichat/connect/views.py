@@ -2,10 +2,15 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db.models import Count, Q
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.http import JsonResponse, HttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from .forms import CustomUserCreationForm, CustomAuthenticationForm
-from .models import Message, UserProfile
+from .models import Conversation, Message, UserProfile
+from . import archive, history, search
+from .versions import user_list_etag
 
 
 @login_required
@@ -13,34 +18,25 @@ def index(request):
     """
     Main chat page view.
     """
-    # Get all users except the current user, with their online status
-    users = User.objects.exclude(id=request.user.id).annotate(
-        unread_count=Count(
-            'sent_messages',
-            filter=Q(sent_messages__receiver=request.user, sent_messages__is_read=False)
-        )
-    ).select_related('profile')
-    
-    # Get the last message for each conversation
-    conversations = []
-    for user in users:
-        last_message = Message.objects.filter(
-            Q(sender=request.user, receiver=user) | Q(sender=user, receiver=request.user)
-        ).order_by('-timestamp').first()
-        
-        if last_message:
-            conversations.append({
-                'user': user,
-                'last_message': last_message,
-                'unread_count': user.unread_count,
-            })
-    
-    # Sort conversations with most recent message first
-    conversations.sort(key=lambda x: x['last_message'].timestamp, reverse=True)
-    
+    # One indexed query over the inbox table, most recent conversation first
+    # The preview and time are kept on the row, as the last message itself
+    # may have been archived
+    inbox = Conversation.for_user(request.user).select_related(
+        'user_low__profile', 'user_high__profile'
+    )
+
+    conversations = [
+        {
+            'user': conversation.other_user(request.user),
+            'last_message_preview': conversation.last_message_preview,
+            'last_message_time': conversation.formatted_last_message_at,
+            'unread_count': conversation.unread_count_for(request.user),
+        }
+        for conversation in inbox
+    ]
+
     return render(request, 'chat/index.html', {
         'conversations': conversations,
-        'users': users,
     })
 
 
@@ -95,7 +91,10 @@ def register_view(request):
 @login_required
 def get_messages(request, user_id):
     """
-    API endpoint to get message history with a specific user.
+    API endpoint to get one page of message history with a specific user.
+
+    Returns the newest page by default; pass the "before" cursor from a
+    response to get the page of older messages (or "after" for newer ones).
     """
     try:
         other_user = User.objects.get(id=user_id)
@@ -103,28 +102,50 @@ def get_messages(request, user_id):
         return JsonResponse({'error': 'User not found'}, status=404)
     
     # Get messages between current user and the other user
-    messages = Message.objects.filter(
-        (Q(sender=request.user) & Q(receiver=other_user)) |
-        (Q(sender=other_user) & Q(receiver=request.user))
-    ).order_by('timestamp')
+    messages = Message.objects.filter(conversation_key=Message.key_for(request.user.id, other_user.id))
     
-    # Mark messages from other user as read
-    Message.objects.filter(sender=other_user, receiver=request.user, is_read=False).update(is_read=True)
+    try:
+        if request.GET.get('before') or request.GET.get('after'):
+            page = archive.paginate(
+                messages,
+                Message.key_for(request.user.id, other_user.id),
+                before=request.GET.get('before'),
+                after=request.GET.get('after'),
+                limit=request.GET.get('limit'),
+            )
+        else:
+            # The newest page is what every opened chat asks for first
+            page = history.newest_page(messages, request.user.id, other_user.id, request.GET.get('limit'))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    # Mark messages from other user as read when the latest page is opened
+    if not request.GET.get('before'):
+        Conversation.mark_read(request.user.id, other_user.id)
+    
+    # Messages up to each side's read cursor have been read by that side
+    conversation = Conversation.between(request.user.id, other_user.id).first()
+    my_cursor = conversation.last_read_for(request.user) if conversation else 0
+    their_cursor = conversation.last_read_for(other_user) if conversation else 0
     
     # Format messages for JSON response
     message_list = []
-    for msg in messages:
+    for msg in page['messages']:
         message_list.append({
             'id': msg.id,
             'content': msg.content,
             'timestamp': msg.timestamp.isoformat(),
             'formatted_timestamp': msg.formatted_timestamp,
-            'is_read': msg.is_read,
-            'is_sent_by_me': msg.sender.id == request.user.id,
+            'is_read': msg.id <= (their_cursor if msg.sender_id == request.user.id else my_cursor),
+            'is_sent_by_me': msg.sender_id == request.user.id,
         })
     
     return JsonResponse({
         'messages': message_list,
+        'before': page['before'],
+        'after': page['after'],
+        'has_more': page['has_more'],
+        'last_read_message_id': their_cursor,
         'user': {
             'id': other_user.id,
             'username': other_user.username,
@@ -134,26 +155,74 @@ def get_messages(request, user_id):
 
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=user_list_etag)
 def get_users(request):
     """
     API endpoint to get user list with status and unread message counts.
     """
+    # Our unread counter lives on the low or high side of the pair row
+    unread_as_low = Conversation.objects.filter(
+        user_low=request.user, user_high=OuterRef('pk')
+    ).values('unread_low')[:1]
+    unread_as_high = Conversation.objects.filter(
+        user_low=OuterRef('pk'), user_high=request.user
+    ).values('unread_high')[:1]
+    
     users = User.objects.exclude(id=request.user.id).annotate(
-        unread_count=Count(
-            'sent_messages',
-            filter=Q(sent_messages__receiver=request.user, sent_messages__is_read=False)
-        )
-    ).values('id', 'username', 'unread_count')
+        unread_count=Coalesce(Subquery(unread_as_low), Subquery(unread_as_high), 0),
+        # Joined in the same query; users without a profile are offline
+        is_online=Coalesce('profile__is_online', False),
+    ).values('id', 'username', 'unread_count', 'is_online')
     
-    # Add online status to each user
-    for user in users:
+    return JsonResponse({'users': list(users)})
+
+
+@login_required
+def search_messages(request):
+    """
+    API endpoint to search the user's own conversations.
+
+    Takes the words to look for in "q", and optionally "user" to search only
+    the conversation with that user. Results are newest first; pass the
+    "before" cursor from a response to get the next page.
+    """
+    query = request.GET.get('q', '')
+    messages = Message.objects.filter(Q(sender=request.user) | Q(receiver=request.user))
+    if request.GET.get('user'):
         try:
-            profile = UserProfile.objects.get(user_id=user['id'])
-            user['is_online'] = profile.is_online
-        except UserProfile.DoesNotExist:
-            user['is_online'] = False
+            other_id = int(request.GET['user'])
+        except ValueError:
+            return JsonResponse({'error': 'Invalid user'}, status=400)
+        messages = Message.objects.filter(conversation_key=Message.key_for(request.user.id, other_id))
     
-    return JsonResponse({'users': list(users)})
+    try:
+        page = search.search_messages(
+            messages.select_related('sender', 'receiver'),
+            query,
+            before=request.GET.get('before'),
+            limit=request.GET.get('limit'),
+        )
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    results = []
+    for msg in page['messages']:
+        other_user = msg.receiver if msg.sender_id == request.user.id else msg.sender
+        results.append({
+            'id': msg.id,
+            'content': msg.content,
+            'timestamp': msg.timestamp.isoformat(),
+            'formatted_timestamp': msg.formatted_timestamp,
+            'is_sent_by_me': msg.sender_id == request.user.id,
+            'user': {'id': other_user.id, 'username': other_user.username},
+        })
+    
+    return JsonResponse({
+        'messages': results,
+        'before': page['before'],
+        'has_more': page['has_more'],
+    })
 
 
 def home(request):
@@ -1,264 +1,688 @@
-import json
+import asyncio
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
+from django.conf import settings
 from django.utils import timezone
-from .models import Message, UserProfile
+from connect.models import Conversation, Message
+from .contacts import contacts
+from multichat.utils import get_room_or_error
+from .db import database_sync_to_async
+from .events import events
+from .exceptions import ClientError
+from .metrics import (
+    FRAMES_RECEIVED, HANDLER_SECONDS, LAYER_DELIVERY_SECONDS, LAYER_SECONDS, OPEN_SOCKETS, frame_label
+)
+from .persistence import DURABILITY_ASYNC, writer
+from .presence import presence
+from .ratelimit import LocalLimits, retry_after, shared_limits
+from .rooms import rooms
+from .typing_state import typing
+from .wire import encode_frames, negotiate
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.user = self.scope["user"]
-        
+class FrameConsumer(AsyncWebsocketConsumer):
+    """
+    Base for sockets that exchange frames in a negotiated wire format,
+    with rate limits and metrics. Subclasses act on frames in handle_frame().
+    """
+
+    # Frame type assumed when a frame has none
+    default_frame_type = None
+    # Frame types the client is told about when they are rate limited
+    reported_frames = set()
+    # Frame types only held to their own limit, not the shared 'frames' one
+    unshared_frames = set()
+
+    async def admit(self):
+        """
+        Applies the connect rate limits and requires a logged in user.
+        Closes the socket and returns False if it may not connect.
+        """
+        # Rate limiting, per address before authentication and per user after
+        client = self.scope.get('client')
+        if client and not await shared_limits.allow('connect.ip', client[0]):
+            await self.close(code=4002)
+            return False
+
         if not self.user.is_authenticated:
             # Reject the connection if user is not authenticated
             await self.close()
+            return False
+
+        if not await shared_limits.allow('connect.user', self.user.id):
+            await self.close(code=4002)
+            return False
+
+        # Frames this socket may still send, overall and per frame type
+        self.frame_limits = LocalLimits()
+        return True
+
+    async def send_frame(self, data):
+        """
+        Encode a frame in this socket's wire format and send it.
+        """
+        await self.send(**self.codec.encode(data))
+
+    async def group_send_frame(self, group, data, **extra):
+        """
+        Send a frame to every socket in a group. The frame is encoded once
+        here instead of once per receiving socket.
+        """
+        event = {
+            'type': 'forward_frame',
+            'frames': encode_frames(data),
+            # Wall clock, as the receiving consumer may run in another process
+            'sent_at': time.time(),
+            **extra
+        }
+        with LAYER_SECONDS.labels('group_send').time():
+            await self.channel_layer.group_send(group, event)
+
+    async def fan_out_frame(self, groups, data):
+        """
+        Send a frame to several groups at once, e.g. all shards of a room,
+        encoding it only once.
+        """
+        event = {
+            'type': 'forward_frame',
+            'frames': encode_frames(data),
+            'sent_at': time.time()
+        }
+        with LAYER_SECONDS.labels('group_send').time():
+            await asyncio.gather(*(self.channel_layer.group_send(group, event) for group in groups))
+
+    async def group_add(self, group):
+        with LAYER_SECONDS.labels('group_add').time():
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def group_discard(self, group):
+        with LAYER_SECONDS.labels('group_discard').time():
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def dispatch(self, message):
+        """
+        Time every event handler; frames from the client are timed per frame
+        type in receive() instead.
+        """
+        if message['type'] == 'websocket.receive':
+            return await super().dispatch(message)
+        with HANDLER_SECONDS.labels(message['type']).time():
+            await super().dispatch(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except ValueError as e:
+            # Undecodable floods are dropped without an answer
+            if self.frame_limits.allow('frames'):
+                await self.send_frame({"error": str(e)})
             return
-        
-        # Update user's online status
-        await self.update_user_status(True)
-        
+        label = frame_label(data.get('type', self.default_frame_type))
+        FRAMES_RECEIVED.labels(label).inc()
+        limits = [f"frame.{label}"]
+        if label not in self.unshared_frames:
+            limits.insert(0, 'frames')
+        refused = next((name for name in limits if not self.frame_limits.allow(name)), None)
+        if refused is not None:
+            if label in self.reported_frames:
+                # Tell the client, as what it sent was not acted on
+                await self.send_frame({
+                    'type': 'rate_limited',
+                    'frame': label,
+                    'retry_after': retry_after(refused)
+                })
+            return
+        try:
+            with HANDLER_SECONDS.labels(f"receive.{label}").time():
+                await self.handle_frame(data)
+        except ClientError as e:
+            # Catch any errors and send it back
+            await self.send_frame({"error": e.code})
+        except Exception as e:
+            # A consumer that raised would be gone without disconnect()
+            # running. Close instead, so disconnect() cleans up.
+            print(f"Error handling {label} frame: {e}")
+            await self.close(code=1011)
+
+    async def handle_frame(self, data):
+        """
+        Act on a decoded frame from the client.
+        """
+        raise NotImplementedError
+
+    def message_text(self, message):
+        if not isinstance(message, str) or not message.strip():
+            raise ClientError("MESSAGE_INVALID")
+        return message
+
+    async def forward_frame(self, event):
+        """
+        Send a frame that was already encoded by the sender of the event.
+        """
+        if 'sent_at' in event:
+            LAYER_DELIVERY_SECONDS.observe(max(0, time.time() - event['sent_at']))
+        await self.send(**event['frames'][self.codec.subprotocol])
+
+
+class ChatConsumer(FrameConsumer):
+    default_frame_type = 'chat_message'
+    # Clients retry presence subscriptions that were refused
+    reported_frames = {'chat_message', 'subscribe_presence'}
+    # Sent on keystrokes; a fast typist must not use up the shared limit
+    # that their next message needs
+    unshared_frames = {'typing_status'}
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        # MessagePack or JSON frames, depending on what the client offered
+        self.codec, subprotocol = negotiate(self.scope.get('subprotocols', []))
+
+        if not await self.admit():
+            return
+
+        # Events numbered after this reach us live once we have joined the
+        # group below; the ones in between are replayed by resume()
+        joined_seq = await events.current(self.user.id)
+
         # Join a group for the user to receive personal messages
         self.user_group_name = f"user_{self.user.id}"
-        await self.channel_layer.group_add(
-            self.user_group_name,
-            self.channel_name
-        )
-        
-        # Join a general group to broadcast online status
-        await self.channel_layer.group_add(
-            'all_users',
-            self.channel_name
-        )
-        
-        await self.accept()
-        
-        # Broadcast to all users that this user is online
-        await self.channel_layer.group_send(
-            'all_users',
+        OPEN_SOCKETS.inc()
+        await self.group_add(self.user_group_name)
+
+        # Follow the presence of everyone we have talked to
+        self.contacts = await contacts.get(self.user.id)
+        self.presence_subscriptions = set()
+        await self.subscribe_presence(self.contacts)
+
+        # Messages still being written in the background (async durability)
+        self.pending_writes = set()
+
+        await self.accept(subprotocol)
+
+        # Catch a reconnecting client up on what it missed
+        await self.resume(self.last_seq(), joined_seq)
+
+        # Register the socket; only the user's first socket makes them online
+        if await presence.connect(self.user.id):
+            await self.broadcast_status('online')
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'user_group_name'):
+            # Connection was rejected before it was set up
+            return
+        OPEN_SOCKETS.dec()
+
+        # Leave user's personal group
+        await self.group_discard(self.user_group_name)
+
+        # Stop following other users' presence
+        for user_id in self.presence_subscriptions:
+            await self.group_discard(f"presence_{user_id}")
+
+        # Unregister the socket; only the user's last socket makes them offline
+        if await presence.disconnect(self.user.id):
+            await self.broadcast_status('offline')
+
+    def last_seq(self):
+        """
+        The number of the last event the client handled, which a client that
+        reconnects passes as ?last_seq= in the socket URL.
+        """
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['last_seq'][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def resume(self, last_seq, joined_seq):
+        """
+        Send the events after last_seq in one batch, or tell the client to
+        reload if they are no longer kept. New clients get the events after
+        joined_seq, which were numbered while the socket joined its group
+        and may not have reached it live.
+        """
+        seq, missed = await events.since(self.user.id, joined_seq if last_seq is None else last_seq)
+        if missed is None:
+            await self.send_frame({'type': 'resync', 'seq': seq})
+        else:
+            await self.send_frame({'type': 'resume', 'seq': seq, 'events': missed})
+
+    async def send_user_event(self, user_id, data, **extra):
+        """
+        Send an event to every socket of a user, numbered in the user's event
+        stream so it can be replayed to a client that reconnects.
+        """
+        data = await events.append(user_id, data)
+        await self.group_send_frame(f"user_{user_id}", data, **extra)
+
+    async def broadcast_status(self, status):
+        """
+        Tell the users subscribed to our presence that we went online/offline.
+        """
+        await self.group_send_frame(
+            f"presence_{self.user.id}",
             {
                 'type': 'user_status',
                 'user_id': self.user.id,
-                'status': 'online'
+                'status': status
             }
         )
 
-    async def disconnect(self, close_code):
-        # Update user's offline status
-        await self.update_user_status(False)
-        
-        # Leave user's personal group
-        await self.channel_layer.group_discard(
-            self.user_group_name,
-            self.channel_name
+    async def subscribe_presence(self, user_ids):
+        """
+        Join the presence groups of the given users, up to a per-socket cap.
+        The groups are joined concurrently, a batch at a time.
+        """
+        limit = getattr(settings, 'PRESENCE_MAX_SUBSCRIPTIONS', 500)
+        batch = getattr(settings, 'PRESENCE_SUBSCRIBE_BATCH', 100)
+        added = []
+        for user_id in user_ids:
+            if user_id in self.presence_subscriptions or user_id == self.user.id:
+                continue
+            if len(self.presence_subscriptions) >= limit:
+                break
+            self.presence_subscriptions.add(user_id)
+            added.append(user_id)
+        for start in range(0, len(added), batch):
+            await asyncio.gather(*(
+                self.group_add(f"presence_{user_id}") for user_id in added[start:start + batch]
+            ))
+
+    async def add_contact(self, user_id):
+        """
+        Start following a user we just exchanged a first message with.
+        """
+        user_id = int(user_id)
+        if user_id in self.contacts:
+            return
+        self.contacts.add(user_id)
+        await contacts.invalidate(self.user.id, user_id)
+        await self.subscribe_presence([user_id])
+
+    async def deliver_message(self, message_obj):
+        """
+        Send a message to the personal group of its receiver.
+        """
+        await self.add_contact(message_obj.receiver_id)
+        await self.send_user_event(
+            message_obj.receiver_id,
+            {
+                'type': 'chat_message',
+                'message': message_obj.content,
+                'sender_id': self.user.id,
+                'sender_username': self.user.username,
+                'message_id': message_obj.id,
+                'timestamp': message_obj.timestamp.isoformat(),
+                'unread_count': message_obj.unread_count
+            },
+            contact_id=self.user.id
         )
-        
-        # Leave the general group
-        await self.channel_layer.group_discard(
-            'all_users',
-            self.channel_name
+
+    async def confirm_message(self, message_obj):
+        """
+        Send confirmation of a saved message back to the sender.
+        """
+        await self.send_user_event(
+            self.user.id,
+            {
+                'type': 'message_sent',
+                'message': message_obj.content,
+                'receiver_id': message_obj.receiver_id,
+                'message_id': message_obj.id,
+                'timestamp': message_obj.timestamp.isoformat(),
+                'client_id': message_obj.client_id
+            },
+            contact_id=message_obj.receiver_id
         )
-        
-        # Broadcast to all users that this user is offline
-        await self.channel_layer.group_send(
-            'all_users',
+
+    async def persist_message(self, message_obj):
+        """
+        Write an already delivered message and confirm it to the sender.
+        """
+        try:
+            saved = await writer.save(message_obj)
+        except Exception as e:
+            print(f"Error saving message: {e}")
+            # The receiver already has it, but the sender gets no id; let
+            # them send it again
+            if message_obj.client_id is not None:
+                await events.release(self.user.id, message_obj.client_id)
+            await self.send_user_event(
+                self.user.id,
+                {
+                    'type': 'message_failed',
+                    'error': 'MESSAGE_NOT_SAVED',
+                    'receiver_id': message_obj.receiver_id,
+                    'client_id': message_obj.client_id
+                }
+            )
+            return
+        if saved is None:
+            await self.close(code=4001)  # Custom close code for invalid user
+            return
+        await self.confirm_message(saved)
+
+    async def send_typing_status(self, sender_id, receiver_id, is_typing):
+        """
+        Send typing status to receiver.
+        """
+        await self.group_send_frame(
+            f"user_{receiver_id}",
             {
-                'type': 'user_status',
-                'user_id': self.user.id,
-                'status': 'offline'
+                'type': 'typing_status',
+                'user_id': sender_id,
+                'is_typing': is_typing
             }
         )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    def user_id(self, user_id):
+        try:
+            return int(user_id)
+        except (TypeError, ValueError):
+            raise ClientError("USER_INVALID")
+
+    async def handle_frame(self, data):
+        """
+        Act on a decoded frame from the client.
+        """
         message_type = data.get('type', 'chat_message')
-        
+
+        # Any frame counts as activity; written out with the next presence flush
+        presence.touch(self.user.id)
+
         if message_type == 'chat_message':
-            message = data['message']
-            receiver_id = data['receiver_id']
-            
-            # Save message to database
-            message_obj = await self.save_message(receiver_id, message)
-            
-            # Send message to personal group of receiver
-            receiver_group_name = f"user_{receiver_id}"
-            await self.channel_layer.group_send(
-                receiver_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'sender_id': self.user.id,
-                    'sender_username': self.user.username,
-                    'message_id': message_obj.id,
-                    'timestamp': message_obj.timestamp.isoformat()
-                }
+            # Clients resend unconfirmed messages after a reconnect
+            client_id = data.get('client_id')
+            if client_id is not None and not await events.claim(self.user.id, client_id):
+                return
+
+            message_obj = Message(
+                sender=self.user,
+                receiver_id=self.user_id(data.get('receiver_id')),
+                content=self.message_text(data.get('message'))
             )
-            
-            # Send confirmation back to sender
-            await self.channel_layer.group_send(
-                self.user_group_name,
+            # Echoed in the confirmation so the client can match it up
+            message_obj.client_id = client_id
+
+            if writer.durability == DURABILITY_ASYNC:
+                # Deliver right away; the id is confirmed to the sender once written
+                message_obj.timestamp = timezone.now()
+                message_obj.unread_count = None
+                await self.deliver_message(message_obj)
+                task = asyncio.ensure_future(self.persist_message(message_obj))
+                self.pending_writes.add(task)
+                task.add_done_callback(self.pending_writes.discard)
+                return
+
+            # Save message to database, batched with other consumers' messages
+            try:
+                message_obj = await writer.save(message_obj)
+            except Exception as e:
+                print(f"Error saving message: {e}")
+                # Let the client send it again
+                if client_id is not None:
+                    await events.release(self.user.id, client_id)
+                raise ClientError("MESSAGE_NOT_SAVED")
+            if message_obj is None:
+                await self.close(code=4001)  # Custom close code for invalid user
+                return
+
+            await self.deliver_message(message_obj)
+            await self.confirm_message(message_obj)
+
+        elif message_type == 'read_messages':
+            sender_id = self.user_id(data.get('sender_id'))
+            last_read = await self.mark_messages_as_read(sender_id)
+            if last_read is None:
+                # We have never talked to them
+                return
+
+            # Clear the badge in the reader's other tabs too
+            await self.send_user_event(
+                self.user.id,
                 {
-                    'type': 'message_sent',
-                    'message': message,
-                    'receiver_id': receiver_id,
-                    'message_id': message_obj.id,
-                    'timestamp': message_obj.timestamp.isoformat()
+                    'type': 'unread_count',
+                    'user_id': sender_id,
+                    'unread_count': 0
                 }
             )
-            
-        elif message_type == 'read_messages':
-            sender_id = data['sender_id']
-            await self.mark_messages_as_read(sender_id)
-            
+
             # Notify sender that messages were read
-            sender_group_name = f"user_{sender_id}"
-            await self.channel_layer.group_send(
-                sender_group_name,
+            await self.send_user_event(
+                sender_id,
                 {
                     'type': 'messages_read',
-                    'reader_id': self.user.id
+                    'reader_id': self.user.id,
+                    'last_read_message_id': last_read
                 }
             )
-            
+
+        elif message_type == 'subscribe_presence':
+            # Users scrolled into view in the sidebar, a batch at a time
+            user_ids = data.get('user_ids', [])
+            if not isinstance(user_ids, list):
+                raise ClientError("USER_INVALID")
+            batch = getattr(settings, 'PRESENCE_SUBSCRIBE_BATCH', 100)
+            user_ids = [self.user_id(user_id) for user_id in user_ids[:batch]]
+            await self.subscribe_presence(user_ids)
+            # Users past the subscription cap are left out
+            followed = self.presence_subscriptions & set(user_ids)
+            online = await presence.online_users(followed)
+            await self.send_frame({
+                'type': 'presence_state',
+                'user_ids': sorted(followed),
+                'online': sorted(online)
+            })
+
         elif message_type == 'typing_status':
-            receiver_id = data['receiver_id']
-            is_typing = data['is_typing']
-            
-            # Send typing status to receiver
-            receiver_group_name = f"user_{receiver_id}"
-            await self.channel_layer.group_send(
-                receiver_group_name,
-                {
-                    'type': 'typing_status',
-                    'user_id': self.user.id,
-                    'is_typing': is_typing
-                }
+            # Only changes of state reach the receiver, and at a limited rate
+            await typing.update(
+                self.user.id,
+                self.user_id(data.get('receiver_id')),
+                bool(data.get('is_typing')),
+                self.send_typing_status
             )
 
+        else:
+            raise ClientError("TYPE_INVALID")
+
+    async def forward_frame(self, event):
+        if 'contact_id' in event:
+            await self.add_contact(event['contact_id'])
+        await super().forward_frame(event)
+
+    # The handlers below build the frame from raw event fields, for events
+    # sent by connect.consumers
+
     async def chat_message(self, event):
         """
         Send message to WebSocket.
         """
-        await self.send(text_data=json.dumps({
+        await self.add_contact(event['sender_id'])
+        await self.send_frame({
             'type': 'chat_message',
             'message': event['message'],
             'sender_id': event['sender_id'],
             'sender_username': event['sender_username'],
             'message_id': event['message_id'],
-            'timestamp': event['timestamp']
-        }))
+            'timestamp': event['timestamp'],
+            'unread_count': event.get('unread_count')
+        })
 
     async def message_sent(self, event):
         """
         Confirm message was sent.
         """
-        await self.send(text_data=json.dumps({
+        await self.add_contact(event['receiver_id'])
+        await self.send_frame({
             'type': 'message_sent',
             'message': event['message'],
             'receiver_id': event['receiver_id'],
             'message_id': event['message_id'],
             'timestamp': event['timestamp']
-        }))
+        })
 
     async def messages_read(self, event):
         """
         Notify that messages were read.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'messages_read',
-            'reader_id': event['reader_id']
-        }))
-
-async def receive(self, text_data):
-    try:
-        data = json.loads(text_data)
-        if not all(k in data for k in ['type', 'message', 'receiver_id']):
-            raise ValueError("Missing required fields")
-    except (json.JSONDecodeError, ValueError) as e:
-        await self.send(json.dumps({"error": str(e)}))
-        return
-
+            'reader_id': event['reader_id'],
+            'last_read_message_id': event.get('last_read_message_id')
+        })
 
     async def typing_status(self, event):
         """
         Notify about typing status.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'typing_status',
             'user_id': event['user_id'],
             'is_typing': event['is_typing']
-        }))
+        })
+
+    async def unread_count(self, event):
+        """
+        Update the unread badge of a conversation.
+        """
+        await self.send_frame({
+            'type': 'unread_count',
+            'user_id': event['user_id'],
+            'unread_count': event['unread_count']
+        })
 
     async def user_status(self, event):
         """
         Broadcast user online/offline status.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'user_status',
             'user_id': event['user_id'],
             'status': event['status']
-        }))
-    
-    @database_sync_to_async
-    def update_user_status(self, is_online):
-        """
-        Update user's online status in database.
-        """
-        profile, created = UserProfile.objects.get_or_create(user=self.user)
-        profile.is_online = is_online
-        profile.last_activity = timezone.now()
-        profile.save()
-        return profile
-
-  @database_sync_to_async
-def save_message(self, receiver_id, content):
-    try:
-        receiver = User.objects.get(id=receiver_id)
-        message = Message.objects.create(
-            sender=self.user,
-            receiver=receiver,
-            content=content
-        )
-        return message
-    except User.DoesNotExist:
-        await self.close(code=4001)  # Custom close code for invalid user
-    except Exception as e:
-        print(f"Error saving message: {e}")
-        
+        })
 
     @database_sync_to_async
     def mark_messages_as_read(self, sender_id):
         """
-        Mark messages from sender as read.
+        Move our read cursor past every message from sender. Returns the
+        cursor, or None if there is no conversation with sender.
         """
-        sender = User.objects.get(id=sender_id)
-        Message.objects.filter(
-            sender=sender,
-            receiver=self.user,
-            is_read=False
-        ).update(is_read=True)
-        return True
+        last_read = Conversation.mark_read(self.user.id, sender_id)
+        if last_read is None:
+            # Nothing was unread, usually because get_messages has just marked
+            # it read; the sender and our other tabs still need the cursor
+            last_read = Conversation.between(self.user.id, sender_id).values_list(
+                Conversation.last_read_field(self.user.id, sender_id), flat=True
+            ).first()
+        return last_read
+
+
+class RoomConsumer(FrameConsumer):
+    """
+    Group chat in rooms that may have thousands of members.
 
-@database_sync_to_async
-def get_user_cached(self, user_id):
-    user = cache.get(f"user_{user_id}")
-    if not user:
-        user = User.objects.get(id=user_id)
-        cache.set(f"user_{user_id}", user, timeout=300)
-    return user
+    A socket can have several rooms open. For each it joins one shard group
+    of the room (see RoomDirectory), and every message is sent to all of the
+    room's shards. Messages carry the room's sequence number, which goes up
+    by one per message, so a client that sees a number skipped knows it
+    missed something and can reload. Messages sent through different
+    workers may overtake each other, so a client should give a missing
+    number a moment to arrive.
+
+    Room messages are not stored.
+    """
+
+    reported_frames = {'room_message'}
 
     async def connect(self):
-    # Rate limiting
-    if await self.check_connection_limit():
-        await self.close(code=4002)
-        return
-
-@database_sync_to_async
-def check_connection_limit(self):
-    from django.core.cache import cache
-    key = f"ws_conn_{self.user.id}"
-    count = cache.get(key, 0)
-    if count > 5:  # Max 5 connections per user
-        return True
-    cache.set(key, count+1, timeout=60)
-    return False
\ No newline at end of file
+        self.user = self.scope["user"]
+        self.codec, subprotocol = negotiate(self.scope.get('subprotocols', []))
+
+        if not await self.admit():
+            return
+
+        # room id -> the shard group this socket listens on
+        self.rooms = {}
+        OPEN_SOCKETS.inc()
+        await self.accept(subprotocol)
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'rooms'):
+            # Connection was rejected before it was set up
+            return
+        OPEN_SOCKETS.dec()
+        for group in self.rooms.values():
+            await self.group_discard(group)
+
+    async def handle_frame(self, data):
+        message_type = data.get('type')
+        if message_type == 'join_room':
+            await self.join_room(data.get('room'))
+        elif message_type == 'leave_room':
+            await self.leave_room(data.get('room'))
+        elif message_type == 'room_message':
+            await self.send_room(data.get('room'), data.get('message'))
+
+    async def join_room(self, room_id):
+        """
+        Called by receive when someone sent a join command.
+        """
+        # The permission check is served from the room cache
+        room = await get_room_or_error(room_id, self.user)
+        if room.id not in self.rooms:
+            group = room.group_name(rooms.shard_for(self.channel_name))
+            await self.group_add(group)
+            self.rooms[room.id] = group
+        # The client numbers the room's messages from here
+        await self.send_frame({
+            'type': 'room_joined',
+            'room': room.id,
+            'title': room.title,
+            'seq': await rooms.current_seq(room.id)
+        })
+
+    async def leave_room(self, room_id):
+        """
+        Called by receive when someone sent a leave command.
+        """
+        room_id = self.room_id(room_id)
+        group = self.rooms.pop(room_id, None)
+        if group is None:
+            raise ClientError("ROOM_NOT_JOINED")
+        await self.group_discard(group)
+        await self.send_frame({
+            'type': 'room_left',
+            'room': room_id
+        })
+
+    async def send_room(self, room_id, message):
+        """
+        Called by receive when someone sends a message to a room.
+        """
+        room_id = self.room_id(room_id)
+        if room_id not in self.rooms:
+            raise ClientError("ROOM_ACCESS_DENIED")
+        room = await rooms.get(room_id)
+        if room is None:
+            raise ClientError("ROOM_INVALID")
+        # Checked before a sequence number is used up
+        message = self.message_text(message)
+        await self.fan_out_frame(
+            [room.group_name(shard) for shard in range(rooms.shards)],
+            {
+                'type': 'room_message',
+                'room': room_id,
+                'seq': await rooms.next_seq(room_id),
+                'sender_id': self.user.id,
+                'sender_username': self.user.username,
+                'message': message
+            }
+        )
+
+    def room_id(self, room_id):
+        try:
+            return int(room_id)
+        except (TypeError, ValueError):
+            raise ClientError("ROOM_INVALID")
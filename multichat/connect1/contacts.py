@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from connect.models import Conversation
+from .db import database_sync_to_async
+
+
+class ContactIndex:
+    """
+    Cached set of the users each user has a message history with.
+
+    Presence updates are only fanned out to a user's contacts, so consumers
+    look this up once per connection instead of joining a global group.
+    """
+
+    key_prefix = 'contacts'
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or getattr(settings, 'CONTACTS_CACHE_TTL', 3600)
+
+    def cache_key(self, user_id):
+        return f"{self.key_prefix}_{user_id}"
+
+    async def get(self, user_id):
+        """
+        Returns the set of contact user ids, computing and caching it on a miss.
+        """
+        key = self.cache_key(user_id)
+        user_ids = await cache.aget(key)
+        if user_ids is None:
+            user_ids = await self.compute(user_id)
+            await cache.aset(key, user_ids, timeout=self.timeout)
+        return set(user_ids)
+
+    @database_sync_to_async
+    def compute(self, user_id):
+        pairs = Conversation.objects.filter(
+            Q(user_low_id=user_id) | Q(user_high_id=user_id)
+        ).values_list('user_low_id', 'user_high_id')
+        return sorted(low if high == user_id else high for low, high in pairs)
+
+    async def invalidate(self, *user_ids):
+        """
+        Drops cached contact sets, e.g. after two users exchange a first message.
+        """
+        await cache.adelete_many([self.cache_key(user_id) for user_id in user_ids])
+
+
+# Shared by all consumers in this process
+contacts = ContactIndex()
@@ -0,0 +1,70 @@
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from .metrics import DB_PENDING, DB_QUEUE_SECONDS, DB_RUN_SECONDS
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process-wide thread pool for ORM calls from consumers, or
+    None when DB_EXECUTOR_WORKERS is 0 and Channels' single database thread
+    is used instead.
+
+    Each worker thread keeps its own connection, so DB_EXECUTOR_WORKERS is
+    also the most connections this process opens; size it to the share of
+    the database's connection limit each worker process may use.
+    """
+    global _executor
+    workers = getattr(settings, 'DB_EXECUTOR_WORKERS', 0)
+    if not workers:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+    return _executor
+
+
+def database_sync_to_async(func):
+    """
+    Drop-in replacement for channels.db.database_sync_to_async that runs the
+    call on the database executor and records how long it waited for a
+    worker thread and how long it ran.
+
+    Old connections are closed around each call as with Channels, which
+    honours CONN_MAX_AGE and CONN_HEALTH_CHECKS, so worker threads reuse
+    their connection for as long as it is healthy.
+    """
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        enqueued = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            DB_QUEUE_SECONDS.labels(name).observe(started - enqueued)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                DB_RUN_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+        executor = get_executor()
+        if executor is None:
+            call = DatabaseSyncToAsync(run)
+        else:
+            call = DatabaseSyncToAsync(run, thread_sensitive=False, executor=executor)
+        DB_PENDING.inc()
+        try:
+            return await call()
+        finally:
+            DB_PENDING.dec()
+
+    return wrapper
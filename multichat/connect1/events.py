@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from connect.versions import fresh_version
+
+
+class EventLog:
+    """
+    Numbered stream of the events sent to each user, kept for a while so a
+    client that reconnects can be sent just what it missed.
+
+    Every event for a user gets the next number of the user's sequence and
+    is kept in the shared cache for EVENT_LOG_TTL seconds. A client passes
+    the last number it handled when it reconnects; if all later events are
+    still kept, and there are at most EVENT_LOG_SIZE of them, they are
+    replayed in one batch. Otherwise the client has to reload.
+
+    Like room sequences, a sequence that is evicted restarts from the
+    current time in milliseconds, so numbers never go back and a client
+    from before the restart is told to reload.
+    """
+
+    key_prefix = 'events'
+
+    def __init__(self, ttl=None, size=None):
+        self.ttl = ttl or getattr(settings, 'EVENT_LOG_TTL', 300)
+        self.size = size or getattr(settings, 'EVENT_LOG_SIZE', 200)
+
+    def seq_key(self, user_id):
+        return f"{self.key_prefix}_seq_{user_id}"
+
+    def event_key(self, user_id, seq):
+        return f"{self.key_prefix}_{user_id}_{seq}"
+
+    def client_key(self, user_id, client_id):
+        return f"{self.key_prefix}_client_{user_id}_{client_id}"
+
+    async def append(self, user_id, data):
+        """
+        Numbers and keeps an event for the user. Returns the event with its
+        number in the "seq" field.
+        """
+        key = self.seq_key(user_id)
+        try:
+            seq = await cache.aincr(key)
+        except ValueError:
+            await cache.aadd(key, fresh_version(), timeout=None)
+            seq = await cache.aincr(key)
+        data = {**data, 'seq': seq}
+        await cache.aset(self.event_key(user_id, seq), data, timeout=self.ttl)
+        return data
+
+    async def current(self, user_id):
+        """
+        Returns the number of the user's latest event.
+        """
+        key = self.seq_key(user_id)
+        seq = await cache.aget(key)
+        if seq is None:
+            # add() so concurrent first connects agree on the starting value
+            await cache.aadd(key, fresh_version(), timeout=None)
+            seq = await cache.aget(key)
+        return seq
+
+    async def since(self, user_id, seq):
+        """
+        Returns (latest number, events after seq in order). The events are
+        None if some of them are no longer kept.
+        """
+        current = await self.current(user_id)
+        if seq is None:
+            return current, []
+        if seq > current or current - seq > self.size:
+            return current, None
+        keys = [self.event_key(user_id, missed) for missed in range(seq + 1, current + 1)]
+        found = await cache.aget_many(keys)
+        if len(found) < len(keys):
+            return current, None
+        return current, [found[key] for key in keys]
+
+    async def claim(self, user_id, client_id):
+        """
+        Returns True the first time a client id is seen for the user within
+        the retention time, so frames resent after a reconnect are only
+        acted on once.
+        """
+        return await cache.aadd(self.client_key(user_id, client_id), True, timeout=self.ttl)
+
+    async def release(self, user_id, client_id):
+        """
+        Forgets a claimed client id, for a frame that was not acted on after
+        all and may be sent again.
+        """
+        await cache.adelete(self.client_key(user_id, client_id))
+
+
+# Shared by all consumers in this process
+events = EventLog()
@@ -0,0 +1,92 @@
+import asyncio
+from collections import namedtuple
+
+from async_lru import alru_cache
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from .db import database_sync_to_async
+
+# What consumers need to know about another user
+Identity = namedtuple('Identity', ['id', 'username'])
+
+
+class IdentityCache:
+    """
+    Resolves user ids to identities without a query per frame.
+
+    Lookups go through an LRU in this process (IDENTITY_LOCAL_SIZE entries
+    kept for IDENTITY_LOCAL_TTL seconds), then the shared cache (kept for
+    IDENTITY_CACHE_TTL seconds), and only then the database. Unknown ids
+    are cached too, so a client cannot make us query for them repeatedly.
+
+    Saving or deleting a user invalidates the shared entry and the LRU of
+    this process; LRUs of other processes catch up within the local TTL.
+    """
+
+    key_prefix = 'identity'
+
+    def __init__(self, timeout=None, local_ttl=None, local_size=None):
+        self.timeout = timeout or getattr(settings, 'IDENTITY_CACHE_TTL', 3600)
+        self.local_size = local_size or getattr(settings, 'IDENTITY_LOCAL_SIZE', 10000)
+        self.local_ttl = local_ttl or getattr(settings, 'IDENTITY_LOCAL_TTL', 30)
+        self.lookup = self.local_cache()
+        # Loop the LRU lives on, for invalidations from other threads
+        self._loop = None
+
+    def local_cache(self):
+        """
+        A new, empty LRU in front of the shared cache, for one event loop.
+        """
+        return alru_cache(maxsize=self.local_size, ttl=self.local_ttl)(self.lookup_shared)
+
+    def cache_key(self, user_id):
+        return f"{self.key_prefix}_{user_id}"
+
+    async def get(self, user_id):
+        """
+        Returns the Identity of a user, or None if there is no such user.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not None and loop is not self._loop:
+            # Entries hold tasks of the loop they were looked up on
+            self.lookup = self.local_cache()
+        self._loop = loop
+        return await self.lookup(int(user_id))
+
+    async def existing(self, user_ids):
+        """
+        Returns the subset of user_ids that belong to existing users.
+        """
+        user_ids = list(user_ids)
+        found = await asyncio.gather(*(self.get(user_id) for user_id in user_ids))
+        return {user_id for user_id, identity in zip(user_ids, found) if identity is not None}
+
+    async def lookup_shared(self, user_id):
+        key = self.cache_key(user_id)
+        fields = await cache.aget(key)
+        if fields is None:
+            fields = await self.fetch(user_id)
+            await cache.aset(key, fields, timeout=self.timeout)
+        # An empty tuple records that the user does not exist
+        return Identity(user_id, *fields) if fields else None
+
+    @database_sync_to_async
+    def fetch(self, user_id):
+        row = User.objects.filter(id=user_id).values_list('username').first()
+        return tuple(row) if row else ()
+
+    def invalidate(self, user_id):
+        """
+        Forgets a user in the shared cache and in this process. Safe to call
+        from any thread, e.g. from a signal handler.
+        """
+        cache.delete(self.cache_key(user_id))
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.lookup.cache_invalidate, user_id)
+
+
+# Shared by all consumers in this process
+identities = IdentityCache()
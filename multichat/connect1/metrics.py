@@ -0,0 +1,80 @@
+"""
+Prometheus metrics of the realtime layer.
+
+Metrics live in the default prometheus_client registry of each process and
+are served by the ASGI app itself on METRICS_PATH (see with_metrics_endpoint).
+"""
+
+from django.conf import settings
+from prometheus_client import Counter, Gauge, Histogram, make_asgi_app
+
+# Frame types clients may send; anything else is counted as "unknown" so a
+# misbehaving client cannot create unbounded label values
+FRAME_TYPES = {
+    'chat_message', 'read_messages', 'subscribe_presence', 'typing_status',
+    'join_room', 'leave_room', 'room_message',
+}
+
+OPEN_SOCKETS = Gauge(
+    'chat_open_sockets',
+    'WebSocket connections currently open in this process',
+)
+HANDLER_SECONDS = Histogram(
+    'chat_handler_seconds',
+    'Time spent handling a consumer event',
+    ['event'],
+)
+FRAMES_RECEIVED = Counter(
+    'chat_frames_received_total',
+    'Frames received from clients',
+    ['frame'],
+)
+DB_PENDING = Gauge(
+    'chat_db_pending_calls',
+    'Database calls waiting for or running on a worker thread',
+)
+DB_QUEUE_SECONDS = Histogram(
+    'chat_db_queue_seconds',
+    'Time a database call waited for a worker thread',
+    ['function'],
+)
+DB_RUN_SECONDS = Histogram(
+    'chat_db_run_seconds',
+    'Time a database call ran on its worker thread',
+    ['function'],
+)
+RATE_LIMITED = Counter(
+    'chat_rate_limited_total',
+    'Connect attempts and frames refused by a rate limit',
+    ['limit'],
+)
+LAYER_SECONDS = Histogram(
+    'chat_layer_seconds',
+    'Time spent in channel layer calls',
+    ['operation'],
+)
+LAYER_DELIVERY_SECONDS = Histogram(
+    'chat_layer_delivery_seconds',
+    'Time from a group_send until a consumer handles the event',
+)
+
+
+def frame_label(frame_type):
+    # Types come from the client and need not even be hashable
+    return frame_type if isinstance(frame_type, str) and frame_type in FRAME_TYPES else 'unknown'
+
+
+def with_metrics_endpoint(app):
+    """
+    Wraps an ASGI HTTP app so that METRICS_PATH is answered with the metrics
+    of this process and every other request is passed through.
+    """
+    path = getattr(settings, 'METRICS_PATH', '/metrics')
+    metrics_app = make_asgi_app()
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == path:
+            return await metrics_app(scope, receive, send)
+        return await app(scope, receive, send)
+
+    return application
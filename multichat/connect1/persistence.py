@@ -0,0 +1,120 @@
+import asyncio
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from connect.models import Conversation, Message
+from .db import database_sync_to_async
+from .identity import identities
+
+# Fan out only once the message is committed (default)
+DURABILITY_COMMIT = 'commit'
+# Fan out right away and write the message in the background
+DURABILITY_ASYNC = 'async'
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for chat messages.
+
+    Consumers in this process hand their unsaved messages to one writer task,
+    which collects them for up to MESSAGE_BATCH_INTERVAL seconds (or until
+    MESSAGE_BATCH_SIZE are waiting) and saves the whole batch with a single
+    bulk_create in one transaction. Every caller is then woken up with its
+    own saved message, id and receiver's unread count included.
+    """
+
+    def __init__(self, batch_size=None, batch_interval=None, durability=None):
+        self.batch_size = batch_size or getattr(settings, 'MESSAGE_BATCH_SIZE', 100)
+        self.batch_interval = batch_interval or getattr(settings, 'MESSAGE_BATCH_INTERVAL', 0.01)
+        self.durability = durability or getattr(settings, 'MESSAGE_DURABILITY', DURABILITY_COMMIT)
+        # (message, future) waiting for the next batch
+        self.pending = []
+        self._task = None
+
+    async def save(self, message):
+        """
+        Queues an unsaved Message and waits until its batch is committed.
+        Returns the saved message with `unread_count` set, or None if the
+        receiver does not exist. Raises the error if the message could not
+        be written.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        self.ensure_writer()
+        return await future
+
+    def ensure_writer(self):
+        """
+        Starts the batch writer on the running event loop if it is idle.
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            if len(self.pending) < self.batch_size:
+                # Give other consumers a moment to add to the batch
+                await asyncio.sleep(self.batch_interval)
+            await self.flush()
+
+    async def flush(self):
+        """
+        Writes up to batch_size pending messages and wakes up their senders.
+        """
+        batch = self.pending[:self.batch_size]
+        self.pending = self.pending[self.batch_size:]
+        messages = [message for message, _ in batch]
+        try:
+            # Receivers are checked against the identity cache, not the database
+            receivers = await identities.existing({message.receiver_id for message in messages})
+            saved = await self.write(messages, receivers)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, saved):
+            # The consumer may have disconnected in the meantime
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @database_sync_to_async
+    def write(self, messages, receivers):
+        """
+        Saves a batch. Returns, per message, the saved message, None if the
+        receiver does not exist, or the error that kept it from being saved.
+        """
+        try:
+            return self.insert(messages, receivers)
+        except Exception:
+            # A receiver may have been deleted after it was cached, or a row
+            # is bad. Ask the database who exists and save the messages one
+            # at a time, so only the bad rows fail.
+            receivers = set(User.objects.filter(id__in=receivers).values_list('id', flat=True))
+            return [self.insert_one(message, receivers) for message in messages]
+
+    def insert_one(self, message, receivers):
+        try:
+            return self.insert([message], receivers)[0]
+        except Exception as e:
+            return e
+
+    def insert(self, messages, receivers):
+        valid = [message for message in messages if message.receiver_id in receivers]
+        with transaction.atomic():
+            # Ids are filled in on backends that support RETURNING (PostgreSQL, SQLite)
+            Message.objects.bulk_create(valid)
+            for message, count in zip(valid, Conversation.record_messages(valid)):
+                message.unread_count = count
+        return [message if message.receiver_id in receivers else None for message in messages]
+
+
+# Shared by all consumers in this process
+writer = MessageWriter()
@@ -0,0 +1,160 @@
+import asyncio
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+from connect.models import UserProfile
+from connect.versions import bump_roster
+from .db import database_sync_to_async
+
+
+class PresenceRegistry:
+    """
+    Tracks which users are online without touching the database on every
+    socket connect/disconnect.
+
+    Open connections are counted per user twice: in this process (so we know
+    whose heartbeat to keep alive) and in the shared cache (so every worker
+    agrees on when a user goes from 0 to 1 connections and back). Only those
+    transitions are remembered, and a background task writes them to
+    UserProfile in bulk every PRESENCE_FLUSH_INTERVAL seconds.
+    """
+
+    key_prefix = 'presence'
+
+    def __init__(self, heartbeat_ttl=None, flush_interval=None):
+        self.heartbeat_ttl = heartbeat_ttl or getattr(settings, 'PRESENCE_HEARTBEAT_TTL', 60)
+        self.flush_interval = flush_interval or getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 5)
+        # user_id -> number of sockets this process holds for that user
+        self.connections = {}
+        # user_id -> (is_online, last_activity) waiting to be written
+        self.dirty = {}
+        self._task = None
+
+    def cache_key(self, user_id):
+        return f"{self.key_prefix}_{user_id}"
+
+    async def connect(self, user_id):
+        """
+        Registers a new socket for the user. Returns True if this was the
+        user's first open connection anywhere, i.e. they just came online.
+        """
+        self.ensure_flusher()
+        self.connections[user_id] = self.connections.get(user_id, 0) + 1
+        key = self.cache_key(user_id)
+        # add() is atomic, so only one worker ever initialises the counter
+        await cache.aadd(key, 0, timeout=self.heartbeat_ttl)
+        count = await cache.aincr(key)
+        if count == 1:
+            self.mark(user_id, True)
+            return True
+        return False
+
+    async def disconnect(self, user_id):
+        """
+        Unregisters a socket for the user. Returns True if that was their
+        last open connection anywhere, i.e. they just went offline.
+        """
+        local = self.connections.get(user_id, 0) - 1
+        if local > 0:
+            self.connections[user_id] = local
+        else:
+            self.connections.pop(user_id, None)
+        key = self.cache_key(user_id)
+        try:
+            count = await cache.adecr(key)
+        except ValueError:
+            # The counter expired under us; treat the user as gone
+            count = 0
+        if count <= 0:
+            await cache.adelete(key)
+            self.mark(user_id, False)
+            return True
+        return False
+
+    def touch(self, user_id):
+        """
+        Records activity for a connected user; coalesced into the next flush.
+        """
+        self.mark(user_id, True)
+
+    def mark(self, user_id, is_online):
+        self.dirty[user_id] = (is_online, timezone.now())
+
+    async def is_online(self, user_id):
+        return bool(await cache.aget(self.cache_key(user_id)))
+
+    async def online_users(self, user_ids):
+        """
+        Returns the subset of user_ids that currently have an open socket.
+        """
+        keys = {self.cache_key(user_id): user_id for user_id in user_ids}
+        found = await cache.aget_many(list(keys))
+        return {keys[key] for key, count in found.items() if count}
+
+    async def heartbeat(self):
+        """
+        Pushes back the expiry of every user this process holds sockets for,
+        so counters of crashed workers age out on their own.
+        """
+        for user_id in list(self.connections):
+            await cache.atouch(self.cache_key(user_id), self.heartbeat_ttl)
+
+    async def flush(self):
+        """
+        Writes all pending presence changes in one go.
+        """
+        if not self.dirty:
+            return
+        pending, self.dirty = self.dirty, {}
+        await self.write(pending)
+
+    @database_sync_to_async
+    def write(self, pending):
+        # user_id -> is_online as stored so far
+        existing = dict(
+            UserProfile.objects.filter(user_id__in=pending).values_list('user_id', 'is_online')
+        )
+        # Users created before profiles existed still need a row
+        missing = [UserProfile(user_id=user_id) for user_id in pending if user_id not in existing]
+        if missing:
+            UserProfile.objects.bulk_create(missing, ignore_conflicts=True)
+        # One UPDATE, with each user's own status and time
+        UserProfile.objects.filter(user_id__in=pending).update(
+            is_online=Case(
+                *[When(user_id=user_id, then=Value(is_online)) for user_id, (is_online, _) in pending.items()],
+                output_field=models.BooleanField(),
+            ),
+            last_activity=Case(
+                *[When(user_id=user_id, then=Value(seen)) for user_id, (_, seen) in pending.items()],
+                output_field=models.DateTimeField(),
+            ),
+        )
+        # Everyone's user list shows online status, but not last_activity,
+        # so a flush of mere activity leaves their ETags alone
+        if any(existing.get(user_id, False) != is_online for user_id, (is_online, _) in pending.items()):
+            bump_roster()
+
+    def ensure_flusher(self):
+        """
+        Starts the periodic heartbeat/flush task on the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.heartbeat()
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing presence: {e}")
+
+
+# Shared by all consumers in this process
+presence = PresenceRegistry()
@@ -0,0 +1,199 @@
+"""
+Token-bucket rate limits for the chat socket.
+
+A limit is a bucket of `burst` tokens that refills evenly over `period`
+seconds; every attempt takes a token and is refused when the bucket is
+empty. Limits are configured by name in RATE_LIMITS as (burst, period), and
+a limit set to None is switched off.
+
+Limits shared by every worker, such as connect attempts per user, live in
+Redis and are checked and updated by one Lua script, so concurrent attempts
+cannot race past them. Without RATE_LIMIT_REDIS_URL, or while Redis is
+unreachable, they fall back to buckets in this process. Limits that belong
+to a single socket, such as its inbound frames, never leave the process.
+"""
+
+import asyncio
+import math
+import time
+
+from django.conf import settings
+
+from .metrics import RATE_LIMITED
+
+DEFAULT_LIMITS = {
+    # Connect attempts, shared by all workers
+    'connect.user': (10, 60),
+    'connect.ip': (30, 60),
+    # Frames received on one socket, all types together and per type
+    'frames': (30, 10),
+    'frame.chat_message': (20, 10),
+    'frame.read_messages': (20, 10),
+    'frame.typing_status': (20, 10),
+    'frame.subscribe_presence': (5, 10),
+    'frame.join_room': (20, 10),
+    'frame.leave_room': (20, 10),
+    'frame.room_message': (20, 10),
+}
+
+# Refill the bucket, then take a token if there is one. Runs atomically in
+# Redis and uses the server clock, so workers need not agree on the time.
+TAKE_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+
+def get_limit(name):
+    """
+    Returns (burst, period) for a named limit, or None if it is switched off.
+    """
+    limits = {**DEFAULT_LIMITS, **getattr(settings, 'RATE_LIMITS', {})}
+    return limits.get(name)
+
+
+class TokenBucket:
+    """
+    A bucket in this process. Coroutines on one event loop never interleave
+    inside take(), so it needs no lock.
+    """
+
+    def __init__(self, burst, period):
+        self.burst = burst
+        self.rate = burst / period
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """
+        Takes a token. Returns True if there was one.
+        """
+        self.refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class LocalLimits:
+    """
+    A set of named limits kept in this process, e.g. for one socket.
+    """
+
+    def __init__(self):
+        # (name, key) -> TokenBucket
+        self.buckets = {}
+
+    def allow(self, name, key=''):
+        """
+        Returns True if the attempt is within the named limit for key.
+        """
+        limit = get_limit(name)
+        if limit is None:
+            return True
+        bucket = self.buckets.get((name, key))
+        if bucket is None:
+            bucket = self.buckets[(name, key)] = TokenBucket(*limit)
+        if bucket.take():
+            return True
+        RATE_LIMITED.labels(name).inc()
+        return False
+
+    def prune(self):
+        """
+        Forgets buckets that have refilled; they behave like new ones.
+        """
+        now = time.monotonic()
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.is_full(now)}
+
+
+class SharedLimits(LocalLimits):
+    """
+    Named limits shared by all workers through Redis.
+    """
+
+    key_prefix = 'ratelimit'
+    # Local buckets kept before full ones are pruned, while Redis is not used
+    max_local_buckets = 10000
+
+    def __init__(self, redis_url=None):
+        super().__init__()
+        self.redis_url = redis_url or getattr(settings, 'RATE_LIMIT_REDIS_URL', None)
+        self._redis = None
+        self._script = None
+        # Whether Redis failed last time; an outage is only reported once
+        self.degraded = False
+
+    def get_script(self):
+        """
+        Returns the take script registered on a client for the running event
+        loop, as redis.asyncio connections cannot be shared between loops.
+        """
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._redis is None or self._redis[0] is not loop:
+            client = redis.asyncio.Redis.from_url(self.redis_url)
+            self._redis = (loop, client)
+            self._script = client.register_script(TAKE_SCRIPT)
+        return self._script
+
+    async def allow(self, name, key=''):
+        limit = get_limit(name)
+        if limit is None:
+            return True
+        if self.redis_url:
+            from redis.exceptions import RedisError
+
+            burst, period = limit
+            try:
+                allowed = await self.get_script()(
+                    keys=[f"{self.key_prefix}:{name}:{key}"], args=[burst, burst / period]
+                )
+            except (RedisError, OSError) as e:
+                if not self.degraded:
+                    print(f"Error checking rate limit, using local limits: {e}")
+                    self.degraded = True
+            else:
+                if self.degraded:
+                    print("Rate limits are shared through Redis again")
+                    self.degraded = False
+                if not allowed:
+                    RATE_LIMITED.labels(name).inc()
+                return bool(allowed)
+        if len(self.buckets) >= self.max_local_buckets:
+            self.prune()
+        return super().allow(name, key)
+
+
+def retry_after(name):
+    """
+    Seconds until a refused attempt at the named limit gets a token again.
+    """
+    burst, period = get_limit(name)
+    return math.ceil(period / burst)
+
+
+# Shared by all consumers in this process
+shared_limits = SharedLimits()
@@ -0,0 +1,121 @@
+import asyncio
+import zlib
+
+from async_lru import alru_cache
+from django.conf import settings
+from django.core.cache import cache
+
+from connect.models import Room
+from connect.versions import fresh_version
+from .db import database_sync_to_async
+
+
+class RoomDirectory:
+    """
+    Rooms as seen by the room consumer: a cached lookup of each room's
+    settings, the shard each socket listens on, and per-room sequence
+    numbers.
+
+    Rooms are looked up like identities (see connect1.identity): through an
+    LRU in this process, then the shared cache, then the database, so
+    joining a room does not query it. Saving or deleting a room invalidates
+    both tiers.
+
+    Big rooms are split into ROOM_FANOUT_SHARDS channel layer groups, and
+    each socket joins only one of them. A message is sent to every shard,
+    so no single group_send has to walk the room's whole membership.
+    """
+
+    key_prefix = 'room'
+
+    def __init__(self, shards=None, timeout=None, local_ttl=None, local_size=None):
+        self.shards = shards or getattr(settings, 'ROOM_FANOUT_SHARDS', 8)
+        self.timeout = timeout or getattr(settings, 'ROOM_CACHE_TTL', 3600)
+        self.local_size = local_size or getattr(settings, 'ROOM_LOCAL_SIZE', 1000)
+        self.local_ttl = local_ttl or getattr(settings, 'ROOM_LOCAL_TTL', 30)
+        self.lookup = self.local_cache()
+        # Loop the LRU lives on, for invalidations from other threads
+        self._loop = None
+
+    def local_cache(self):
+        """
+        A new, empty LRU in front of the shared cache, for one event loop.
+        """
+        return alru_cache(maxsize=self.local_size, ttl=self.local_ttl)(self.lookup_shared)
+
+    def cache_key(self, room_id):
+        return f"{self.key_prefix}_{room_id}"
+
+    def seq_key(self, room_id):
+        return f"{self.key_prefix}_seq_{room_id}"
+
+    async def get(self, room_id):
+        """
+        Returns an unsaved Room carrying the cached fields, or None if there
+        is no such room.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not None and loop is not self._loop:
+            # Entries hold tasks of the loop they were looked up on
+            self.lookup = self.local_cache()
+        self._loop = loop
+        return await self.lookup(int(room_id))
+
+    async def lookup_shared(self, room_id):
+        key = self.cache_key(room_id)
+        fields = await cache.aget(key)
+        if fields is None:
+            fields = await self.fetch(room_id)
+            await cache.aset(key, fields, timeout=self.timeout)
+        # An empty dict records that the room does not exist
+        return Room(id=room_id, **fields) if fields else None
+
+    @database_sync_to_async
+    def fetch(self, room_id):
+        return Room.objects.filter(id=room_id).values('title', 'staff_only').first() or {}
+
+    def invalidate(self, room_id):
+        """
+        Forgets a room in the shared cache and in this process. Safe to call
+        from any thread, e.g. from a signal handler.
+        """
+        cache.delete(self.cache_key(room_id))
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.lookup.cache_invalidate, room_id)
+
+    def shard_for(self, channel_name):
+        """
+        The shard a socket listens on; stable for the life of the socket.
+        """
+        return zlib.crc32(channel_name.encode()) % self.shards
+
+    async def current_seq(self, room_id):
+        """
+        Returns the sequence number of the last message sent to the room.
+        """
+        key = self.seq_key(room_id)
+        seq = await cache.aget(key)
+        if seq is None:
+            # add() so concurrent first joins agree on the starting value
+            await cache.aadd(key, fresh_version(), timeout=None)
+            seq = await cache.aget(key)
+        return seq
+
+    async def next_seq(self, room_id):
+        """
+        Returns the sequence number of a new message in the room. Numbers
+        increase by one per message; if the counter is evicted it restarts
+        from the current time in milliseconds, which is ahead of any value
+        it had, so clients see a gap and never a step back.
+        """
+        key = self.seq_key(room_id)
+        try:
+            return await cache.aincr(key)
+        except ValueError:
+            await cache.aadd(key, fresh_version(), timeout=None)
+            return await cache.aincr(key)
+
+
+# Shared by all consumers in this process
+rooms = RoomDirectory()
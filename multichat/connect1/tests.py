@@ -0,0 +1,509 @@
+import asyncio
+import io
+import threading
+from contextlib import redirect_stdout
+from datetime import timedelta
+from unittest import mock
+
+import msgpack
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from prometheus_client import REGISTRY
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from connect.models import Conversation, Message, Room, UserProfile
+from connect.versions import ROSTER_KEY
+from .consumers import ChatConsumer, RoomConsumer
+from .contacts import ContactIndex
+from .db import database_sync_to_async, get_executor
+from .events import events
+from .identity import IdentityCache
+from .persistence import DURABILITY_ASYNC, MessageWriter, writer
+from .presence import PresenceRegistry, presence
+from .ratelimit import LocalLimits, SharedLimits
+from .rooms import rooms
+from .typing_state import TypingTracker
+from .wire import JSONCodec, MessagePackCodec, encode_frames, negotiate
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Async tests that touch the database run it on Channels' single database
+# thread (DB_EXECUTOR_WORKERS=0): the pool's threads have their own
+# connections and would not see the test case's transaction.
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DB_EXECUTOR_WORKERS=0)
+class PresenceRegistryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='secret')
+        self.registry = PresenceRegistry(heartbeat_ttl=60, flush_interval=3600)
+
+    async def test_only_first_and_last_socket_change_status(self):
+        self.assertTrue(await self.registry.connect(self.user.id))
+        self.assertFalse(await self.registry.connect(self.user.id))
+        self.assertTrue(await self.registry.is_online(self.user.id))
+        self.assertFalse(await self.registry.disconnect(self.user.id))
+        self.assertTrue(await self.registry.disconnect(self.user.id))
+        self.assertFalse(await self.registry.is_online(self.user.id))
+
+    async def test_flush_writes_final_state_once(self):
+        for _ in range(3):
+            await self.registry.connect(self.user.id)
+            await self.registry.disconnect(self.user.id)
+        await self.registry.connect(self.user.id)
+        self.assertEqual(len(self.registry.dirty), 1)
+
+        await self.registry.flush()
+        self.assertEqual(self.registry.dirty, {})
+        profile = await UserProfile.objects.aget(user=self.user)
+        self.assertTrue(profile.is_online)
+
+    async def test_flush_keeps_each_users_own_activity_time(self):
+        bob = await User.objects.acreate_user('bob', password='secret')
+        left = timezone.now() - timedelta(minutes=5)
+        seen = timezone.now()
+        self.registry.dirty = {self.user.id: (False, left), bob.id: (True, seen)}
+        await self.registry.flush()
+
+        profiles = {
+            profile.user_id: profile async for profile in UserProfile.objects.filter(user_id__in=[self.user.id, bob.id])
+        }
+        self.assertEqual((profiles[self.user.id].is_online, profiles[self.user.id].last_activity), (False, left))
+        self.assertEqual((profiles[bob.id].is_online, profiles[bob.id].last_activity), (True, seen))
+
+    async def test_only_status_changes_bump_the_roster(self):
+        await self.registry.connect(self.user.id)
+        await self.registry.flush()
+        version = await cache.aget(ROSTER_KEY)
+        self.assertIsNotNone(version)
+
+        self.registry.touch(self.user.id)
+        await self.registry.flush()
+        self.assertEqual(await cache.aget(ROSTER_KEY), version)
+
+        await self.registry.disconnect(self.user.id)
+        await self.registry.flush()
+        self.assertNotEqual(await cache.aget(ROSTER_KEY), version)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DB_EXECUTOR_WORKERS=0)
+class ContactIndexTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.carol = User.objects.create_user('carol', password='secret')
+        self.index = ContactIndex()
+
+    async def send(self, sender, receiver):
+        message = await Message.objects.acreate(sender=sender, receiver=receiver, content='hi')
+        await sync_to_async(Conversation.record_message)(message)
+
+    async def test_contacts_are_message_partners_in_either_direction(self):
+        await self.send(self.alice, self.bob)
+        await self.send(self.carol, self.alice)
+        self.assertEqual(await self.index.get(self.alice.id), {self.bob.id, self.carol.id})
+        self.assertEqual(await self.index.get(self.bob.id), {self.alice.id})
+
+    async def test_cached_until_invalidated(self):
+        self.assertEqual(await self.index.get(self.alice.id), set())
+        await self.send(self.alice, self.bob)
+        self.assertEqual(await self.index.get(self.alice.id), set())
+        await self.index.invalidate(self.alice.id, self.bob.id)
+        self.assertEqual(await self.index.get(self.alice.id), {self.bob.id})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DB_EXECUTOR_WORKERS=0)
+class IdentityCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='secret')
+        self.identities = IdentityCache(timeout=60, local_ttl=60, local_size=10)
+
+    async def test_identities_are_cached_until_invalidated(self):
+        identity = await self.identities.get(self.user.id)
+        self.assertEqual(identity, (self.user.id, 'alice'))
+        self.assertIsNone(await self.identities.get(0))
+
+        # Renames without signals are not seen until invalidation, even
+        # once the local tier is dropped
+        await User.objects.filter(id=self.user.id).aupdate(username='alicia')
+        self.assertEqual((await self.identities.get(self.user.id)).username, 'alice')
+        self.identities.lookup.cache_clear()
+        self.assertEqual((await self.identities.get(self.user.id)).username, 'alice')
+
+        await sync_to_async(self.identities.invalidate)(self.user.id)
+        await asyncio.sleep(0)
+        self.assertEqual((await self.identities.get(self.user.id)).username, 'alicia')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DB_EXECUTOR_WORKERS=0)
+class RoomConsumerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        rooms.lookup.cache_clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.room = Room.objects.create(title='Lobby')
+        self.staff_room = Room.objects.create(title='Staff', staff_only=True)
+
+    async def open(self, user):
+        communicator = WebsocketCommunicator(RoomConsumer.as_asgi(), '/ws/rooms/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_messages_reach_every_shard_in_sequence(self):
+        alice, bob = await self.open(self.alice), await self.open(self.bob)
+        for communicator in (alice, bob):
+            await communicator.send_json_to({'type': 'join_room', 'room': self.room.id})
+            joined = await communicator.receive_json_from()
+        self.assertEqual(joined['title'], 'Lobby')
+
+        for text in ('one', ['bad'], '  ', 'two'):
+            await alice.send_json_to({'type': 'room_message', 'room': self.room.id, 'message': text})
+        # Alice is in the room too, so her own messages come back among the errors
+        echoed = [await alice.receive_json_from() for _ in range(4)]
+        self.assertEqual([frame for frame in echoed if 'error' in frame], [{'error': 'MESSAGE_INVALID'}] * 2)
+        # Refused messages do not leave a gap in the sequence
+        received = [await bob.receive_json_from() for _ in range(2)]
+        self.assertEqual([frame['message'] for frame in received], ['one', 'two'])
+        self.assertEqual([frame['seq'] for frame in received], [joined['seq'] + 1, joined['seq'] + 2])
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_room_permissions_are_checked_from_the_cache(self):
+        bob = await self.open(self.bob)
+        await bob.send_json_to({'type': 'join_room', 'room': self.staff_room.id})
+        self.assertEqual(await bob.receive_json_from(), {'error': 'ROOM_ACCESS_DENIED'})
+        await bob.send_json_to({'type': 'room_message', 'room': self.room.id, 'message': 'hi'})
+        self.assertEqual(await bob.receive_json_from(), {'error': 'ROOM_ACCESS_DENIED'})
+
+        # Served from the cache even once the room is gone
+        await Room.objects.filter(id=self.staff_room.id).adelete()
+        self.assertEqual((await rooms.get(self.staff_room.id)).title, 'Staff')
+        await bob.disconnect()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DB_EXECUTOR_WORKERS=0)
+class ResumeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+
+    async def connect(self, query=''):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/?{query}')
+        communicator.scope['user'] = self.alice
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return frame
+
+    async def test_reconnecting_client_gets_missed_events(self):
+        fresh = await self.connect()
+        self.assertEqual(fresh, {'type': 'resume', 'seq': fresh['seq'], 'events': []})
+
+        for count in (1, 2):
+            await events.append(self.alice.id, {'type': 'unread_count', 'user_id': 7, 'unread_count': count})
+
+        resumed = await self.connect(f"last_seq={fresh['seq']}")
+        self.assertEqual(resumed['seq'], fresh['seq'] + 2)
+        self.assertEqual([event['unread_count'] for event in resumed['events']], [1, 2])
+        self.assertEqual([event['seq'] for event in resumed['events']], [fresh['seq'] + 1, fresh['seq'] + 2])
+
+        # Events that are no longer kept cannot be replayed
+        await cache.adelete(events.event_key(self.alice.id, fresh['seq'] + 1))
+        self.assertEqual((await self.connect(f"last_seq={fresh['seq']}"))['type'], 'resync')
+
+    async def test_event_numbered_while_joining_is_replayed(self):
+        group_add = ChatConsumer.group_add
+
+        async def append_then_join(consumer, group):
+            # An event numbered before the socket is in the group
+            if group == f"user_{self.alice.id}":
+                await events.append(self.alice.id, {'type': 'unread_count', 'user_id': 7, 'unread_count': 3})
+            await group_add(consumer, group)
+
+        with mock.patch.object(ChatConsumer, 'group_add', append_then_join):
+            fresh = await self.connect()
+        self.assertEqual([event['unread_count'] for event in fresh['events']], [3])
+        self.assertEqual(fresh['events'][0]['seq'], fresh['seq'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DB_EXECUTOR_WORKERS=0)
+class ChatConsumerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+
+    async def open(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())['type'], 'resume')
+        return communicator
+
+    @override_settings(RATE_LIMITS={'frames': (3, 60), 'frame.typing_status': (100, 60)})
+    async def test_typing_does_not_use_up_the_message_limit(self):
+        alice = await self.open(self.alice)
+        for is_typing in [True, False] * 5:
+            await alice.send_json_to({'type': 'typing_status', 'receiver_id': self.bob.id, 'is_typing': is_typing})
+        for text in ('one', 'two', 'three'):
+            await alice.send_json_to({'type': 'chat_message', 'receiver_id': self.bob.id, 'message': text})
+            self.assertEqual((await alice.receive_json_from())['type'], 'message_sent')
+
+        await alice.send_json_to({'type': 'chat_message', 'receiver_id': self.bob.id, 'message': 'four'})
+        refused = await alice.receive_json_from()
+        self.assertEqual((refused['type'], refused['frame']), ('rate_limited', 'chat_message'))
+        await alice.disconnect()
+
+    async def test_malformed_frames_are_answered_with_errors(self):
+        alice = await self.open(self.alice)
+        for frame, error in [
+            ({'type': 'chat_message', 'message': 'hi'}, 'USER_INVALID'),
+            ({'type': 'chat_message', 'receiver_id': self.bob.id, 'message': ['hi']}, 'MESSAGE_INVALID'),
+            ({'type': 'read_messages', 'sender_id': 'bob'}, 'USER_INVALID'),
+            ({'type': []}, 'TYPE_INVALID'),
+            ({'type': {}}, 'TYPE_INVALID'),
+            ({'type': 'subscribe_presence', 'user_ids': 7}, 'USER_INVALID'),
+        ]:
+            await alice.send_json_to(frame)
+            self.assertEqual(await alice.receive_json_from(), {'error': error})
+
+        # The socket is still usable
+        await alice.send_json_to({'type': 'chat_message', 'receiver_id': self.bob.id, 'message': 'hi'})
+        self.assertEqual((await alice.receive_json_from())['type'], 'message_sent')
+        await alice.disconnect()
+
+    @override_settings(PRESENCE_MAX_SUBSCRIPTIONS=3, PRESENCE_SUBSCRIBE_BATCH=2)
+    async def test_presence_subscriptions_are_capped(self):
+        alice = await self.open(self.alice)
+        await alice.send_json_to({'type': 'subscribe_presence', 'user_ids': [self.bob.id, 101, 102]})
+        state = await alice.receive_json_from()
+        self.assertEqual(state['user_ids'], sorted([self.bob.id, 101]))
+        await alice.send_json_to({'type': 'subscribe_presence', 'user_ids': [103, 104]})
+        self.assertEqual((await alice.receive_json_from())['user_ids'], [103])
+        await alice.disconnect()
+
+    async def test_read_receipt_is_sent_after_the_messages_view_marked_them_read(self):
+        alice, bob = await self.open(self.alice), await self.open(self.bob)
+        await alice.send_json_to({'type': 'chat_message', 'receiver_id': self.bob.id, 'message': 'hi'})
+        sent = await alice.receive_json_from()
+        self.assertEqual((await bob.receive_json_from())['message_id'], sent['message_id'])
+
+        # As get_messages does when bob opens the chat
+        await sync_to_async(Conversation.mark_read)(self.bob.id, self.alice.id)
+        await bob.send_json_to({'type': 'read_messages', 'sender_id': self.alice.id})
+        self.assertEqual((await bob.receive_json_from())['type'], 'unread_count')
+        read = await alice.receive_json_from()
+        self.assertEqual((read['type'], read['last_read_message_id']), ('messages_read', sent['message_id']))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_message_failing_after_async_delivery_can_be_sent_again(self):
+        alice, bob = await self.open(self.alice), await self.open(self.bob)
+        frame = {'type': 'chat_message', 'receiver_id': self.bob.id, 'message': 'hi', 'client_id': 'c1'}
+        with mock.patch.object(writer, 'durability', DURABILITY_ASYNC), \
+                mock.patch.object(writer, 'save', side_effect=RuntimeError('down')), \
+                redirect_stdout(io.StringIO()):
+            await alice.send_json_to(frame)
+            self.assertEqual((await bob.receive_json_from())['message'], 'hi')
+            failed = await alice.receive_json_from()
+        self.assertEqual((failed['type'], failed['client_id']), ('message_failed', 'c1'))
+
+        # The client id was released, so the retry is saved
+        await alice.send_json_to(frame)
+        self.assertEqual((await alice.receive_json_from())['type'], 'message_sent')
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_failing_handler_closes_the_socket_and_releases_presence(self):
+        alice = await self.open(self.alice)
+        # Answered once connect() has finished
+        await alice.send_json_to({'type': 'subscribe_presence', 'user_ids': []})
+        await alice.receive_json_from()
+        self.assertTrue(await presence.is_online(self.alice.id))
+        with mock.patch.object(ChatConsumer, 'mark_messages_as_read', side_effect=RuntimeError('boom')), \
+                redirect_stdout(io.StringIO()) as output:
+            await alice.send_json_to({'type': 'read_messages', 'sender_id': self.bob.id})
+            self.assertEqual(await alice.receive_output(), {'type': 'websocket.close', 'code': 1011})
+        self.assertIn('boom', output.getvalue())
+        await alice.disconnect()
+        self.assertFalse(await presence.is_online(self.alice.id))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DB_EXECUTOR_WORKERS=0)
+class MessageWriterTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.writer = MessageWriter(batch_size=10, batch_interval=0.01)
+
+    async def test_concurrent_messages_are_saved_in_one_batch(self):
+        batches = []
+        write = self.writer.write
+
+        async def counting_write(messages, receivers):
+            batches.append(len(messages))
+            return await write(messages, receivers)
+
+        self.writer.write = counting_write
+        saved = await asyncio.gather(
+            self.writer.save(Message(sender=self.alice, receiver_id=self.bob.id, content='1')),
+            self.writer.save(Message(sender=self.alice, receiver_id=self.bob.id, content='2')),
+            self.writer.save(Message(sender=self.alice, receiver_id=0, content='lost')),
+        )
+
+        self.assertEqual(batches, [3])
+        self.assertIsNone(saved[2])
+        self.assertEqual([message.unread_count for message in saved[:2]], [1, 2])
+        ids = [message_id async for message_id in Message.objects.order_by('id').values_list('id', flat=True)]
+        self.assertEqual(ids, [saved[0].id, saved[1].id])
+
+    async def test_bad_row_only_fails_its_own_message(self):
+        saved = await asyncio.gather(
+            self.writer.save(Message(sender=self.alice, receiver_id=self.bob.id, content='1')),
+            self.writer.save(Message(sender=self.alice, receiver_id=self.bob.id, content=None)),
+            self.writer.save(Message(sender=self.alice, receiver_id=self.bob.id, content='3')),
+            return_exceptions=True,
+        )
+
+        self.assertIsInstance(saved[1], IntegrityError)
+        self.assertEqual([message.content for message in (saved[0], saved[2])], ['1', '3'])
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+class TypingTrackerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.tracker = TypingTracker(ttl=0.2, min_interval=0.05)
+
+    async def send(self, sender_id, receiver_id, is_typing):
+        self.sent.append(is_typing)
+
+    async def test_keystrokes_coalesce_and_expire(self):
+        for _ in range(20):
+            await self.tracker.update(1, 2, True, self.send)
+        self.assertEqual(self.sent, [True])
+
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.sent, [True, False])
+        self.assertEqual(self.tracker.states, {})
+
+    async def test_rapid_changes_are_throttled_to_latest_state(self):
+        await self.tracker.update(1, 2, True, self.send)
+        await self.tracker.update(1, 2, False, self.send)
+        await self.tracker.update(1, 2, True, self.send)
+        await self.tracker.update(1, 2, False, self.send)
+        self.assertEqual(self.sent, [True])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, [True, False])
+
+
+class WireTests(SimpleTestCase):
+
+    def test_negotiation_prefers_msgpack_and_falls_back_to_json(self):
+        codec, subprotocol = negotiate(['chat.json', 'chat.msgpack'])
+        self.assertIsInstance(codec, MessagePackCodec)
+        self.assertEqual(subprotocol, 'chat.msgpack')
+        codec, subprotocol = negotiate([])
+        self.assertIsInstance(codec, JSONCodec)
+        self.assertIsNone(subprotocol)
+
+    def test_msgpack_frames_use_field_codes(self):
+        codec = MessagePackCodec()
+        frame = {'type': 'typing_status', 'user_id': 7, 'is_typing': True}
+        encoded = codec.encode(frame)['bytes_data']
+        self.assertLess(len(encoded), len(JSONCodec().encode(frame)['text_data']) // 2)
+        self.assertEqual(codec.decode(bytes_data=encoded), frame)
+        with self.assertRaises(ValueError):
+            codec.decode(text_data='{}')
+
+    def test_batched_frames_use_field_codes_too(self):
+        codec = MessagePackCodec()
+        frame = {'type': 'resume', 'seq': 2, 'events': [{'type': 'unread_count', 'seq': 2}]}
+        encoded = codec.encode(frame)['bytes_data']
+        self.assertEqual(msgpack.unpackb(encoded)['ev'], [{'t': 'unread_count', 'sq': 2}])
+        self.assertEqual(codec.decode(bytes_data=encoded), frame)
+
+    def test_group_frames_are_ready_for_every_format(self):
+        frame = {'type': 'user_status', 'user_id': 7, 'status': 'online'}
+        frames = encode_frames(frame)
+        for codec in (JSONCodec(), MessagePackCodec()):
+            self.assertEqual(frames[codec.subprotocol], codec.encode(frame))
+
+
+@override_settings(RATE_LIMITS={'frames': (3, 0.1), 'connect.user': (2, 60)})
+class RateLimitTests(SimpleTestCase):
+
+    async def test_bucket_allows_burst_then_refills(self):
+        limits = LocalLimits()
+        self.assertEqual([limits.allow('frames') for _ in range(4)], [True, True, True, False])
+        await asyncio.sleep(0.05)
+        self.assertEqual([limits.allow('frames') for _ in range(2)], [True, False])
+        # Limits without a configuration are off
+        self.assertTrue(all(limits.allow('frame.unknown') for _ in range(100)))
+
+    async def test_shared_limits_fall_back_to_this_process(self):
+        # Nothing listens on this port
+        limits = SharedLimits(redis_url='redis://127.0.0.1:9/0')
+        with redirect_stdout(io.StringIO()) as output:
+            results = [await limits.allow('connect.user', 7) for _ in range(3)]
+            self.assertTrue(await limits.allow('connect.user', 8))
+        self.assertEqual(results, [True, True, False])
+        # Reported once per outage, not once per attempt
+        self.assertEqual(output.getvalue().count('using local limits'), 1)
+        self.assertTrue(limits.degraded)
+
+
+@override_settings(DB_EXECUTOR_WORKERS=0)
+class DatabaseMetricsTests(TestCase):
+
+    async def test_calls_record_queue_and_run_time(self):
+        @database_sync_to_async
+        def count_users():
+            return User.objects.count()
+
+        labels = {'function': count_users.__qualname__}
+        before = REGISTRY.get_sample_value('chat_db_run_seconds_count', labels) or 0
+        self.assertEqual(await count_users(), 0)
+        self.assertEqual(REGISTRY.get_sample_value('chat_db_run_seconds_count', labels), before + 1)
+        self.assertEqual(REGISTRY.get_sample_value('chat_db_queue_seconds_count', labels), before + 1)
+
+
+@override_settings(DB_EXECUTOR_WORKERS=2)
+class DatabaseExecutorTests(TransactionTestCase):
+
+    async def test_calls_run_on_the_pool(self):
+        @database_sync_to_async
+        def thread_name():
+            User.objects.exists()
+            return threading.current_thread().name
+
+        self.assertIsNotNone(get_executor())
+        self.assertTrue((await thread_name()).startswith('db'))
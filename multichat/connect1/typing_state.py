@@ -0,0 +1,105 @@
+import asyncio
+
+from django.conf import settings
+
+
+class TypingState:
+    """
+    What the receiver was last told about one sender's typing.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.is_typing = False
+        self.sent_at = None
+        # Latest state held back by the throttle, and the timer that sends it
+        self.pending = None
+        self.throttle_timer = None
+        # Timer that sends is_typing False if the sender goes quiet
+        self.expiry_timer = None
+
+
+class TypingTracker:
+    """
+    Coalesces typing indicators per (sender, receiver) pair.
+
+    Clients report typing on every keystroke; only changes of state are
+    forwarded, at most one per TYPING_MIN_INTERVAL seconds, and a sender
+    that stops reporting is turned off automatically after TYPING_TTL
+    seconds. Typing traffic through the channel layer is thus proportional
+    to state changes rather than keystrokes.
+    """
+
+    def __init__(self, ttl=None, min_interval=None):
+        self.ttl = ttl or getattr(settings, 'TYPING_TTL', 5)
+        self.min_interval = min_interval or getattr(settings, 'TYPING_MIN_INTERVAL', 1)
+        # (sender_id, receiver_id) -> TypingState
+        self.states = {}
+
+    async def update(self, sender_id, receiver_id, is_typing, send):
+        """
+        Reports the sender's typing state. `send(sender_id, receiver_id,
+        is_typing)` is awaited whenever the receiver needs to be told.
+        """
+        key = (sender_id, receiver_id)
+        state = self.states.get(key)
+        if state is None:
+            if not is_typing:
+                return
+            state = self.states[key] = TypingState(send)
+
+        loop = asyncio.get_running_loop()
+        if state.expiry_timer is not None:
+            state.expiry_timer.cancel()
+            state.expiry_timer = None
+        if is_typing:
+            state.expiry_timer = loop.call_later(self.ttl, self.expire, key)
+
+        if state.throttle_timer is not None:
+            # A change is already scheduled; it will carry the latest state
+            state.pending = is_typing
+            return
+        if is_typing == state.is_typing:
+            return
+        wait = 0 if state.sent_at is None else state.sent_at + self.min_interval - loop.time()
+        if wait > 0:
+            state.pending = is_typing
+            state.throttle_timer = loop.call_later(wait, self.release, key)
+            return
+        await self.emit(key, state, is_typing)
+
+    async def emit(self, key, state, is_typing):
+        state.is_typing = is_typing
+        state.sent_at = asyncio.get_running_loop().time()
+        if not is_typing and state.expiry_timer is None and state.throttle_timer is None:
+            # Nothing left to track for this pair
+            self.states.pop(key, None)
+        await state.send(*key, is_typing)
+
+    def release(self, key):
+        """
+        Sends the state held back by the throttle, if it is still news.
+        """
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.throttle_timer = None
+        is_typing, state.pending = state.pending, None
+        if is_typing is not None and is_typing != state.is_typing:
+            asyncio.ensure_future(self.emit(key, state, is_typing))
+        elif not state.is_typing and state.expiry_timer is None:
+            self.states.pop(key, None)
+
+    def expire(self, key):
+        """
+        The sender stopped reporting; tell the receiver they stopped typing.
+        """
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.expiry_timer = None
+        asyncio.ensure_future(self.update(*key, False, state.send))
+
+
+# Shared by all consumers in this process
+typing = TypingTracker()
@@ -0,0 +1,117 @@
+"""
+Wire formats of the chat socket.
+
+The client picks one through the WebSocket subprotocol it offers. With
+"chat.msgpack" frames are binary MessagePack maps keyed by the short codes in
+FIELDS; with "chat.json", or no subprotocol at all, they are JSON text frames
+with the full field names.
+"""
+
+import json
+
+import msgpack
+
+MSGPACK = 'chat.msgpack'
+JSON = 'chat.json'
+
+# Field name -> code used on the wire by the MessagePack format.
+# static/js/wire.js keeps a copy of this table.
+FIELDS = {
+    'type': 't',
+    'message': 'm',
+    'message_id': 'i',
+    'sender_id': 's',
+    'sender_username': 'u',
+    'receiver_id': 'r',
+    'reader_id': 'rd',
+    'user_id': 'ui',
+    'user_ids': 'us',
+    'timestamp': 'ts',
+    'unread_count': 'n',
+    'last_read_message_id': 'lr',
+    'is_typing': 'ty',
+    'status': 'st',
+    'online': 'o',
+    'error': 'e',
+    'frame': 'f',
+    'retry_after': 'ra',
+    'room': 'rm',
+    'title': 'ti',
+    'seq': 'sq',
+    'events': 'ev',
+    'client_id': 'ci',
+}
+CODES = {code: field for field, code in FIELDS.items()}
+
+
+def rename(data, names):
+    """
+    Renames the keys of a frame, and of any frames batched inside it.
+    """
+    return {
+        names.get(key, key): [rename(item, names) for item in value] if is_batch(value) else value
+        for key, value in data.items()
+    }
+
+
+def is_batch(value):
+    return isinstance(value, list) and bool(value) and isinstance(value[0], dict)
+
+
+class JSONCodec:
+    subprotocol = JSON
+
+    def encode(self, data):
+        """
+        Returns the keyword arguments for AsyncWebsocketConsumer.send.
+        """
+        return {'text_data': json.dumps(data)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        """
+        Parses a received frame. Raises ValueError if it is malformed.
+        """
+        data = json.loads(text_data if text_data is not None else bytes_data)
+        if not isinstance(data, dict):
+            raise ValueError('Expected an object')
+        return data
+
+
+class MessagePackCodec:
+    subprotocol = MSGPACK
+
+    def encode(self, data):
+        return {'bytes_data': msgpack.packb(rename(data, FIELDS))}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ValueError('Expected a binary frame')
+        try:
+            data = msgpack.unpackb(bytes_data)
+        except msgpack.UnpackException as e:
+            raise ValueError(str(e))
+        if not isinstance(data, dict):
+            raise ValueError('Expected a map')
+        return rename(data, CODES)
+
+
+CODECS = [MessagePackCodec(), JSONCodec()]
+
+
+def negotiate(subprotocols):
+    """
+    Picks the codec for a socket from the subprotocols its client offered,
+    preferring MessagePack. Returns (codec, subprotocol to accept or None).
+    """
+    for codec in CODECS:
+        if codec.subprotocol in subprotocols:
+            return codec, codec.subprotocol
+    return CODECS[-1], None
+
+
+def encode_frames(data):
+    """
+    Encodes a frame once in every wire format, so a group event can carry
+    it ready to send to each socket whatever format that socket speaks.
+    """
+    return {codec.subprotocol: codec.encode(data) for codec in CODECS}
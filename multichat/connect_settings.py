@@ -90,6 +90,10 @@ if all([
             'PASSWORD': os.getenv('PGPASSWORD'),
             'HOST': os.getenv('PGHOST'),
             'PORT': os.getenv('PGPORT'),
+            # Keep connections open between requests and consumer calls, and
+            # check they are still usable before reusing them
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
         }
     }
 else:
@@ -117,6 +121,77 @@ else:
         },
     }
 
+# Presence registry: sockets refresh their cache entry every flush, and
+# entries of workers that die expire after the heartbeat TTL
+PRESENCE_HEARTBEAT_TTL = int(os.getenv('PRESENCE_HEARTBEAT_TTL', 60))
+PRESENCE_FLUSH_INTERVAL = int(os.getenv('PRESENCE_FLUSH_INTERVAL', 5))
+# Presence is only fanned out to contacts and to users a socket subscribes to
+PRESENCE_MAX_SUBSCRIPTIONS = int(os.getenv('PRESENCE_MAX_SUBSCRIPTIONS', 500))
+# Most users one subscribe_presence frame may ask for; clients ask for the
+# sidebar users in view, not the whole list. Also the number of presence
+# groups a socket joins at once.
+PRESENCE_SUBSCRIBE_BATCH = int(os.getenv('PRESENCE_SUBSCRIBE_BATCH', 100))
+CONTACTS_CACHE_TTL = int(os.getenv('CONTACTS_CACHE_TTL', 3600))
+
+# User ids are resolved through a per-process LRU (kept briefly, as other
+# processes' saves only reach it on expiry) in front of the shared cache
+IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', 3600))
+IDENTITY_LOCAL_TTL = float(os.getenv('IDENTITY_LOCAL_TTL', 30))
+IDENTITY_LOCAL_SIZE = int(os.getenv('IDENTITY_LOCAL_SIZE', 10000))
+
+# Rooms are fanned out over this many channel layer groups each; room
+# settings are cached like identities
+ROOM_FANOUT_SHARDS = int(os.getenv('ROOM_FANOUT_SHARDS', 8))
+ROOM_CACHE_TTL = int(os.getenv('ROOM_CACHE_TTL', 3600))
+ROOM_LOCAL_TTL = float(os.getenv('ROOM_LOCAL_TTL', 30))
+
+# Typing indicators are forwarded at most once per TYPING_MIN_INTERVAL
+# seconds per pair, and switched off after TYPING_TTL seconds of silence
+TYPING_TTL = float(os.getenv('TYPING_TTL', 5))
+TYPING_MIN_INTERVAL = float(os.getenv('TYPING_MIN_INTERVAL', 1))
+
+# Message history is served in keyset-paginated pages
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_SIZE_MAX = 200
+# The newest HISTORY_CACHE_SIZE messages of each conversation are cached, so
+# opening a chat does not query them; entries expire after HISTORY_CACHE_TTL
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', 50))
+HISTORY_CACHE_TTL = int(os.getenv('HISTORY_CACHE_TTL', 3600))
+
+# On PostgreSQL messages are partitioned by month, and partition_messages
+# creates MESSAGE_PARTITIONS_AHEAD months in advance. archive_messages moves
+# months older than MESSAGE_ARCHIVE_AFTER_MONTHS into compressed segments of
+# up to MESSAGE_ARCHIVE_SEGMENT_SIZE messages each.
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv('MESSAGE_PARTITIONS_AHEAD', 3))
+MESSAGE_ARCHIVE_AFTER_MONTHS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_MONTHS', 12))
+MESSAGE_ARCHIVE_SEGMENT_SIZE = int(os.getenv('MESSAGE_ARCHIVE_SEGMENT_SIZE', 500))
+
+# Events sent to a user are numbered and kept for EVENT_LOG_TTL seconds, so
+# a client that reconnects gets up to EVENT_LOG_SIZE missed events replayed
+EVENT_LOG_TTL = int(os.getenv('EVENT_LOG_TTL', 300))
+EVENT_LOG_SIZE = int(os.getenv('EVENT_LOG_SIZE', 200))
+
+# Messages are written in batches of up to MESSAGE_BATCH_SIZE, collected for
+# MESSAGE_BATCH_INTERVAL seconds. With MESSAGE_DURABILITY = 'commit' messages
+# are delivered once saved; 'async' delivers first and saves in the background,
+# so messages still in a batch are lost if the worker dies.
+MESSAGE_BATCH_SIZE = int(os.getenv('MESSAGE_BATCH_SIZE', 100))
+MESSAGE_BATCH_INTERVAL = float(os.getenv('MESSAGE_BATCH_INTERVAL', 0.01))
+MESSAGE_DURABILITY = os.getenv('MESSAGE_DURABILITY', 'commit')
+
+# Prometheus metrics of each worker process are served by the ASGI app here
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+
+# ORM calls from consumers run on a pool of this many threads, each holding
+# one persistent connection; 0 uses Channels' single database thread
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 8))
+
+# Connect attempts are rate limited across workers with a token bucket in
+# this Redis; unset, each worker keeps its own buckets. Limits are
+# (burst, period in seconds) by name, see connect1.ratelimit.DEFAULT_LIMITS.
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL')
+RATE_LIMITS = {}
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -88,6 +88,10 @@ if all([PGDATABASE, PGHOST, PGPORT, PGUSER, PGPASSWORD]):
             'PASSWORD': PGPASSWORD,
             'HOST': PGHOST,
             'PORT': PGPORT,
+            # Keep connections open between requests and consumer calls, and
+            # check they are still usable before reusing them
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
         }
     }
 else:
@@ -105,6 +109,14 @@ CHANNEL_LAYERS = {
     },
 }
 
+# ORM calls from consumers run on a pool of this many threads, each holding
+# one persistent connection; 0 uses Channels' single database thread
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 8))
+
+# Connect attempts are rate limited across workers with a token bucket in
+# this Redis; unset, each worker keeps its own buckets
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL')
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -1,24 +1,22 @@
-from channels.db import database_sync_to_async
+from connect1.exceptions import ClientError
+from connect1.rooms import rooms
 
-from .exceptions import ClientError
-from .models import Room
 
-
-# This decorator turns this function from a synchronous function into an async one
-# we can call from our async consumers, that handles Django DBs correctly.
-# For more, see http://channels.readthedocs.io/en/latest/topics/databases.html
-@database_sync_to_async
-def get_room_or_error(room_id, user):
+async def get_room_or_error(room_id, user):
     """
     Tries to fetch a room for the user, checking permissions along the way.
+    The room comes from the room cache, so this does not query the database
+    for rooms that were looked up recently.
     """
     # Check if the user is logged in
     if not user.is_authenticated:
         raise ClientError("USER_HAS_TO_LOGIN")
     # Find the room they requested (by ID)
     try:
-        room = Room.objects.get(pk=room_id)
-    except Room.DoesNotExist:
+        room = await rooms.get(room_id)
+    except (TypeError, ValueError):
+        room = None
+    if room is None:
         raise ClientError("ROOM_INVALID")
     # Check permissions
     if room.staff_only and not user.is_staff:
@@ -1,5 +1,8 @@
 // Global WebSocket connection
 let chatSocket;
+// Numbered events handled so far, for resuming after a reconnect
+const eventStream = new EventStream();
+let reconnectAttempts = 0;
 // Current selected user for chatting
 let selectedUser = null;
 // Current user's ID and username
@@ -9,6 +12,21 @@ let currentUsername;
 let typingTimer;
 // Status toast instance
 let statusToast;
+// Cursor for the next page of older messages (null when there are none)
+let olderMessagesCursor = null;
+let loadingOlderMessages = false;
+let olderMessagesObserver = null;
+// ETag of the user list currently rendered in the sidebar
+let userListETag = null;
+// Most users subscribe_presence asks for at once (PRESENCE_SUBSCRIBE_BATCH)
+const PRESENCE_BATCH_SIZE = 100;
+// Sidebar users in view, and those whose presence we asked for
+const presenceVisible = new Set();
+let presenceRequested = new Set();
+// Batches sent and not answered yet, oldest first
+let presenceInFlight = [];
+let presenceObserver = null;
+let presenceTimer = null;
 
 /**
  * Initialize the chat application
@@ -25,6 +43,9 @@ function initChat(userId, username) {
     // Initialize event listeners
     initEventListeners();
     
+    // Follow the presence of sidebar users as they come into view
+    observePresence();
+    
     // Initialize Bootstrap toast
     statusToast = new bootstrap.Toast(document.getElementById('statusToast'));
     
@@ -45,35 +66,44 @@ function connectWebSocket() {
     const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const wsUrl = `${wsProtocol}//${window.location.host}/ws/chat/`;
     
-    chatSocket = new WebSocket(wsUrl);
+    // Ask for the events missed since the last one we handled
+    const socket = Wire.connect(eventStream.url(wsUrl));
+    chatSocket = socket;
     
     // Connection opened
     chatSocket.onopen = function(e) {
         console.log("WebSocket connection established");
+        reconnectAttempts = 0;
         
-        // For reconnection cases, reload the user list
-        updateUserList();
-        
-        // If there was a selected user, reopen that conversation
-        if (selectedUser) {
-            loadUserMessages(selectedUser.id);
-        }
+        // A new socket follows nobody yet
+        presenceRequested = new Set();
+        presenceInFlight = [];
+        schedulePresenceSubscription(0);
     };
     
     // Listen for messages
     chatSocket.onmessage = function(e) {
-        const data = JSON.parse(e.data);
-        handleWebSocketMessage(data);
+        const data = Wire.decode(e.data);
+        if (eventStream.accept(data)) {
+            handleWebSocketMessage(data);
+        }
     };
     
     // Connection closed
     chatSocket.onclose = function(e) {
         console.log("WebSocket connection closed");
         
-        // Attempt to reconnect after 3 seconds
+        // Only the current socket reconnects, not one we replaced
+        if (socket !== chatSocket) {
+            return;
+        }
+        
+        // Back off exponentially, with jitter so clients do not all return at once
+        reconnectAttempts += 1;
+        const backoff = Math.min(30, Math.pow(2, reconnectAttempts)) * 1000;
         setTimeout(function() {
             connectWebSocket();
-        }, 3000);
+        }, backoff / 2 + Math.random() * backoff / 2);
     };
     
     // Connection error
@@ -94,6 +124,9 @@ function handleWebSocketMessage(data) {
         case 'message_sent':
             handleMessageSent(data);
             break;
+        case 'message_failed':
+            showErrorMessage('Your message could not be sent. Please try again.');
+            break;
         case 'messages_read':
             handleMessagesRead(data);
             break;
@@ -103,8 +136,58 @@ function handleWebSocketMessage(data) {
         case 'user_status':
             handleUserStatus(data);
             break;
+        case 'presence_state':
+            handlePresenceState(data);
+            break;
+        case 'unread_count':
+            handleUnreadCount(data);
+            break;
+        case 'resume':
+            handleResume(data);
+            break;
+        case 'resync':
+            handleResync(data);
+            break;
+        case 'rate_limited':
+            if (data.frame === 'subscribe_presence') {
+                handlePresenceRateLimited(data);
+            } else {
+                showErrorMessage(`You are sending messages too fast. Try again in ${data.retry_after}s.`);
+            }
+            break;
         default:
-            console.log("Unknown message type:", data.type);
+            if (data.error === 'MESSAGE_NOT_SAVED') {
+                showErrorMessage('Your message could not be sent. Please try again.');
+            } else if (data.error) {
+                console.error("Server error:", data.error);
+            } else {
+                console.log("Unknown message type:", data.type);
+            }
+    }
+}
+
+/**
+ * Handle the events missed while the socket was disconnected
+ * @param {object} data - The batch of events
+ */
+function handleResume(data) {
+    data.events.forEach(event => {
+        if (eventStream.accept(event)) {
+            handleWebSocketMessage(event);
+        }
+    });
+    eventStream.reset(data.seq);
+}
+
+/**
+ * Reload what the server could not replay after a long disconnect
+ * @param {object} data - The resync notice
+ */
+function handleResync(data) {
+    eventStream.reset(data.seq);
+    updateUserList();
+    if (selectedUser) {
+        loadUserMessages(selectedUser.id);
     }
 }
 
@@ -126,8 +209,22 @@ function handleChatMessage(data) {
         sendReadReceipt(data.sender_id);
     }
     
-    // Update the user list to show unread count
-    updateUserList();
+    // The server sends the new unread count along with the message
+    const userItem = document.querySelector(`.user-item[data-user-id="${data.sender_id}"]`);
+    if (userItem) {
+        if (!selectedUser || data.sender_id !== selectedUser.id) {
+            let unreadCount = data.unread_count;
+            if (unreadCount === null) {
+                // Delivered before it was saved; count it ourselves
+                const unreadCountElement = userItem.querySelector('.unread-count');
+                unreadCount = (unreadCountElement ? parseInt(unreadCountElement.textContent) : 0) + 1;
+            }
+            setUnreadBadge(userItem, unreadCount);
+        }
+    } else {
+        // First message from this user; fetch the list to add them
+        updateUserList();
+    }
     
     // Play notification sound if the message is not from the selected user
     if (!selectedUser || data.sender_id !== selectedUser.id) {
@@ -164,9 +261,6 @@ function handleMessageSent(data) {
             });
         }
     }
-    
-    // Update the user list to show the latest message
-    updateUserList();
 }
 
 /**
@@ -178,6 +272,11 @@ function handleMessagesRead(data) {
     if (selectedUser && data.reader_id === selectedUser.id) {
         const sentMessages = document.querySelectorAll('.message.sent:not(.read)');
         sentMessages.forEach(message => {
+            // Only messages up to the reader's cursor have been read
+            const messageId = parseInt(message.dataset.messageId);
+            if (data.last_read_message_id && !(messageId <= data.last_read_message_id)) {
+                return;
+            }
             message.classList.add('read');
             
             // Add read indicator
@@ -260,6 +359,101 @@ function handleUserStatus(data) {
     }
 }
 
+/**
+ * Handle the current online status of users we subscribed to
+ * @param {object} data - The presence data
+ */
+function handlePresenceState(data) {
+    presenceInFlight.shift();
+    const online = new Set(data.online);
+    // Only the users the server now follows for us; it may have refused
+    // some once at its limit
+    data.user_ids.forEach(userId => {
+        const userItem = document.querySelector(`.user-item[data-user-id="${userId}"]`);
+        const statusIndicator = userItem && userItem.querySelector('.status-indicator');
+        if (statusIndicator) {
+            statusIndicator.classList.toggle('online', online.has(userId));
+            statusIndicator.classList.toggle('offline', !online.has(userId));
+        }
+    });
+}
+
+/**
+ * Ask again for a batch of presence subscriptions that was rate limited
+ * @param {object} data - The rate limit data
+ */
+function handlePresenceRateLimited(data) {
+    const batch = presenceInFlight.shift() || [];
+    batch.forEach(userId => presenceRequested.delete(userId));
+    schedulePresenceSubscription(data.retry_after * 1000);
+}
+
+/**
+ * Handle a change of the unread count of a conversation
+ * @param {object} data - The unread count data
+ */
+function handleUnreadCount(data) {
+    const userItem = document.querySelector(`.user-item[data-user-id="${data.user_id}"]`);
+    if (userItem) {
+        setUnreadBadge(userItem, data.unread_count);
+    }
+}
+
+/**
+ * Watch the sidebar users so that presence is only subscribed to for
+ * those scrolled into view, not for the whole list. The server already
+ * sends updates for users we have talked to.
+ */
+function observePresence() {
+    if (!presenceObserver) {
+        presenceObserver = new IntersectionObserver(entries => {
+            entries.forEach(entry => {
+                const userId = parseInt(entry.target.dataset.userId);
+                if (entry.isIntersecting) {
+                    presenceVisible.add(userId);
+                } else {
+                    presenceVisible.delete(userId);
+                }
+            });
+            schedulePresenceSubscription(500);
+        });
+    }
+    // Observing an element twice has no effect
+    document.querySelectorAll('.user-item').forEach(item => presenceObserver.observe(item));
+}
+
+/**
+ * Subscribe after a delay, so a scroll through the sidebar is one batch
+ * @param {number} delay - Milliseconds to wait
+ */
+function schedulePresenceSubscription(delay) {
+    clearTimeout(presenceTimer);
+    presenceTimer = setTimeout(subscribePresence, delay);
+}
+
+/**
+ * Subscribe to presence updates of the visible users not asked for yet
+ */
+function subscribePresence() {
+    if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    const userIds = Array.from(presenceVisible)
+        .filter(userId => !presenceRequested.has(userId))
+        .slice(0, PRESENCE_BATCH_SIZE);
+    if (userIds.length === 0) {
+        return;
+    }
+    userIds.forEach(userId => presenceRequested.add(userId));
+    presenceInFlight.push(userIds);
+    chatSocket.send(Wire.encode(chatSocket, {
+        type: 'subscribe_presence',
+        user_ids: userIds
+    }));
+    // More may be in view than one batch holds
+    schedulePresenceSubscription(500);
+}
+
 /**
  * Initialize all event listeners
  */
@@ -288,15 +482,19 @@ function initEventListeners() {
     document.getElementById('messageInput').addEventListener('input', function() {
         document.getElementById('sendMessage').disabled = this.value.trim() === '';
         
-        // Send typing indicator
+        // Send typing indicator, once when typing starts rather than on
+        // every keystroke
         if (selectedUser) {
-            sendTypingStatus(true);
+            if (!typingTimer) {
+                sendTypingStatus(true);
+            }
             
             // Clear existing timer
             clearTimeout(typingTimer);
             
             // Set new timer to stop typing indicator after 2 seconds of inactivity
             typingTimer = setTimeout(function() {
+                typingTimer = null;
                 sendTypingStatus(false);
             }, 2000);
         }
@@ -407,6 +605,9 @@ function loadUserMessages(userId) {
                 });
             }
             
+            // Older history is fetched page by page as the user scrolls to it
+            watchOlderMessages(data.before);
+            
             // Send read receipt for unread messages
             sendReadReceipt(userId);
             
@@ -419,6 +620,74 @@ function loadUserMessages(userId) {
         });
 }
 
+/**
+ * Load the next page of older messages when the end of the history comes into view
+ * @param {string|null} cursor - Cursor returned by the last page, null if there is no older page
+ */
+function watchOlderMessages(cursor) {
+    olderMessagesCursor = cursor;
+    
+    if (olderMessagesObserver) {
+        olderMessagesObserver.disconnect();
+        olderMessagesObserver = null;
+    }
+    const oldSentinel = document.getElementById('olderMessagesSentinel');
+    if (oldSentinel) {
+        oldSentinel.remove();
+    }
+    if (!cursor) {
+        return;
+    }
+    
+    // Messages are shown newest first, so older ones go after the last one
+    const sentinel = document.createElement('div');
+    sentinel.id = 'olderMessagesSentinel';
+    sentinel.className = 'text-center p-2 text-muted';
+    sentinel.innerHTML = '<i class="fas fa-spinner fa-spin"></i>';
+    document.getElementById('messages').appendChild(sentinel);
+    
+    olderMessagesObserver = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadOlderMessages();
+        }
+    }, { root: document.getElementById('messagesContainer') });
+    olderMessagesObserver.observe(sentinel);
+}
+
+/**
+ * Fetch the page of messages before the oldest one shown
+ */
+function loadOlderMessages() {
+    if (!olderMessagesCursor || loadingOlderMessages || !selectedUser) {
+        return;
+    }
+    loadingOlderMessages = true;
+    const userId = selectedUser.id;
+    
+    fetch(`/get_messages/${userId}/?before=${encodeURIComponent(olderMessagesCursor)}`)
+        .then(response => response.json())
+        .then(data => {
+            // Ignore the page if another conversation was opened meanwhile
+            if (!selectedUser || selectedUser.id !== userId) {
+                return;
+            }
+            
+            // The page is oldest first; insert newest first above the sentinel
+            const sentinel = document.getElementById('olderMessagesSentinel');
+            data.messages.slice().reverse().forEach(message => {
+                appendMessage(message, sentinel);
+            });
+            
+            watchOlderMessages(data.before);
+        })
+        .catch(error => {
+            console.error('Error loading older messages:', error);
+        })
+        .finally(() => {
+            loadingOlderMessages = false;
+        });
+}
+
 /**
  * Send a message to the selected user
  */
@@ -444,7 +713,7 @@ function sendMessage() {
     
     // Send the message through WebSocket
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify({
+        chatSocket.send(Wire.encode(chatSocket, {
             type: 'chat_message',
             message: messageContent,
             receiver_id: selectedUser.id
@@ -465,6 +734,8 @@ function sendMessage() {
     document.getElementById('sendMessage').disabled = true;
     
     // Stop typing indicator
+    clearTimeout(typingTimer);
+    typingTimer = null;
     sendTypingStatus(false);
 }
 
@@ -474,7 +745,7 @@ function sendMessage() {
  */
 function sendReadReceipt(senderId) {
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify({
+        chatSocket.send(Wire.encode(chatSocket, {
             type: 'read_messages',
             sender_id: senderId
         }));
@@ -487,7 +758,7 @@ function sendReadReceipt(senderId) {
  */
 function sendTypingStatus(isTyping) {
     if (selectedUser && chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify({
+        chatSocket.send(Wire.encode(chatSocket, {
             type: 'typing_status',
             receiver_id: selectedUser.id,
             is_typing: isTyping
@@ -498,8 +769,9 @@ function sendTypingStatus(isTyping) {
 /**
  * Append a message to the chat
  * @param {object} message - The message object
+ * @param {Element} [before] - Insert before this element instead of at the top
  */
-function appendMessage(message) {
+function appendMessage(message, before) {
     const messagesContainer = document.getElementById('messages');
     
     // Create message element
@@ -524,7 +796,11 @@ function appendMessage(message) {
     `;
     
     // Add to the DOM
-    messagesContainer.prepend(messageElement);
+    if (before) {
+        messagesContainer.insertBefore(messageElement, before);
+    } else {
+        messagesContainer.prepend(messageElement);
+    }
 }
 
 /**
@@ -572,9 +848,21 @@ function formatTime(date) {
  * Update the user list
  */
 function updateUserList() {
-    fetch('/get_users/')
-        .then(response => response.json())
+    // Always revalidate; the server answers 304 when nothing changed
+    fetch('/get_users/', { cache: 'no-cache' })
+        .then(response => {
+            const etag = response.headers.get('ETag');
+            if (etag && etag === userListETag) {
+                return null;
+            }
+            userListETag = etag;
+            return response.json();
+        })
         .then(data => {
+            if (!data) {
+                return;
+            }
+            
             const userListContent = document.getElementById('userListContent');
             
             // Store the current scroll position
@@ -599,31 +887,7 @@ function updateUserList() {
                     }
                     
                     // Update unread count
-                    let unreadCountElement = userItem.querySelector('.unread-count');
-                    if (user.unread_count > 0) {
-                        if (unreadCountElement) {
-                            unreadCountElement.textContent = user.unread_count;
-                        } else {
-                            // Create unread count element
-                            unreadCountElement = document.createElement('div');
-                            unreadCountElement.className = 'unread-count';
-                            unreadCountElement.textContent = user.unread_count;
-                            userItem.querySelector('.user-meta').appendChild(unreadCountElement);
-                        }
-                        
-                        // Add has-unread class if not the selected user
-                        if (!selectedUser || user.id !== selectedUser.id) {
-                            userItem.classList.add('has-unread');
-                        }
-                    } else {
-                        // Remove unread count element
-                        if (unreadCountElement) {
-                            unreadCountElement.remove();
-                        }
-                        
-                        // Remove has-unread class
-                        userItem.classList.remove('has-unread');
-                    }
+                    setUnreadBadge(userItem, user.unread_count);
                 } else {
                     // Create new user item
                     userItem = document.createElement('div');
@@ -658,12 +922,49 @@ function updateUserList() {
             
             // Restore scroll position
             userListContent.scrollTop = scrollTop;
+            
+            // Follow the presence of new sidebar users once they are in view
+            observePresence();
         })
         .catch(error => {
             console.error('Error updating user list:', error);
         });
 }
 
+/**
+ * Show, update or remove the unread badge of a sidebar user
+ * @param {HTMLElement} userItem - The sidebar user item
+ * @param {number} count - The unread count
+ */
+function setUnreadBadge(userItem, count) {
+    let unreadCountElement = userItem.querySelector('.unread-count');
+    if (count > 0) {
+        if (unreadCountElement) {
+            unreadCountElement.textContent = count;
+        } else {
+            // Create unread count element
+            unreadCountElement = document.createElement('div');
+            unreadCountElement.className = 'unread-count';
+            unreadCountElement.textContent = count;
+            userItem.querySelector('.user-meta').appendChild(unreadCountElement);
+        }
+        
+        // Add has-unread class if not the selected user
+        const userId = parseInt(userItem.dataset.userId);
+        if (!selectedUser || userId !== selectedUser.id) {
+            userItem.classList.add('has-unread');
+        }
+    } else {
+        // Remove unread count element
+        if (unreadCountElement) {
+            unreadCountElement.remove();
+        }
+        
+        // Remove has-unread class
+        userItem.classList.remove('has-unread');
+    }
+}
+
 /**
  * Show an error message in the chat
  * @param {string} message - The error message
@@ -0,0 +1,58 @@
+/**
+ * Numbered event stream of the chat socket.
+ *
+ * Events the server sends to a user carry a "seq" number (see
+ * connect1/events.py). The stream remembers up to which number every event
+ * has been handled, so a reconnecting socket can ask for just the events
+ * it missed, and an event that arrives both live and replayed is handled
+ * once.
+ */
+class EventStream {
+    constructor() {
+        // Every numbered event up to here has been handled
+        this.lastSeq = null;
+        // Handled events above lastSeq, which arrived out of order
+        this.handled = new Set();
+    }
+
+    /**
+     * The socket URL, asking for the events missed since the last one handled
+     * @param {string} url - The socket URL
+     */
+    url(url) {
+        return this.lastSeq === null ? url : `${url}?last_seq=${this.lastSeq}`;
+    }
+
+    /**
+     * Whether an event should be handled, i.e. it has not been already
+     * @param {object} data - The event
+     */
+    accept(data) {
+        // Typing and presence events are not numbered
+        if (data.seq === undefined || this.lastSeq === null) {
+            return true;
+        }
+        if (data.seq <= this.lastSeq || this.handled.has(data.seq)) {
+            return false;
+        }
+        this.handled.add(data.seq);
+        while (this.handled.has(this.lastSeq + 1)) {
+            this.lastSeq += 1;
+            this.handled.delete(this.lastSeq);
+        }
+        // Do not wait forever for an event that is not coming
+        if (this.handled.size > 100) {
+            this.reset(Math.max(...this.handled));
+        }
+        return true;
+    }
+
+    /**
+     * Continue the stream from a number the server sent
+     * @param {number} seq - The number of the last event sent
+     */
+    reset(seq) {
+        this.lastSeq = seq;
+        this.handled.clear();
+    }
+}
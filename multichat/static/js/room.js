@@ -5,6 +5,10 @@ let chatUser = {};
 let typingTimer;
 let statusToast;
 let messageQueue = [];
+// Sent messages not confirmed yet, by client_id
+const unconfirmedMessages = new Map();
+// Numbered events handled so far, for resuming after a reconnect
+const eventStream = new EventStream();
 let reconnectAttempts = 0;
 let reconnectInterval = null;
 
@@ -68,7 +72,8 @@ function connectWebSocket() {
     const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const wsUrl = `${wsProtocol}//${window.location.host}/ws/chat/`;
     
-    chatSocket = new WebSocket(wsUrl);
+    // Ask for the events missed since the last one we handled
+    chatSocket = Wire.connect(eventStream.url(wsUrl));
     
     // Connection opened
     chatSocket.onopen = function(e) {
@@ -84,19 +89,27 @@ function connectWebSocket() {
         // Send any queued messages
         if (messageQueue.length > 0) {
             messageQueue.forEach(message => {
-                chatSocket.send(JSON.stringify(message));
+                chatSocket.send(Wire.encode(chatSocket, message));
             });
             messageQueue = [];
         }
         
+        // Follow the chat user's presence
+        chatSocket.send(Wire.encode(chatSocket, {
+            type: 'subscribe_presence',
+            user_ids: [chatUser.id]
+        }));
+        
         // Mark messages as read
         markMessagesAsRead();
     };
     
     // Listen for messages
     chatSocket.onmessage = function(e) {
-        const data = JSON.parse(e.data);
-        handleWebSocketMessage(data);
+        const data = Wire.decode(e.data);
+        if (eventStream.accept(data)) {
+            handleWebSocketMessage(data);
+        }
     };
     
     // Connection closed
@@ -256,7 +269,7 @@ function handleWebSocketMessage(data) {
         case 'messages_read':
             // The other user has read our messages
             if (data.reader_id === chatUser.id) {
-                markMessagesAsReadInUI();
+                markMessagesAsReadInUI(data.last_read_message_id);
             }
             break;
             
@@ -273,6 +286,37 @@ function handleWebSocketMessage(data) {
                 updateUserStatus(data.status === 'online');
             }
             break;
+            
+        case 'presence_state':
+            // Current status of the chat user, sent after subscribing
+            if (data.online.includes(chatUser.id) !== chatUser.isOnline) {
+                updateUserStatus(!chatUser.isOnline);
+            }
+            break;
+
+        case 'resume':
+            // Events missed while disconnected; then resend what they did not confirm
+            data.events.forEach(event => {
+                if (eventStream.accept(event)) {
+                    handleWebSocketMessage(event);
+                }
+            });
+            eventStream.reset(data.seq);
+            resendUnconfirmedMessages();
+            break;
+            
+        case 'resync':
+            // Too long gone to replay; the server ignores resent messages it already has
+            eventStream.reset(data.seq);
+            resendUnconfirmedMessages();
+            break;
+            
+        case 'rate_limited':
+            // The server dropped our last message
+            if (data.frame === 'chat_message') {
+                console.warn(`Sending too fast, message dropped. Retry in ${data.retry_after}s`);
+            }
+            break;
     }
 }
 
@@ -316,7 +360,8 @@ function handleNewMessage(data) {
  * @param {Object} data - The message data
  */
 function updateTempMessage(data) {
-    const tempMessage = document.querySelector(`.message[data-temp-id="${data.message_id}"]`);
+    unconfirmedMessages.delete(data.client_id);
+    const tempMessage = document.querySelector(`.message[data-temp-id="${data.client_id}"]`);
     
     if (tempMessage) {
         // Update the message with confirmed ID
@@ -378,7 +423,7 @@ function updateUserStatus(isOnline) {
  */
 function markMessagesAsRead() {
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify({
+        chatSocket.send(Wire.encode(chatSocket, {
             type: 'read_messages',
             sender_id: chatUser.id
         }));
@@ -393,11 +438,16 @@ function markMessagesAsRead() {
 
 /**
  * Mark messages as read in the UI
+ * @param {number} lastReadId - The reader's read cursor; messages up to it are read
  */
-function markMessagesAsReadInUI() {
+function markMessagesAsReadInUI(lastReadId) {
     const sentMessages = document.querySelectorAll('.message.sent:not(.read)');
     
     sentMessages.forEach(message => {
+        const messageId = parseInt(message.dataset.messageId);
+        if (lastReadId && !(messageId <= lastReadId)) {
+            return;
+        }
         message.classList.add('read');
         
         // Add read indicator if not already present
@@ -419,8 +469,8 @@ function sendMessage() {
     
     if (!messageContent) return;
     
-    // Generate a temporary ID for the message
-    const tempId = Date.now();
+    // Generate a temporary ID for the message, also sent as its client_id
+    const tempId = `${currentUser.id}-${Date.now()}`;
     
     // Add message to UI immediately
     addMessageToUI(messageContent, tempId);
@@ -439,11 +489,14 @@ function sendMessage() {
     const messageData = {
         type: 'chat_message',
         message: messageContent,
-        receiver_id: chatUser.id
+        receiver_id: chatUser.id,
+        // Lets the server drop the message if we send it again after a reconnect
+        client_id: tempId
     };
+    unconfirmedMessages.set(messageData.client_id, messageData);
     
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify(messageData));
+        chatSocket.send(Wire.encode(chatSocket, messageData));
     } else {
         // Queue message for when connection is restored
         messageQueue.push(messageData);
@@ -452,10 +505,19 @@ function sendMessage() {
     }
 }
 
+/**
+ * Send again the messages whose confirmation never arrived
+ */
+function resendUnconfirmedMessages() {
+    unconfirmedMessages.forEach(messageData => {
+        chatSocket.send(Wire.encode(chatSocket, messageData));
+    });
+}
+
 /**
  * Add a sent message to the UI
  * @param {string} content - The message content
- * @param {number} tempId - Temporary message ID
+ * @param {string} tempId - Temporary message ID
  */
 function addMessageToUI(content, tempId) {
     const messagesContainer = document.getElementById('messagesContainer');
@@ -491,7 +553,7 @@ function addMessageToUI(content, tempId) {
  */
 function sendTypingStatus(isTyping) {
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify({
+        chatSocket.send(Wire.encode(chatSocket, {
             type: 'typing_status',
             receiver_id: chatUser.id,
             is_typing: isTyping
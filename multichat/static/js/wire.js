@@ -0,0 +1,242 @@
+/**
+ * Wire formats of the chat socket.
+ *
+ * The socket offers the "chat.msgpack" and "chat.json" subprotocols and the
+ * server picks one. MessagePack frames are binary maps keyed by the short
+ * codes below (a copy of FIELDS in connect1/wire.py); JSON frames use the
+ * full field names.
+ */
+const Wire = (function() {
+    const MSGPACK = 'chat.msgpack';
+    const JSON_PROTOCOL = 'chat.json';
+
+    const FIELDS = {
+        type: 't',
+        message: 'm',
+        message_id: 'i',
+        sender_id: 's',
+        sender_username: 'u',
+        receiver_id: 'r',
+        reader_id: 'rd',
+        user_id: 'ui',
+        user_ids: 'us',
+        timestamp: 'ts',
+        unread_count: 'n',
+        last_read_message_id: 'lr',
+        is_typing: 'ty',
+        status: 'st',
+        online: 'o',
+        error: 'e',
+        frame: 'f',
+        retry_after: 'ra',
+        room: 'rm',
+        title: 'ti',
+        seq: 'sq',
+        events: 'ev',
+        client_id: 'ci'
+    };
+    const CODES = {};
+    Object.keys(FIELDS).forEach(field => {
+        CODES[FIELDS[field]] = field;
+    });
+
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    /**
+     * Encode a value as MessagePack (the subset used by the chat frames)
+     * @param {*} value - The value to encode
+     * @param {number[]} out - Bytes written so far
+     */
+    function pack(value, out) {
+        if (value === null || value === undefined) {
+            out.push(0xc0);
+        } else if (value === false) {
+            out.push(0xc2);
+        } else if (value === true) {
+            out.push(0xc3);
+        } else if (typeof value === 'number') {
+            packNumber(value, out);
+        } else if (typeof value === 'string') {
+            const bytes = textEncoder.encode(value);
+            packLength(bytes.length, 0xa0, 31, 0xd9, 0xda, 0xdb, out);
+            bytes.forEach(b => out.push(b));
+        } else if (Array.isArray(value)) {
+            packLength(value.length, 0x90, 15, null, 0xdc, 0xdd, out);
+            value.forEach(item => pack(item, out));
+        } else {
+            const keys = Object.keys(value);
+            packLength(keys.length, 0x80, 15, null, 0xde, 0xdf, out);
+            keys.forEach(key => {
+                pack(key, out);
+                pack(value[key], out);
+            });
+        }
+    }
+
+    function packLength(length, fixPrefix, fixMax, prefix8, prefix16, prefix32, out) {
+        if (length <= fixMax) {
+            out.push(fixPrefix | length);
+        } else if (prefix8 !== null && length < 0x100) {
+            out.push(prefix8, length);
+        } else if (length < 0x10000) {
+            out.push(prefix16, length >> 8, length & 0xff);
+        } else {
+            out.push(prefix32, (length >>> 24) & 0xff, (length >> 16) & 0xff, (length >> 8) & 0xff, length & 0xff);
+        }
+    }
+
+    function packNumber(value, out) {
+        if (Number.isInteger(value) && value >= 0 && value < 0x80) {
+            out.push(value);
+        } else if (Number.isInteger(value) && value < 0 && value >= -32) {
+            out.push(value & 0xff);
+        } else if (Number.isInteger(value) && value >= -0x80000000 && value < 0x100000000) {
+            const view = new DataView(new ArrayBuffer(5));
+            if (value >= 0) {
+                view.setUint8(0, 0xce);
+                view.setUint32(1, value);
+            } else {
+                view.setUint8(0, 0xd2);
+                view.setInt32(1, value);
+            }
+            new Uint8Array(view.buffer).forEach(b => out.push(b));
+        } else {
+            const view = new DataView(new ArrayBuffer(9));
+            view.setUint8(0, 0xcb);
+            view.setFloat64(1, value);
+            new Uint8Array(view.buffer).forEach(b => out.push(b));
+        }
+    }
+
+    /**
+     * Decode one MessagePack value
+     * @param {DataView} view - The frame
+     * @param {object} pos - Read position, advanced past the value
+     */
+    function unpack(view, pos) {
+        const byte = view.getUint8(pos.offset++);
+        if (byte < 0x80) {
+            return byte;
+        } else if (byte < 0x90) {
+            return unpackMap(view, pos, byte & 0x0f);
+        } else if (byte < 0xa0) {
+            return unpackArray(view, pos, byte & 0x0f);
+        } else if (byte < 0xc0) {
+            return unpackString(view, pos, byte & 0x1f);
+        } else if (byte >= 0xe0) {
+            return byte - 0x100;
+        }
+        switch (byte) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return unpackBytes(view, pos, read(view, pos, 'getUint8', 1));
+            case 0xc5: return unpackBytes(view, pos, read(view, pos, 'getUint16', 2));
+            case 0xc6: return unpackBytes(view, pos, read(view, pos, 'getUint32', 4));
+            case 0xca: return read(view, pos, 'getFloat32', 4);
+            case 0xcb: return read(view, pos, 'getFloat64', 8);
+            case 0xcc: return read(view, pos, 'getUint8', 1);
+            case 0xcd: return read(view, pos, 'getUint16', 2);
+            case 0xce: return read(view, pos, 'getUint32', 4);
+            case 0xcf: return Number(read(view, pos, 'getBigUint64', 8));
+            case 0xd0: return read(view, pos, 'getInt8', 1);
+            case 0xd1: return read(view, pos, 'getInt16', 2);
+            case 0xd2: return read(view, pos, 'getInt32', 4);
+            case 0xd3: return Number(read(view, pos, 'getBigInt64', 8));
+            case 0xd9: return unpackString(view, pos, read(view, pos, 'getUint8', 1));
+            case 0xda: return unpackString(view, pos, read(view, pos, 'getUint16', 2));
+            case 0xdb: return unpackString(view, pos, read(view, pos, 'getUint32', 4));
+            case 0xdc: return unpackArray(view, pos, read(view, pos, 'getUint16', 2));
+            case 0xdd: return unpackArray(view, pos, read(view, pos, 'getUint32', 4));
+            case 0xde: return unpackMap(view, pos, read(view, pos, 'getUint16', 2));
+            case 0xdf: return unpackMap(view, pos, read(view, pos, 'getUint32', 4));
+            default: throw new Error(`Unsupported MessagePack type 0x${byte.toString(16)}`);
+        }
+    }
+
+    function read(view, pos, getter, size) {
+        const value = view[getter](pos.offset);
+        pos.offset += size;
+        return value;
+    }
+
+    function unpackBytes(view, pos, length) {
+        const bytes = new Uint8Array(view.buffer, view.byteOffset + pos.offset, length);
+        pos.offset += length;
+        return bytes;
+    }
+
+    function unpackString(view, pos, length) {
+        return textDecoder.decode(unpackBytes(view, pos, length));
+    }
+
+    function unpackArray(view, pos, length) {
+        const items = [];
+        for (let i = 0; i < length; i++) {
+            items.push(unpack(view, pos));
+        }
+        return items;
+    }
+
+    function unpackMap(view, pos, length) {
+        const map = {};
+        for (let i = 0; i < length; i++) {
+            const key = unpack(view, pos);
+            map[key] = unpack(view, pos);
+        }
+        return map;
+    }
+
+    /**
+     * Open a chat socket offering both wire formats
+     * @param {string} url - The WebSocket URL
+     */
+    function connect(url) {
+        const socket = new WebSocket(url, [MSGPACK, JSON_PROTOCOL]);
+        socket.binaryType = 'arraybuffer';
+        return socket;
+    }
+
+    /**
+     * Rename the keys of a frame, and of any frames batched inside it
+     * @param {object} data - The frame
+     * @param {object} names - Key to new key
+     */
+    function rename(data, names) {
+        const renamed = {};
+        Object.keys(data).forEach(key => {
+            const value = data[key];
+            const isBatch = Array.isArray(value) && value.length > 0 && typeof value[0] === 'object';
+            renamed[names[key] || key] = isBatch ? value.map(item => rename(item, names)) : value;
+        });
+        return renamed;
+    }
+
+    /**
+     * Encode a frame in the format negotiated for the socket
+     * @param {WebSocket} socket - The socket the frame is for
+     * @param {object} data - The frame
+     */
+    function encode(socket, data) {
+        if (socket.protocol !== MSGPACK) {
+            return JSON.stringify(data);
+        }
+        const out = [];
+        pack(rename(data, FIELDS), out);
+        return new Uint8Array(out);
+    }
+
+    /**
+     * Decode a received frame
+     * @param {string|ArrayBuffer} frame - The frame data
+     */
+    function decode(frame) {
+        if (typeof frame === 'string') {
+            return JSON.parse(frame);
+        }
+        return rename(unpack(new DataView(frame), { offset: 0 }), CODES);
+    }
+
+    return { connect: connect, encode: encode, decode: decode };
+})();
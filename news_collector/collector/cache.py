@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import requests
+from django.conf import settings
+
+from .http import client
+
+# A fetched page and the validators to revalidate it with
+Page = namedtuple('Page', ['body', 'etag', 'last_modified', 'fetched_at'])
+
+
+class PageCache:
+    """
+    Pages fetched by the collectors, by URL.
+
+    A page fetched less than NEWS_CACHE_TTL seconds ago is served without a
+    request. For NEWS_CACHE_STALE_TTL seconds after that it is still served
+    right away, while a refresh runs in the background. Older pages are
+    fetched again before being served. Refreshes send If-None-Match and
+    If-Modified-Since, so a site that has not changed answers 304 without
+    a body.
+
+    Pages are evicted least recently used first once their bodies take more
+    than NEWS_CACHE_MAX_BYTES. The sync view's threads and the async
+    consumer share the cache, so it is locked.
+    """
+
+    def __init__(self, ttl=None, stale_ttl=None, max_bytes=None):
+        self.ttl = ttl or getattr(settings, 'NEWS_CACHE_TTL', 60)
+        self.stale_ttl = stale_ttl or getattr(settings, 'NEWS_CACHE_STALE_TTL', 300)
+        self.max_bytes = max_bytes or getattr(settings, 'NEWS_CACHE_MAX_BYTES', 20 * 1024 * 1024)
+        self.pages = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # URLs being refreshed in the background
+        self.refreshing = set()
+        # Background refresh tasks, referenced until they finish
+        self.tasks = set()
+
+    def get(self, url):
+        with self.lock:
+            page = self.pages.get(url)
+            if page is not None:
+                self.pages.move_to_end(url)
+            return page
+
+    def put(self, url, page):
+        with self.lock:
+            old = self.pages.pop(url, None)
+            if old is not None:
+                self.size -= len(old.body)
+            if len(page.body) > self.max_bytes:
+                return
+            self.pages[url] = page
+            self.size += len(page.body)
+            while self.size > self.max_bytes:
+                _, evicted = self.pages.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def state(self, page):
+        """
+        'fresh', 'stale' (servable while refreshing) or 'expired'.
+        """
+        if page is None:
+            return 'expired'
+        age = time.monotonic() - page.fetched_at
+        if age < self.ttl:
+            return 'fresh'
+        if age < self.ttl + self.stale_ttl:
+            return 'stale'
+        return 'expired'
+
+    def claim_refresh(self, url):
+        """
+        Returns True if no other background refresh of url is running.
+        """
+        with self.lock:
+            if url in self.refreshing:
+                return False
+            self.refreshing.add(url)
+            return True
+
+    def release_refresh(self, url):
+        with self.lock:
+            self.refreshing.discard(url)
+
+    @staticmethod
+    def validators(page):
+        headers = {}
+        if page is not None and page.etag:
+            headers['If-None-Match'] = page.etag
+        if page is not None and page.last_modified:
+            headers['If-Modified-Since'] = page.last_modified
+        return headers
+
+    def update(self, url, page, status, headers, body):
+        """
+        Stores the response to a request made with validators(page) and
+        returns the current body.
+        """
+        if status == 304 and page is not None:
+            page = page._replace(
+                etag=headers.get('ETag', page.etag),
+                last_modified=headers.get('Last-Modified', page.last_modified),
+                fetched_at=time.monotonic(),
+            )
+        else:
+            page = Page(body, headers.get('ETag'), headers.get('Last-Modified'), time.monotonic())
+        self.put(url, page)
+        return page.body
+
+    def fetch(self, url):
+        """
+        Returns the body of url, fetching it with requests if needed. Raises
+        requests.RequestException if it cannot be fetched.
+        """
+        page = self.get(url)
+        state = self.state(page)
+        if state == 'fresh':
+            return page.body
+        if state == 'stale':
+            if self.claim_refresh(url):
+                threading.Thread(target=self.refresh, args=(url, page), daemon=True).start()
+            return page.body
+        return self.revalidate(url, page)
+
+    def revalidate(self, url, page):
+        response = requests.get(url, headers=self.validators(page), timeout=(
+            getattr(settings, 'NEWS_HTTP_CONNECT_TIMEOUT', 3),
+            getattr(settings, 'NEWS_HTTP_READ_TIMEOUT', 5),
+        ))
+        if response.status_code != 304:
+            response.raise_for_status()
+        return self.update(url, page, response.status_code, response.headers, response.content)
+
+    def refresh(self, url, page):
+        try:
+            self.revalidate(url, page)
+        except Exception as e:
+            print('Error refreshing "{}": {}'.format(url, e))
+        finally:
+            self.release_refresh(url)
+
+    async def afetch(self, url):
+        """
+        Returns the body of url, fetching it with the shared aiohttp client
+        if needed. Raises what HttpClient.request() raises.
+        """
+        page = self.get(url)
+        state = self.state(page)
+        if state == 'fresh':
+            return page.body
+        if state == 'stale':
+            if self.claim_refresh(url):
+                task = asyncio.ensure_future(self.arefresh(url, page))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            return page.body
+        return await self.arevalidate(url, page)
+
+    async def arevalidate(self, url, page):
+        status, headers, body = await client.request(url, self.validators(page))
+        return self.update(url, page, status, headers, body)
+
+    async def arefresh(self, url, page):
+        try:
+            await self.arevalidate(url, page)
+        except Exception as e:
+            print('Error refreshing "{}": {}'.format(url, e))
+        finally:
+            self.release_refresh(url)
+
+
+# Shared by the views and consumers of this process
+pages = PageCache()
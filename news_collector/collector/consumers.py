@@ -1,45 +1,70 @@
 import asyncio
 import json
 import datetime
-from aiohttp import ClientSession
+from urllib.parse import parse_qs
 from channels.generic.http import AsyncHttpConsumer
+from django.conf import settings
+from .cache import pages
 from .constants import BLOGS
 
 
 class NewsCollectorAsyncConsumer(AsyncHttpConsumer):
     """
     Async HTTP consumer that fetches URLs.
+
+    Answers with one JSON dict of all pages, or, with ?stream=1, with one
+    NDJSON record per page sent as soon as that page is in.
     """
 
     async def handle(self, body):
 
-        # Adapted from:
-        # "Making 1 million requests with python-aiohttp"
-        # https://pawelmhm.github.io/asyncio/python/aiohttp/2016/04/22/asyncio-aiohttp.html
-        async def fetch(url, session):
-            async with session.get(url) as response:
-                return await response.read()
+        # Pages are served from collector.cache while fresh; fetches share the
+        # process-wide session in collector.http, so connections and DNS
+        # lookups are reused between clicks
+        t0 = datetime.datetime.now()
+        # Launch a coroutine for each URL fetch
+        fetches = [asyncio.ensure_future(self.fetch(name, url)) for name, url in BLOGS.items()]
+
+        # Sites still loading when the time budget runs out are given up on,
+        # so the slowest blog cannot hold up the response
+        budget = getattr(settings, 'NEWS_FETCH_BUDGET', 10)
+        if self.is_streaming():
+            await self.stream_pages(fetches, budget)
+        else:
+            await self.send_pages(fetches, budget)
+        dt = (datetime.datetime.now() - t0).total_seconds()
+        print('All downloads completed; elapsed time: {} [s]'.format(dt))
 
-        tasks = []
-        loop = asyncio.get_event_loop()
+    def is_streaming(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        return query.get('stream', ['0'])[0] not in ('', '0')
 
-        # aiohttp allows a ClientSession object to link all requests together
-        t0 = datetime.datetime.now()
-        async with ClientSession() as session:
-            for name, url in BLOGS.items():
-                print('Start downloading "%s"' % name)
-                # Launch a coroutine for each URL fetch
-                task = loop.create_task(fetch(url, session))
-                tasks.append(task)
-
-            # Wait on, and then gather, all responses
-            responses = await asyncio.gather(*tasks)
-            dt = (datetime.datetime.now() - t0).total_seconds()
-            print('All downloads completed; elapsed time: {} [s]'.format(dt))
-
-        # asyncio.gather returns results in the order of the original sequence,
-        # so we can safely zip these together.
-        data = dict(zip(BLOGS.keys(), [r.decode('utf-8') for r in responses]))
+    async def fetch(self, name, url):
+        """
+        Returns (name, page content), with None as content if the page could
+        not be fetched.
+        """
+        print('Start downloading "%s"' % name)
+        try:
+            content = await pages.afetch(url)
+        except Exception as e:
+            print('Error downloading "{}": {}'.format(name, e))
+            return name, None
+        return name, content.decode('utf-8', 'replace')
+
+    async def send_pages(self, fetches, budget):
+        """
+        Sends all pages at once as a JSON dict of name to content.
+        """
+        done, pending = await asyncio.wait(fetches, timeout=budget)
+        for task in pending:
+            task.cancel()
+
+        data = {name: 'Download error' for name in BLOGS}
+        for task in done:
+            name, content = task.result()
+            if content is not None:
+                data[name] = content
         text = json.dumps(data)
 
         # We have to send a response using send_response rather than returning
@@ -50,3 +75,32 @@ class NewsCollectorAsyncConsumer(AsyncHttpConsumer):
                 (b"Content-Type", b"application/json"),
             ]
         )
+
+    async def stream_pages(self, fetches, budget):
+        """
+        Sends one NDJSON record per page in the order the pages come in:
+        {"name": ..., "content": ...}, or {"name": ..., "error": ...}.
+        """
+        await self.send_headers(headers=[
+            (b"Content-Type", b"application/x-ndjson"),
+            (b"Cache-Control", b"no-cache"),
+        ])
+        remaining = list(BLOGS)
+        try:
+            for fetch in asyncio.as_completed(fetches, timeout=budget):
+                name, content = await fetch
+                remaining.remove(name)
+                await self.send_record(name, content)
+        except asyncio.TimeoutError:
+            for task in fetches:
+                task.cancel()
+            for name in remaining:
+                await self.send_record(name, None)
+        await self.send_body(b"")
+
+    async def send_record(self, name, content):
+        if content is None:
+            record = {'name': name, 'error': 'Download error'}
+        else:
+            record = {'name': name, 'content': content}
+        await self.send_body(json.dumps(record).encode() + b"\n", more_body=True)
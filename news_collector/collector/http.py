@@ -0,0 +1,104 @@
+import asyncio
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from django.conf import settings
+
+
+class HttpClient:
+    """
+    One aiohttp session shared by every request of this process.
+
+    Its connector keeps connections to each host alive between clicks and
+    caches DNS lookups, so only the first fetch of a host pays for DNS and
+    TLS setup. A global and a per-host semaphore bound how many fetches run
+    at once, and every fetch has connect and read timeouts.
+
+    The session is opened on ASGI lifespan startup and closed on shutdown
+    (see Lifespan); servers that do not send lifespan events get it opened
+    on first use.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.semaphore = None
+        # host -> asyncio.Semaphore
+        self.host_semaphores = {}
+
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return
+        connector = TCPConnector(
+            limit=getattr(settings, 'NEWS_HTTP_CONNECTIONS', 100),
+            limit_per_host=getattr(settings, 'NEWS_HTTP_CONNECTIONS_PER_HOST', 4),
+            ttl_dns_cache=getattr(settings, 'NEWS_HTTP_DNS_TTL', 300),
+            keepalive_timeout=getattr(settings, 'NEWS_HTTP_KEEPALIVE', 60),
+        )
+        timeout = ClientTimeout(
+            total=getattr(settings, 'NEWS_HTTP_TIMEOUT', 10),
+            sock_connect=getattr(settings, 'NEWS_HTTP_CONNECT_TIMEOUT', 3),
+            sock_read=getattr(settings, 'NEWS_HTTP_READ_TIMEOUT', 5),
+        )
+        self.session = ClientSession(connector=connector, timeout=timeout)
+        self.semaphore = asyncio.Semaphore(getattr(settings, 'NEWS_HTTP_CONCURRENCY', 50))
+        self.host_semaphores = {}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def host_semaphore(self, url):
+        host = urlsplit(url).hostname
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(
+                getattr(settings, 'NEWS_HTTP_CONCURRENCY_PER_HOST', 4)
+            )
+        return self.host_semaphores[host]
+
+    async def request(self, url, headers=None):
+        """
+        GETs a URL and returns (status, headers, body). Raises
+        aiohttp.ClientError for error responses (a 304 is returned), and
+        asyncio.TimeoutError when a timeout expires.
+        """
+        await self.start()
+        async with self.semaphore, self.host_semaphore(url):
+            async with self.session.get(url, headers=headers) as response:
+                if response.status != 304:
+                    response.raise_for_status()
+                return response.status, response.headers, await response.read()
+
+
+# Shared by all consumers in this process
+client = HttpClient()
+
+
+class Lifespan:
+    """
+    ASGI lifespan application that opens the shared HTTP client at startup
+    and closes it at shutdown.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+
+    async def __call__(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await client.start()
+                except Exception as e:
+                    # The server reports it and does not start
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await client.close()
+                except Exception as e:
+                    await send({'type': 'lifespan.shutdown.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.testing import ApplicationCommunicator, HttpCommunicator
+from django.test import SimpleTestCase
+
+from .cache import Page, PageCache
+from .consumers import NewsCollectorAsyncConsumer
+from .http import Lifespan
+
+
+class FakeClient:
+    """
+    Stands in for collector.http.client, answering every request with 200
+    and the same body.
+    """
+
+    def __init__(self, body=b'new'):
+        self.body = body
+        self.requests = []
+
+    async def request(self, url, headers=None):
+        self.requests.append((url, headers))
+        # Let the caller run on before the response comes in
+        await asyncio.sleep(0)
+        return 200, {'ETag': '"2"'}, self.body
+
+
+class PageCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pages = PageCache(ttl=60, stale_ttl=300)
+        self.client = FakeClient()
+        patcher = mock.patch('collector.cache.client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fresh_page_is_served_without_a_request(self):
+        self.pages.put('http://a/', Page(b'old', '"1"', None, time.monotonic()))
+
+        self.assertEqual(async_to_sync(self.pages.afetch)('http://a/'), b'old')
+        self.assertEqual(self.client.requests, [])
+
+    def test_stale_page_is_served_while_one_refresh_runs(self):
+        fetched_at = time.monotonic() - 61
+        self.pages.put('http://a/', Page(b'old', '"1"', None, fetched_at))
+
+        async def fetch_twice():
+            bodies = [await self.pages.afetch('http://a/') for _ in range(2)]
+            await asyncio.gather(*self.pages.tasks)
+            return bodies
+
+        self.assertEqual(async_to_sync(fetch_twice)(), [b'old', b'old'])
+        self.assertEqual(self.client.requests, [('http://a/', {'If-None-Match': '"1"'})])
+        page = self.pages.get('http://a/')
+        self.assertEqual((page.body, page.etag, self.pages.state(page)), (b'new', '"2"', 'fresh'))
+        self.assertEqual(self.pages.refreshing, set())
+
+
+class NewsCollectorAsyncConsumerTests(SimpleTestCase):
+
+    @mock.patch('collector.consumers.BLOGS', {'Up': 'http://up/', 'Down': 'http://down/'})
+    def test_streams_one_record_per_page(self):
+        async def afetch(url):
+            if url == 'http://down/':
+                raise OSError('unreachable')
+            return b'<html></html>'
+
+        async def get_response():
+            communicator = HttpCommunicator(
+                NewsCollectorAsyncConsumer, 'GET', '/collector/collect_news_async/?stream=1'
+            )
+            return await communicator.get_response()
+
+        with mock.patch('collector.consumers.pages.afetch', afetch), mock.patch('builtins.print'):
+            response = async_to_sync(get_response)()
+
+        self.assertEqual(response['status'], 200)
+        self.assertIn((b'Content-Type', b'application/x-ndjson'), response['headers'])
+        records = [json.loads(line) for line in response['body'].decode().splitlines()]
+        self.assertEqual(
+            sorted(records, key=lambda record: record['name']),
+            [{'name': 'Down', 'error': 'Download error'}, {'name': 'Up', 'content': '<html></html>'}]
+        )
+
+
+class LifespanTests(SimpleTestCase):
+
+    def test_failed_client_start_fails_startup(self):
+        async def start():
+            raise OSError('no sockets left')
+
+        async def startup():
+            communicator = ApplicationCommunicator(Lifespan, {'type': 'lifespan'})
+            await communicator.send_input({'type': 'lifespan.startup'})
+            return await communicator.receive_output()
+
+        with mock.patch('collector.http.client.start', start):
+            message = async_to_sync(startup)()
+
+        self.assertEqual(message, {'type': 'lifespan.startup.failed', 'message': 'no sockets left'})
@@ -2,6 +2,7 @@ import datetime
 import requests
 from django.shortcuts import render
 from django.http import JsonResponse
+from .cache import pages
 from .constants import BLOGS
 
 
@@ -21,14 +22,14 @@ def news_collector_sync_view(request):
     t0 = datetime.datetime.now()
     max_dt = 0
 
-    # Go through each blog and fetch it using requests
+    # Go through each blog and fetch it using requests, unless the page
+    # cache still has it
     for name, link in BLOGS.items():
         t1 = datetime.datetime.now()
-        response = requests.get(link)
-        if response.status_code != 200:
+        try:
+            data[name] = pages.fetch(link).decode("utf-8", "replace")
+        except requests.RequestException:
             data[name] = 'Download error'
-        else:
-            data[name] = response.content.decode("utf-8")
         dt = (datetime.datetime.now() - t1).total_seconds()
         print('Downloaded "{}" from "{}" in {} [s]'.format(name, link, dt))
         max_dt = max(dt, max_dt)
@@ -2,6 +2,7 @@ from django.urls import path, re_path
 from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
 from collector.consumers import NewsCollectorAsyncConsumer
+from collector.http import Lifespan
 
 
 # By default, the ProtocolTypeRouter sets the "http" route to just be Django.
@@ -16,4 +17,7 @@ application = ProtocolTypeRouter({
         # views handle them.
         re_path("^", AsgiHandler),
     ]),
+
+    # Opens and closes the shared HTTP client of the async fetcher
+    "lifespan": Lifespan,
 })
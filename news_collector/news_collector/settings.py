@@ -34,6 +34,34 @@ CHANNEL_LAYERS = {
     },
 }
 
+##### News collector settings
+
+# The async collector shares one HTTP session per process: at most
+# NEWS_HTTP_CONCURRENCY fetches at once (NEWS_HTTP_CONCURRENCY_PER_HOST per
+# site), over kept-alive connections with cached DNS lookups
+NEWS_HTTP_CONNECTIONS = 100
+NEWS_HTTP_CONNECTIONS_PER_HOST = 4
+NEWS_HTTP_CONCURRENCY = 50
+NEWS_HTTP_CONCURRENCY_PER_HOST = 4
+NEWS_HTTP_DNS_TTL = 300
+NEWS_HTTP_KEEPALIVE = 60
+
+# Timeouts of each fetch, in seconds
+NEWS_HTTP_CONNECT_TIMEOUT = 3
+NEWS_HTTP_READ_TIMEOUT = 5
+NEWS_HTTP_TIMEOUT = 10
+
+# Sites not fetched within this many seconds are reported as download errors
+NEWS_FETCH_BUDGET = 10
+
+# Both collectors cache pages: served as they are for NEWS_CACHE_TTL
+# seconds, then for NEWS_CACHE_STALE_TTL more while being revalidated in the
+# background. The least recently used pages are dropped beyond
+# NEWS_CACHE_MAX_BYTES of page bodies.
+NEWS_CACHE_TTL = 60
+NEWS_CACHE_STALE_TTL = 300
+NEWS_CACHE_MAX_BYTES = 20 * 1024 * 1024
+
 # ASGI_APPLICATION should be set to your outermost router
 ASGI_APPLICATION = 'news_collector.routing.application'
 